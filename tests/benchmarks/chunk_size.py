@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Side by side benchmark of fixed and adaptive read sizes in the download loop, from the local http server and a
+local file
+
+Content is streamed to a sink discarding it, so that only the download loop is measured. The local file is streamed
+in memory mode: downloads to file hard link it instead of reading it. CPU time is the process one: for http
+downloads, it includes the local server serving the file.
+Run it with: python3 -m tests.benchmarks.chunk_size [--size MiB]"""
+
+import argparse
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+from time import process_time, time
+from ..tools import change_xdg_path, patchelem
+from ..tools.local_server import LocalHttp
+from udtc.network.download_center import ChunkSizer, DownloadCenter
+
+GB = 1024*1024*1024
+
+
+class NullSink:
+    """Download sink discarding the content"""
+
+    def write(self, data):
+        pass
+
+    def finish(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+def run_download(url, max_block_size, download):
+    """Download url reading at most max_block_size bytes at once and return (elapsed time, cpu time, reads, error)
+
+    download is the DownloadCenter download mode."""
+    done = threading.Event()
+    results = {}
+    reads = {"count": 0}
+    update = ChunkSizer.update
+
+    def counting_update(sizer):
+        reads["count"] += 1
+        update(sizer)
+
+    def on_done(result):
+        results.update(result)
+        done.set()
+
+    with patchelem(DownloadCenter, 'MAX_BLOCK_SIZE', max_block_size), \
+            patchelem(ChunkSizer, 'update', counting_update):
+        start = time()
+        start_cpu = process_time()
+        DownloadCenter([url], on_done, download=download, stream_to={url: NullSink()})
+        done.wait()
+        (elapsed, cpu) = (time() - start, process_time() - start_cpu)
+    return (elapsed, cpu, reads["count"], results[url].error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fixed and adaptive download read sizes")
+    parser.add_argument("--size", type=int, default=256, help="size of the downloaded file, in MiB")
+    parser.add_argument("--port", type=int, default=9877, help="port of the local http server")
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp()
+    server_dir = tempfile.mkdtemp()
+    change_xdg_path('XDG_CACHE_HOME', cache_dir)
+    path = os.path.join(server_dir, "bigfile")
+    with open(path, 'wb') as f:
+        block = os.urandom(1024*1024)
+        for i in range(args.size):
+            f.write(block)
+    server = LocalHttp(server_dir, port=args.port)
+    try:
+        scenarios = [("http", "{}/bigfile".format(server.get_address()), True), ("file", Path(path).as_uri(), False)]
+        variants = [("fixed", DownloadCenter.BLOCK_SIZE), ("adaptive", DownloadCenter.MAX_BLOCK_SIZE)]
+        print("{:<8} {:<9} {:>10} {:>10} {:>12} {:>14}".format("source", "variant", "time (s)", "MiB/s",
+                                                               "reads/GB", "cpu (s)/GB"))
+        for (name, url, download) in scenarios:
+            for (variant, max_block_size) in variants:
+                # empty the cache so that every run downloads everything
+                shutil.rmtree(cache_dir)
+                os.makedirs(cache_dir)
+                (elapsed, cpu, reads, error) = run_download(url, max_block_size, download)
+                if error:
+                    print("{:<8} {:<9} failed: {}".format(name, variant, error))
+                    continue
+                scale = GB / (args.size * 1024 * 1024)
+                print("{:<8} {:<9} {:>10.3f} {:>10.1f} {:>12.0f} {:>14.3f}".format(
+                    name, variant, elapsed, args.size / elapsed, reads * scale, cpu * scale))
+    finally:
+        server.stop()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(server_dir)
+
+
+if __name__ == '__main__':
+    main()
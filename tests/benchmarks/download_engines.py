@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Side by side benchmark of the threaded and asyncio download engines against the local http server
+
+Run it with: python3 -m tests.benchmarks.download_engines [--downloads N] [--max-per-host N]"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+from time import time
+from ..tools import change_xdg_path, get_data_dir
+from ..tools.local_server import LocalHttp
+from udtc.network.async_engine import AsyncDownloadEngine
+from udtc.network.download_center import DownloadCenter
+from udtc.network.scheduler import DownloadScheduler
+from udtc.settings import UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE
+
+
+def client_threads():
+    """Return the number of threads, except the local server ones (one per connection)"""
+    return len([thread for thread in threading.enumerate() if "process_request_thread" not in thread.name])
+
+
+def run_downloads(engine, urls, download):
+    """Download urls with engine and return (elapsed time, peak number of extra client threads, number of errors)"""
+    os.environ[UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE] = engine
+    done = threading.Event()
+    results = {}
+
+    def on_done(result):
+        results.update(result)
+        done.set()
+
+    initial_threads = client_threads()
+    peak_threads = initial_threads
+    start = time()
+    DownloadCenter(urls, on_done, download=download)
+    while not done.wait(0.01):
+        peak_threads = max(peak_threads, client_threads())
+    elapsed = time() - start
+    for result in results.values():
+        for fd in (result.fd, result.buffer):
+            if fd is not None:
+                fd.close()
+    return (elapsed, peak_threads - initial_threads, len([result for result in results.values() if result.error]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the threaded and asyncio download engines")
+    parser.add_argument("--downloads", type=int, default=200, help="number of concurrent page downloads")
+    parser.add_argument("--files", type=int, default=8, help="number of concurrent file downloads")
+    parser.add_argument("--max-workers", type=int, default=None, help="worker threads of the threaded engine")
+    parser.add_argument("--max-per-host", type=int, default=None, help="concurrent downloads per host")
+    parser.add_argument("--port", type=int, default=9877, help="port of the local http server")
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp()
+    change_xdg_path('XDG_CACHE_HOME', cache_dir)
+    server = LocalHttp(os.path.join(get_data_dir(), "server-content"), port=args.port)
+    scheduler = DownloadScheduler()
+    if args.max_workers:
+        scheduler.max_workers = args.max_workers
+    if args.max_per_host:
+        scheduler.max_per_host = args.max_per_host
+    # start the event loop thread before measuring
+    AsyncDownloadEngine()
+    try:
+        scenarios = [("pages", ["{}/simplefile?{}".format(server.get_address(), i) for i in range(args.downloads)],
+                      False),
+                     ("files", ["{}/biggerfile?{}".format(server.get_address(), i) for i in range(args.files)], True)]
+        print("{:<8} {:<8} {:>10} {:>13} {:>8}".format("scenario", "engine", "time (s)", "extra threads", "errors"))
+        for (name, urls, download) in scenarios:
+            for engine in DownloadCenter.ENGINES:
+                # empty caches so that every run downloads everything
+                shutil.rmtree(cache_dir)
+                os.makedirs(cache_dir)
+                (elapsed, peak_threads, errors) = run_downloads(engine, urls, download)
+                print("{:<8} {:<8} {:>10.3f} {:>13} {:>8}".format(name, engine, elapsed, peak_threads, errors))
+    finally:
+        del os.environ[UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE]
+        server.stop()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -84,6 +84,15 @@ class AndroidStudioTests(LargeFrameworkTests):
         self.assertFalse(self.launcher_exists_and_is_pinned(self.desktop_filename))
         self.assertFalse(self.path_exists(self.exec_path))
 
+    def test_prefetch_android_studio(self):
+        """We download android studio to the cache, without installing it"""
+        self.child = pexpect.spawnu(self.command('{} prefetch android android-studio'.format(UDTC)))
+        self.expect_and_no_warn("Android Studio is prefetched", timeout=self.TIMEOUT_INSTALL_PROGRESS)
+        self.wait_and_no_warn()
+
+        self.assertFalse(self.launcher_exists_and_is_pinned(self.desktop_filename))
+        self.assertFalse(self.path_exists(self.exec_path))
+
     def test_doesnt_accept_wrong_path(self):
         """We don't accept a wrong path"""
         self.child = pexpect.spawnu(self.command('{} android android-studio'.format(UDTC)))
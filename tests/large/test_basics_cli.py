@@ -62,3 +62,8 @@ class BasicCLI(LoggedTestCase):
             self.assertNotIn("DEBUG:", self.return_without_first_output(e.output.decode("utf-8")))
             exception_raised = True
         self.assertTrue(exception_raised)
+
+    def test_cache_stats(self):
+        """We display download cache statistics"""
+        result = subprocess.check_output(self.command_as_list([UDTC, 'cache', 'stats']))
+        self.assertIn("Download cache:", result.decode("utf-8"))
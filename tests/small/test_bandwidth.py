@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the bandwidth limiter"""
+
+from contextlib import suppress
+from ..tools import LoggedTestCase
+from udtc.network.bandwidth import BandwidthLimiter, TokenBucket
+from udtc.tools import Singleton
+
+
+class TestTokenBucket(LoggedTestCase):
+    """This will test the token bucket accounting"""
+
+    def test_unlimited(self):
+        """We never wait without a rate"""
+        bucket = TokenBucket()
+        self.assertEqual(bucket.reserve(1024*1024*1024), 0)
+        self.assertIsNone(bucket.rate)
+
+    def test_wait_for_debt(self):
+        """We wait for the tokens taken in debt to be refilled"""
+        bucket = TokenBucket(1000)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, places=1)
+        self.assertAlmostEqual(bucket.reserve(500), 1, places=1)
+
+    def test_change_rate(self):
+        """We apply a new rate to next consumers"""
+        bucket = TokenBucket(1000)
+        bucket.set_rate(2000)
+        self.assertEqual(bucket.rate, 2000)
+        self.assertAlmostEqual(bucket.reserve(1000), 0.5, places=1)
+        bucket.set_rate(None)
+        self.assertEqual(bucket.reserve(1000), 0)
+
+
+class TestBandwidthLimiter(LoggedTestCase):
+    """This will test the global and per host limits"""
+
+    def setUp(self):
+        super().setUp()
+        # get a fresh limiter for each test
+        with suppress(KeyError):
+            Singleton._instances.pop(BandwidthLimiter)
+
+    def tearDown(self):
+        with suppress(KeyError):
+            Singleton._instances.pop(BandwidthLimiter)
+        super().tearDown()
+
+    def test_unlimited_by_default(self):
+        """We don't limit bandwidth without any configuration"""
+        limiter = BandwidthLimiter()
+        self.assertIsNone(limiter.rate())
+        self.assertEqual(limiter.reserve("http://foo/bar", 1024*1024*1024), 0)
+
+    def test_global_limit(self):
+        """We share the global limit between all hosts"""
+        limiter = BandwidthLimiter()
+        limiter.set_rate(1000)
+        self.assertAlmostEqual(limiter.reserve("http://foo/bar", 500), 0.5, places=1)
+        self.assertAlmostEqual(limiter.reserve("http://baz/bar", 500), 1, places=1)
+
+    def test_host_limit(self):
+        """We only limit the host with its own limit"""
+        limiter = BandwidthLimiter()
+        limiter.set_rate(1000, host="foo")
+        self.assertEqual(limiter.rate("foo"), 1000)
+        self.assertAlmostEqual(limiter.reserve("http://foo/bar", 500), 0.5, places=1)
+        self.assertEqual(limiter.reserve("http://baz/bar", 500), 0)
+
+    def test_strictest_limit_wins(self):
+        """We wait for both the global and host limits"""
+        limiter = BandwidthLimiter()
+        limiter.set_rate(10000)
+        limiter.set_rate(1000, host="foo")
+        self.assertAlmostEqual(limiter.reserve("http://foo/bar", 500), 0.5, places=1)
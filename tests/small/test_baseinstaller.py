@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the base installer download handling"""
+
+from os.path import getsize, join
+import re
+import shutil
+import tempfile
+from time import time
+from unittest.mock import Mock
+from ..tools import change_xdg_path, get_data_dir, CopyingMock, LoggedTestCase
+from ..tools.local_server import LocalHttp
+from udtc.frameworks.baseinstaller import BaseInstaller, DownloadPageParser
+from udtc.network.download_center import DownloadCenter
+from udtc.network.progress import ProgressAggregator, ProgressSnapshot
+
+
+class FakeInstaller:
+    """Installer parsing download pages the Android way, with the default metadata completion"""
+
+    expect_license = True
+    require_checksum = True
+    is_metadata_complete = BaseInstaller.is_metadata_complete
+
+    def __init__(self):
+        self.parsed_lines = 0
+
+    def parse_license(self, line, license_txt, in_license):
+        if line.startswith('<p class="sdk-terms-intro">'):
+            in_license = True
+        if in_license:
+            if line.startswith('</div>'):
+                in_license = False
+            else:
+                license_txt.write(line)
+        return in_license
+
+    def parse_download_link(self, line, in_download):
+        self.parsed_lines += 1
+        url, md5sum = (None, None)
+        if 'id="linux-studio"' in line:
+            in_download = True
+        if in_download:
+            p = re.search(r'href="(.*)">', line)
+            if p:
+                url = p.group(1)
+            p = re.search(r'<td>(\w+)</td>', line)
+            if p:
+                md5sum = p.group(1)
+            if "</tr>" in line:
+                in_download = False
+        if url is None and md5sum is None:
+            return (None, in_download)
+        return ((url, md5sum), in_download)
+
+
+class TestDownloadPageParser(LoggedTestCase):
+    """This will test parsing download pages while they are downloading"""
+
+    PAGE = (b'<p class="sdk-terms-intro">Terms</p>\n'
+            b'<p>Some terms</p>\n'
+            b'</div>\n'
+            b'<tr><a id="linux-studio" href="http://foo/bar.tgz">\n'
+            b'<td>abcdef</td>\n'
+            b'</tr>\n'
+            b'<tr><a id="linux-studio" href="http://foo/later.tgz">\n')
+
+    def feed(self, parser, content, chunk_size):
+        for i in range(0, len(content), chunk_size):
+            parser.write(content[i:i + chunk_size])
+
+    def test_parse_in_chunks(self):
+        """We parse lines split across chunks and stop once we have everything"""
+        installer = FakeInstaller()
+        parser = DownloadPageParser(installer)
+        self.feed(parser, self.PAGE, 5)
+        parser.finish()
+
+        self.assertTrue(parser.complete)
+        self.assertEqual(parser.url, "http://foo/bar.tgz")
+        self.assertEqual(parser.checksum, "abcdef")
+        self.assertEqual(parser.license_txt.getvalue(), '<p class="sdk-terms-intro">Terms</p>\n<p>Some terms</p>\n')
+        # the last link wasn't parsed
+        self.assertEqual(installer.parsed_lines, 6)
+
+    def test_not_complete_without_checksum(self):
+        """We parse the whole page, including its last line without line ending, if we miss a required checksum"""
+        installer = FakeInstaller()
+        parser = DownloadPageParser(installer)
+        self.feed(parser, self.PAGE.replace(b"<td>abcdef</td>\n", b"").rstrip(b"\n"), 1024)
+        self.assertEqual(parser.url, "http://foo/bar.tgz")
+        parser.finish()
+
+        self.assertFalse(parser.complete)
+        self.assertEqual(parser.url, "http://foo/later.tgz")
+        self.assertIsNone(parser.checksum)
+
+
+class TestDownloadPageStreaming(LoggedTestCase):
+    """This will test the download page streaming from a local server"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+
+    def tearDown(self):
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def test_stop_download_once_parsed(self):
+        """We don't download the rest of the page once we have the link, its md5sum and the license"""
+        filename = join("developer.android.com", "sdk", "installing", "studio.html")
+        request = "{}/{}".format(self.server.get_address(), filename)
+        parser = DownloadPageParser(FakeInstaller())
+        callback = CopyingMock()
+        report = CopyingMock()
+        DownloadCenter([request], callback, download=False, report=report, stream_to={request: parser})
+        timeout = time() + 5
+        while not callback.called:
+            if time() > timeout:
+                raise(BaseException("Function not called within 5 seconds"))
+
+        result = callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertTrue(parser.complete)
+        self.assertEqual(parser.url, "https://developer.android.com/android-studio-fake.tgz")
+        self.assertEqual(parser.checksum, "490786f827f2578f788e25e423b10cec")
+        self.assertIn("sdk-terms-intro", parser.license_txt.getvalue())
+        self.assertLess(report.call_args[0][0][request]["current"], getsize(join(self.server_dir, filename)))
+
+
+class TestRequirementsFailure(LoggedTestCase):
+    """This will test the downloads once the requirements installation is done"""
+
+    def test_cancel_downloads_on_error(self):
+        """We cancel the downloads in flight once the requirements installation failed"""
+        installer = Mock()
+        BaseInstaller.requirement_done(installer, Mock(error="Can't install requirements"))
+
+        installer._download_center.cancel.assert_called_once_with()
+        installer.download_and_requirements_done.assert_called_once_with()
+
+    def test_keep_downloading_on_success(self):
+        """We keep downloading once the requirements are installed"""
+        installer = Mock()
+        BaseInstaller.requirement_done(installer, Mock(error=None))
+
+        installer._download_center.cancel.assert_not_called()
+
+
+class TestDownloadProgress(LoggedTestCase):
+    """This will test the download progress reported by the installer"""
+
+    def report(self, installer, *downloads):
+        """Report the downloads (url, current, size) progress to the installer"""
+        aggregator = ProgressAggregator()
+        for (url, current, size) in downloads:
+            aggregator.update(url, current, size)
+        snapshot = ProgressSnapshot({url: {"current": current, "size": size} for (url, current, size) in downloads},
+                                    aggregator.totals())
+        BaseInstaller.get_progress_download(installer, snapshot)
+
+    def test_report_progress(self):
+        """We report the overall download progress, weighted by size"""
+        installer = Mock()
+        self.report(installer, ("http://foo", 100, 100), ("http://bar", 0, 300))
+
+        installer.get_progress.assert_called_once_with(25, None)
+        self.assertEqual(installer.total_download_size, 400)
+
+    def test_unknown_sizes(self):
+        """We don't report any progress until a download size is known"""
+        installer = Mock()
+        self.report(installer, ("http://foo", 100, -1))
+
+        installer.get_progress.assert_not_called()
+        self.assertEqual(installer.total_download_size, 0)
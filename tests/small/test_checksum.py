@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the download checksums"""
+
+import hashlib
+import tempfile
+from ..tools import LoggedTestCase
+from udtc.network.checksum import Checksum
+
+
+class TestChecksum(LoggedTestCase):
+    """This will test checksum parsing and computation"""
+
+    def test_parse_bare_md5(self):
+        """A bare digest is a md5sum"""
+        self.assertEqual(Checksum.parse("ABCD"), {"md5": "abcd"})
+
+    def test_parse_typed_digests(self):
+        """We parse one or multiple typed digests"""
+        self.assertEqual(Checksum.parse("SHA256:abcd"), {"sha256": "abcd"})
+        self.assertEqual(Checksum.parse(("sha256:abcd", "sha512:ef")), {"sha256": "abcd", "sha512": "ef"})
+
+    def test_parse_no_checksum(self):
+        """We don't expect anything without checksum"""
+        self.assertEqual(Checksum.parse(None), {})
+        self.assertIsNone(Checksum(None).strongest())
+
+    def test_parse_unsupported_digest(self):
+        """We raise on unknown digest types"""
+        self.assertRaises(BaseException, Checksum.parse, "crc32:abcd")
+
+    def test_strongest(self):
+        """We return the strongest digest"""
+        self.assertEqual(Checksum(("md5:abcd", "sha256:ef", "sha1:12")).strongest(), ("sha256", "ef"))
+
+    def test_compute_all_digests_in_one_pass(self):
+        """We compute all expected digests from the same chunks"""
+        checksum = Checksum(("md5:" + hashlib.md5(b"foobar").hexdigest(),
+                             "sha512:" + hashlib.sha512(b"foobar").hexdigest()))
+        checksum.update(b"foo")
+        checksum.update(b"bar")
+        self.assertEqual(checksum.mismatches(), [])
+
+    def test_mismatches(self):
+        """We return the digests which don't match"""
+        checksum = Checksum(("md5:" + hashlib.md5(b"foobar").hexdigest(), "sha256:abcd"))
+        checksum.update(b"foobar")
+        self.assertEqual(checksum.mismatches(), ["sha256"])
+
+    def test_update_from_file(self):
+        """We hash a range of a file"""
+        checksum = Checksum("sha256:" + hashlib.sha256(b"bar").hexdigest())
+        with tempfile.TemporaryFile() as f:
+            f.write(b"foobarbaz")
+            f.flush()
+            checksum.update_from_file(f, 3, 6)
+        self.assertEqual(checksum.mismatches(), [])
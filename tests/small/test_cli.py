@@ -21,7 +21,7 @@
 
 import importlib
 from ..tools import LoggedTestCase
-from udtc.ui.cli import mangle_args_for_default_framework
+from udtc.ui.cli import frameworks_to_prefetch, mangle_args_for_default_framework
 import os
 import sys
 from ..tools import get_data_dir, change_xdg_path, patchelem
@@ -185,3 +185,37 @@ class TestCLIFromFrameworks(LoggedTestCase):
         """No framework in a category without default are preserved with global and ext options"""
         self.assertEquals(mangle_args_for_default_framework(["-v", "category-f", "--foo", "install_path"]),
                           ["-v", "category-f", "--foo", "install_path"])
+
+    def prefetched_names(self, *args):
+        """Return the sorted names of the frameworks to prefetch for args, any framework being prefetchable"""
+        with patchelem(udtc.ui.cli, 'BaseInstaller', frameworks.BaseFramework):
+            prefetched = frameworks_to_prefetch(*args)
+        return sorted(framework.name for framework in prefetched) if prefetched is not None else None
+
+    def test_prefetch_all_frameworks(self):
+        """We prefetch all frameworks of all categories by default"""
+        names = self.prefetched_names()
+        self.assertIn("Framework A", names)
+        self.assertIn("Framework/B", names)
+        self.assertIn("Framework Free A", names)
+
+    def test_prefetch_category(self):
+        """We prefetch all frameworks of a category"""
+        self.assertEquals(self.prefetched_names("category-a"), ["Framework A", "Framework/B"])
+
+    def test_prefetch_framework(self):
+        """We prefetch one framework of a category"""
+        self.assertEquals(self.prefetched_names("category-a", "framework-b"), ["Framework/B"])
+
+    def test_prefetch_framework_in_main_category(self):
+        """We prefetch one framework of the main category"""
+        self.assertEquals(self.prefetched_names("framework-free-a"), ["Framework Free A"])
+
+    def test_prefetch_unknown(self):
+        """We have nothing to prefetch for unknown categories or frameworks"""
+        self.assertIsNone(self.prefetched_names("category-z"))
+        self.assertIsNone(self.prefetched_names("category-a", "framework-z"))
+
+    def test_prefetch_only_installers(self):
+        """We only prefetch frameworks downloading something"""
+        self.assertIsNone(frameworks_to_prefetch("category-a"))
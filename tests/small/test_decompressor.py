@@ -19,14 +19,16 @@
 
 """Tests for the decompressor module"""
 
+from io import BytesIO
 import os
+import tarfile
 from time import time
 from unittest.mock import Mock
 import shutil
 import stat
 import tempfile
 from ..tools import get_data_dir, LoggedTestCase
-from udtc.decompressor import Decompressor
+from udtc.decompressor import Decompressor, StreamExtractor
 
 
 class TestDecompressor(LoggedTestCase):
@@ -150,3 +152,108 @@ class TestDecompressor(LoggedTestCase):
         self.assertTrue(os.path.isfile(execfile))
         self.assertEquals(oct(stat.S_IMODE(os.lstat(simplefile).st_mode)), '0o664')
         self.assertEquals(oct(stat.S_IMODE(os.lstat(execfile).st_mode)), '0o775')
+
+    def stream_file(self, filepath, extractor, chunk_size=1000):
+        """Feed filepath content to extractor in chunks"""
+        with open(filepath, 'rb') as f:
+            for data in iter(lambda: f.read(chunk_size), b""):
+                extractor.write(data)
+
+    def test_stream_extract(self):
+        """We extract a tarball fed in chunks, then move it to its destination"""
+        self.tempdir = tempfile.mkdtemp()
+        dest = os.path.join(self.tempdir, "dest")
+        extractor = StreamExtractor(dest)
+        self.stream_file(os.path.join(self.compressfiles_dir, "valid.tgz"), extractor)
+        extractor.finish()
+        self.assertFalse(os.path.exists(dest))
+
+        Decompressor({extractor: Decompressor.DecompressOrder(dest=dest, dir='server-content')}, self.on_done)
+        self.wait_for_callback(self.on_done)
+
+        results = self.on_done.call_args[0][0]
+        self.assertIsNone(results[extractor].error)
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'simplefile')))
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'subdir', 'otherfile')))
+        extractor.close()
+        self.assertEqual(os.listdir(self.tempdir), ["dest"])
+
+    def test_stream_extract_invalid_file(self):
+        """We raise an error if the streamed tarball is invalid"""
+        self.tempdir = tempfile.mkdtemp()
+        extractor = StreamExtractor(os.path.join(self.tempdir, "dest"))
+        with self.assertRaises(BaseException):
+            self.stream_file(os.path.join(self.compressfiles_dir, "invalid.tgz"), extractor)
+            extractor.finish()
+        extractor.abort()
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_stream_extract_abort(self):
+        """We discard the partially extracted tree when aborting"""
+        self.tempdir = tempfile.mkdtemp()
+        extractor = StreamExtractor(os.path.join(self.tempdir, "dest"))
+        with open(os.path.join(self.compressfiles_dir, "valid.tgz"), 'rb') as f:
+            extractor.write(f.read(200))
+        extractor.abort()
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def build_tarball(self, *members):
+        """Return the content of a tarball of members, tuples of (name, type, linkname)"""
+        content = BytesIO()
+        with tarfile.open(fileobj=content, mode="w") as archive:
+            for (name, type, linkname) in members:
+                info = tarfile.TarInfo(name)
+                info.type = type
+                info.linkname = linkname
+                data = b"foo" if type == tarfile.REGTYPE else b""
+                info.size = len(data)
+                archive.addfile(info, BytesIO(data))
+        return content.getvalue()
+
+    def assert_stream_rejected(self, *members):
+        """Assert that streaming a tarball of members fails without writing anything outside of the staging dir"""
+        self.tempdir = tempfile.mkdtemp()
+        extractor = StreamExtractor(os.path.join(self.tempdir, "install", "dest"))
+        with self.assertRaises(BaseException):
+            extractor.write(self.build_tarball(*members))
+            extractor.finish()
+        extractor.abort()
+        self.assertEqual(os.listdir(self.tempdir), ["install"])
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, "install")), [])
+
+    def test_stream_extract_rejects_parent_path(self):
+        """We don't extract members outside of the staging directory"""
+        self.assert_stream_rejected(("../../escaped.txt", tarfile.REGTYPE, ""))
+
+    def test_stream_extract_rejects_absolute_path(self):
+        """We don't extract members with an absolute path"""
+        self.assert_stream_rejected(("/tmp/escaped.txt", tarfile.REGTYPE, ""))
+
+    def test_stream_extract_rejects_link_outside(self):
+        """We don't extract links going outside of the staging directory, nor files through them"""
+        self.assert_stream_rejected(("escape", tarfile.SYMTYPE, "../.."), ("escape/escaped.txt", tarfile.REGTYPE, ""))
+
+    def test_stream_extract_rejects_device(self):
+        """We don't extract device files"""
+        self.assert_stream_rejected(("null", tarfile.CHRTYPE, ""))
+
+    def test_stream_extract_links_inside(self):
+        """We extract links staying in the staging directory"""
+        self.tempdir = tempfile.mkdtemp()
+        extractor = StreamExtractor(os.path.join(self.tempdir, "dest"))
+        extractor.write(self.build_tarball(("dir/file", tarfile.REGTYPE, ""),
+                                           ("dir/link", tarfile.SYMTYPE, "file"),
+                                           ("hardlink", tarfile.LNKTYPE, "dir/file")))
+        extractor.finish()
+
+        self.assertEqual(os.readlink(os.path.join(extractor.path, "dir", "link")), "file")
+        with open(os.path.join(extractor.path, "hardlink"), 'rb') as f:
+            self.assertEqual(f.read(), b"foo")
+        extractor.close()
+
+    def test_can_stream(self):
+        """We only stream tarballs"""
+        self.tempdir = tempfile.mkdtemp()
+        self.assertTrue(StreamExtractor.can_stream("http://foo/bar.tar.gz"))
+        self.assertTrue(StreamExtractor.can_stream("http://foo/bar.TGZ"))
+        self.assertFalse(StreamExtractor.can_stream("http://foo/bar.zip"))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the download cache"""
+
+import os
+import shutil
+import tempfile
+from ..tools import change_xdg_path, LoggedTestCase, patchelem
+from udtc.network.download_cache import DownloadCache
+
+
+class TestDownloadCache(LoggedTestCase):
+    """This will test the download cache in a temporary cache directory"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        self.cache = DownloadCache()
+        self.fd_to_close = []
+
+    def tearDown(self):
+        for fd in self.fd_to_close:
+            fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def create_file(self, content):
+        """Create a file with content and return its path"""
+        fd, path = tempfile.mkstemp(dir=self.cache_dir)
+        with open(fd, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_key_for_digest(self):
+        """We key by digest when we know it"""
+        self.assertEqual(DownloadCache.key_for("http://foo/bar", digest=("sha256", "ABCD"), validator="foo"),
+                         "sha256-abcd")
+
+    def test_key_for_url_and_validator(self):
+        """We key by url and validator if there is no md5sum"""
+        key = DownloadCache.key_for("http://foo/bar", validator="foo")
+        self.assertTrue(key.startswith("url-"))
+        self.assertNotEqual(key, DownloadCache.key_for("http://foo/bar", validator="bar"))
+
+    def test_key_for_unidentified_content(self):
+        """We can't key content without md5sum nor validator"""
+        self.assertIsNone(DownloadCache.key_for("http://foo/bar"))
+
+    def test_add_and_get(self):
+        """We get back content we added, as a temporary file which doesn't remove it from the cache"""
+        self.cache.add("md5-foo", self.create_file(b"content"))
+        fd = self.cache.get("md5-foo", suffix=".tgz")
+        self.assertTrue(fd.name.endswith(".tgz"))
+        self.assertEqual(fd.read(), b"content")
+        fd.close()
+
+        fd = self.cache.get("md5-foo")
+        self.fd_to_close.append(fd)
+        self.assertEqual(fd.read(), b"content")
+
+    def test_get_unknown_key(self):
+        """We return None for content not in the cache"""
+        self.assertIsNone(self.cache.get("md5-foo"))
+
+    def test_remove(self):
+        """We remove an entry, ignoring unknown ones"""
+        self.cache.add("md5-foo", self.create_file(b"content"))
+        self.cache.remove("md5-foo")
+        self.cache.remove("md5-bar")
+        self.assertIsNone(self.cache.get("md5-foo"))
+
+    def test_stats(self):
+        """We count entries, size, hits and misses"""
+        self.cache.add("md5-foo", self.create_file(b"content"))
+        self.fd_to_close.append(self.cache.get("md5-foo"))
+        self.cache.get("md5-bar")
+        self.cache.get("md5-baz")
+
+        stats = self.cache.stats()
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["size"], 7)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+
+    def test_evict_least_recently_used(self):
+        """We evict least recently used content once over the size budget"""
+        with patchelem(DownloadCache, 'DEFAULT_MAX_SIZE', 15):
+            self.cache.add("md5-foo", self.create_file(b"content"))
+            self.cache.add("md5-bar", self.create_file(b"content"))
+            os.utime(os.path.join(self.cache.path, "md5-foo"), (0, 0))
+            os.utime(os.path.join(self.cache.path, "md5-bar"), (1, 1))
+            # foo is used again
+            self.fd_to_close.append(self.cache.get("md5-foo"))
+            self.cache.add("md5-baz", self.create_file(b"content"))
+
+        self.assertIsNone(self.cache.get("md5-bar"))
+        self.assertEqual(self.cache.stats()["entries"], 2)
+
+    def test_prune(self):
+        """We remove everything when evicting to 0"""
+        self.cache.add("md5-foo", self.create_file(b"content"))
+        self.cache.add("md5-bar", self.create_file(b"other content"))
+
+        self.assertEqual(self.cache.evict(max_size=0), 20)
+        self.assertEqual(self.cache.stats()["entries"], 0)
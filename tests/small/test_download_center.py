@@ -19,13 +19,38 @@
 
 """Tests for the download center module using a local server"""
 
+import asyncio
+from concurrent import futures
+from contextlib import suppress
+from email.utils import formatdate
+import json
 import os
-from os.path import join, getsize
+from os.path import join, getsize, getmtime
+import random
+import shutil
+import tempfile
+import threading
 from time import time
-from unittest.mock import Mock, call
-from ..tools import get_data_dir, CopyingMock, LoggedTestCase
+from unittest.mock import Mock, call, patch
+from urllib.request import pathname2url
+import requests.exceptions
+import urllib3.exceptions
+import yaml
+from ..tools import change_xdg_path, get_data_dir, CopyingMock, LoggedTestCase, patchelem
 from ..tools.local_server import LocalHttp
-from udtc.network.download_center import DownloadCenter
+from udtc.network.download_cache import DownloadCache, PageCache
+from udtc.decompressor import StreamExtractor
+from udtc.network.checksum import Checksum
+from udtc.network.async_engine import AsyncDownloadEngine, with_timeout
+from udtc.network.bandwidth import BandwidthLimiter
+from udtc.network.download_center import ChunkSizer, DownloadCancelled, DownloadCenter
+from udtc.network.mirrors import DownloadStalled, MirrorSelector, ThroughputMonitor
+from udtc.network.scheduler import DownloadScheduler
+from udtc.network.session import SessionManager
+from udtc.network.single_flight import InFlightDownloads
+from udtc.network import telemetry
+from udtc.settings import UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE
+from udtc.tools import Singleton
 
 
 class TestDownloadCenter(LoggedTestCase):
@@ -48,11 +73,20 @@ class TestDownloadCenter(LoggedTestCase):
         super().setUp()
         self.callback = Mock()
         self.fd_to_close = []
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        # don't share transfers left in flight by previous tests
+        with suppress(KeyError):
+            Singleton._instances.pop(InFlightDownloads)
 
     def tearDown(self):
         super().tearDown()
+        with suppress(KeyError):
+            Singleton._instances.pop(InFlightDownloads)
         for fd in self.fd_to_close:
             fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
 
     def build_server_address(self, path, localhost=False):
         """build server address to path to get requested"""
@@ -137,6 +171,18 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertIsNone(result.buffer)
         self.assertIsNone(result.error)
 
+    def test_download_with_md5_hashed_while_streaming(self):
+        """we compute the md5sum while downloading, without reading the file back"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        update_from_file = Mock()
+        with patchelem(Checksum, 'update_from_file', update_from_file):
+            DownloadCenter([(request, '268a5059001855fef30b4f95f82044ed')], self.callback)
+            self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][request].error)
+        self.assertFalse(update_from_file.called)
+
     def test_download_with_progress(self):
         """we deliver progress hook while downloading"""
         filename = "simplefile"
@@ -151,14 +197,48 @@ class TestDownloadCenter(LoggedTestCase):
                          [call({self.build_server_address(filename): {'size': filesize, 'current': 0}}),
                           call({self.build_server_address(filename): {'size': filesize, 'current': filesize}})])
 
+    def report_all_progress(self):
+        """return a context manager where downloads report all their progress, without coalescing it"""
+        return patchelem(DownloadCenter, 'report_granularity', classmethod(lambda cls: (0, 0)))
+
+    def test_download_with_coalesced_progress(self):
+        """we deliver the first and last progress of a download, coalescing the ones in between"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        report = Mock()
+        request = self.build_server_address(filename)
+        DownloadCenter([request], self.callback, report=report)
+        self.wait_for_callback(self.callback)
+
+        # each report is a snapshot, never modified afterwards
+        self.assertEqual(report.call_args_list,
+                         [call({request: {'size': filesize, 'current': 0}}),
+                          call({request: {'size': filesize, 'current': filesize}})])
+
+    def test_download_with_progress_every_step(self):
+        """we deliver progress once it moved by the report step"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        report = Mock()
+        request = self.build_server_address(filename)
+        with patchelem(DownloadCenter, 'report_granularity', classmethod(lambda cls: (0, 95))):
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        # the first block is less than 95% of the file
+        self.assertEqual(report.call_args_list,
+                         [call({request: {'size': filesize, 'current': 0}}),
+                          call({request: {'size': filesize, 'current': filesize}})])
+
     def test_download_with_multiple_progress(self):
-        """we deliver multiple progress hooks on bigger files"""
+        """we deliver all progress hooks on bigger files without coalescing them"""
         filename = "biggerfile"
         filesize = getsize(join(self.server_dir, filename))
         report = CopyingMock()
         request = self.build_server_address(filename)
-        dl_center = DownloadCenter([request], self.callback, report=report)
-        self.wait_for_callback(self.callback)
+        with self.report_all_progress():
+            dl_center = DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
 
         self.assertEqual(report.call_count, 3)
         self.assertEqual(report.call_args_list,
@@ -167,6 +247,22 @@ class TestDownloadCenter(LoggedTestCase):
                                                                       'current': dl_center.BLOCK_SIZE}}),
                           call({self.build_server_address(filename): {'size': filesize, 'current': filesize}})])
 
+    def test_download_progress_totals(self):
+        """we deliver the overall progress of all downloads with each report, and from the progress aggregator"""
+        requests = [self.build_server_address("biggerfile"), self.build_server_address("simplefile")]
+        total_size = sum(getsize(join(self.server_dir, filename)) for filename in ("biggerfile", "simplefile"))
+        report = CopyingMock()
+        with self.report_all_progress():
+            dl_center = DownloadCenter(requests, self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        for ((snapshot,), kwargs) in report.call_args_list:
+            self.assertEqual(snapshot.totals.current, sum(progress["current"] for progress in snapshot.values()))
+        totals = report.call_args[0][0].totals
+        self.assertEqual((totals.current, totals.size, totals.unknown), (total_size, total_size, 0))
+        self.assertEqual(totals.percentage, 100)
+        self.assertEqual(dl_center.progress.totals(), totals)
+
     def test_multiple_downloads(self):
         """we deliver more than on download in parallel"""
         requests = [self.build_server_address("biggerfile"), self.build_server_address("simplefile")]
@@ -188,8 +284,9 @@ class TestDownloadCenter(LoggedTestCase):
         """we deliver more than on download in parallel"""
         requests = [self.build_server_address("biggerfile"), self.build_server_address("simplefile")]
         report = CopyingMock()
-        DownloadCenter(requests, self.callback, report=report)
-        self.wait_for_callback(self.callback)
+        with self.report_all_progress():
+            DownloadCenter(requests, self.callback, report=report)
+            self.wait_for_callback(self.callback)
 
         self.assertEqual(report.call_count, 5)
         # ensure that first call only contains one file
@@ -289,6 +386,44 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertIsNone(result.fd)
         self.expect_warn_error = True
 
+    def test_download_with_sha256(self):
+        """we deliver one successful download, matching a typed sha256 digest"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        DownloadCenter([(request, 'sha256:b1b113c6ed8ab3a14779f7c54179eac2b87d39fcebbf65a50556b8d68caaa2fb')],
+                       self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_download_with_multiple_digests(self):
+        """we check all digests of a request and report the ones which don't match"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        DownloadCenter([(request, ('md5:268a5059001855fef30b4f95f82044ed', 'sha256:AAAAA'))], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("The sha256 of", result.error)
+        self.assertIn("Corrupted download", result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_download_with_unsupported_digest(self):
+        """we raise an error on unknown digest types"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        DownloadCenter([(request, 'crc32:AAAAA')], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Unsupported checksum type", result.error)
+        self.expect_warn_error = True
+
     def test_download_with_no_size(self):
         """we deliver one successful download, even if size isn't provided. Progress returns -1 though"""
         filename = "simplefile-with-no-content-length"
@@ -308,88 +443,1538 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertEqual(report.call_count, 2)
         self.assertEqual(report.call_args_list,
                          [call({self.build_server_address(filename): {'size': -1, 'current': 0}}),
-                          call({self.build_server_address(filename): {'size': -1, 'current': 8192}})])
+                          call({self.build_server_address(filename): {'size': -1,
+                                                                      'current': getsize(join(self.server_dir,
+                                                                                              filename))}})])
 
+    def test_segmented_download(self):
+        """we deliver a big download fetched in multiple ranges in parallel"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+            self.wait_for_callback(self.callback)
 
-class TestDownloadCenterSecure(LoggedTestCase):
-    """This will test the download center in secure mode by sending one or more download requests"""
-
-    server = None
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertIsNone(result.buffer)
 
-    @classmethod
-    def setUpClass(cls):
-        super().setUpClass()
-        cls.server_dir = join(get_data_dir(), "server-content")
-        cls.server = LocalHttp(cls.server_dir, use_ssl="localhost.pem")
+    def test_segmented_download_with_wrong_md5(self):
+        """we raise an error if a download in multiple ranges doesn't have the correct md5sum"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024):
+            DownloadCenter([(request, 'AAAAA')], self.callback)
+            self.wait_for_callback(self.callback)
 
-    @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        cls.server.stop()
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Corrupted download", result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
 
-    def setUp(self):
-        super().setUp()
-        self.callback = Mock()
-        self.fd_to_close = []
+    def test_segmented_download_with_progress(self):
+        """we deliver progress hooks summing all segments while downloading in multiple ranges"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
+        report = CopyingMock()
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024):
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
 
-    def tearDown(self):
-        super().tearDown()
-        for fd in self.fd_to_close:
-            fd.close()
+        self.assertEqual(report.call_args_list[0], call({request: {'size': filesize, 'current': 0}}))
+        self.assertEqual(report.call_args, call({request: {'size': filesize, 'current': filesize}}))
 
-    def test_download(self):
-        """we deliver one successful download under ssl with known cert"""
-        filename = "simplefile"
-        # The host name is important here, since we verify it, so request
-        # the localhost address.
-        request = TestDownloadCenter.build_server_address(self, filename, True)
-        # prepare the cert and set it as the trusted system context
-        os.environ['REQUESTS_CA_BUNDLE'] = join(get_data_dir(), 'localhost.pem')
-        try:
+    def test_segmented_download_fallback_without_ranges(self):
+        """we fallback to one stream if the server doesn't advertise ranges and content length"""
+        filename = "simplefile-with-no-content-length"
+        request = self.build_server_address(filename)
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1):
             DownloadCenter([request], self.callback)
-            TestDownloadCenter.wait_for_callback(self, self.callback)
+            self.wait_for_callback(self.callback)
 
-            result = self.callback.call_args[0][0][request]
-            self.assertTrue(self.callback.called)
-            self.assertEqual(self.callback.call_count, 1)
-            with open(os.path.join(self.server_dir, filename), 'rb') as file_on_disk:
-                self.assertEqual(file_on_disk.read(),
-                                 result.fd.read())
-        finally:
-            del os.environ['REQUESTS_CA_BUNDLE']
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
 
-    def test_redirect_download(self):
-        """we deliver one successful download after being redirected"""
+    def test_segments_scheduled_against_host_limit(self):
+        """we submit segments to the scheduler, and fetch ourself those it doesn't start"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        submit = DownloadScheduler.submit
+        segments = []
+
+        def never_start_segments(scheduler, fn, *args, url=None, priority=DownloadScheduler.DEFAULT_PRIORITY,
+                                 ready=None):
+            if fn.__name__ != "run":
+                return submit(scheduler, fn, *args, url=url, priority=priority, ready=ready)
+            segments.append((url, priority))
+            return futures.Future()
+
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024), \
+                patchelem(DownloadScheduler, 'submit', never_start_segments):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+        self.assertEqual(segments, [(request, DownloadScheduler.DEFAULT_PRIORITY)] * (DownloadCenter.SEGMENTS - 1))
+
+    def create_partial(self, request, filename, size, validator=None, md5sum=None):
+        """Create a partial download of the size first bytes of filename for request"""
+        partial_path, state_path = DownloadCenter._partial_paths(request, Checksum.parse(md5sum))
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            with open(partial_path, 'wb') as f:
+                f.write(file_on_disk.read(size))
+        if validator is None:
+            validator = formatdate(getmtime(join(self.server_dir, filename)), usegmt=True)
+        with open(state_path, 'w') as f:
+            yaml.dump({"url": request, "validator": validator}, f)
+
+    def test_resume_download(self):
+        """we resume a previous partial download"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
+        self.create_partial(request, filename, 5000)
+        report = CopyingMock()
+        DownloadCenter([request], self.callback, report=report)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(report.call_args_list[0], call({request: {'size': filesize, 'current': 5000}}))
+        self.assertEqual(report.call_args, call({request: {'size': filesize, 'current': filesize}}))
+        # the partial file became the temporary file
+        self.assertEqual(os.listdir(os.path.dirname(DownloadCenter._partial_paths(request, None)[0])),
+                         [os.path.basename(result.fd.name)])
+
+    def test_resume_download_with_md5(self):
+        """we check the md5sum of a resumed download, including the previously downloaded part"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        self.create_partial(request, filename, 5000, md5sum='42d69d1a6d333a7ebdf64792a555e392')
+        DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_resume_download_changed_on_server(self):
+        """we restart the download from scratch if the file changed on the server since the partial download"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
+        self.create_partial(request, filename, 5000, validator="Mon, 01 Jan 2001 00:00:00 GMT")
+        report = CopyingMock()
+        DownloadCenter([request], self.callback, report=report)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(report.call_args_list[0], call({request: {'size': filesize, 'current': 0}}))
+
+    def test_interrupted_download_is_resumed(self):
+        """we keep what was downloaded when interrupted and only download the rest on next attempt"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
+        report = Mock(side_effect=[None, BaseException("Connection dropped")])
+        with self.report_all_progress():
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+        self.assertIn("Connection dropped", self.callback.call_args[0][0][request].error)
+        self.assertEqual(getsize(DownloadCenter._partial_paths(request, None)[0]), DownloadCenter.BLOCK_SIZE)
+
+        callback = Mock()
+        report = CopyingMock()
+        DownloadCenter([request], callback, report=report)
+        self.wait_for_callback(callback)
+
+        result = callback.call_args[0][0][request]
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(report.call_args_list[0], call({request: {'size': filesize,
+                                                                   'current': DownloadCenter.BLOCK_SIZE}}))
+        self.expect_warn_error = True
+
+    def test_interrupted_segmented_download_is_resumed(self):
+        """we keep the complete segments of an interrupted segmented download and only download the missing ones"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024), patchelem(DownloadCenter, 'MAX_RETRIES', 0), \
+                patchelem(DownloadCenter, '_get', self.flaky_get(0)):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+            self.wait_for_callback(self.callback)
+        self.assertIsNotNone(self.callback.call_args[0][0][request].error)
+        partial_path, state_path = DownloadCenter._partial_paths(request,
+                                                                 Checksum.parse('42d69d1a6d333a7ebdf64792a555e392'))
+        self.assertTrue(os.path.isfile(partial_path))
+        with open(state_path) as f:
+            missing = ["bytes={}-{}".format(next, end) for (start, next, end) in yaml.safe_load(f)["segments"]
+                       if next <= end]
+        self.assertIn("bytes=0-2249", missing)
+
+        callback = Mock()
+        headers = []
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024),\
+                patchelem(DownloadCenter, '_get', self.recording_get(DownloadCenter._get, headers)):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], callback)
+            self.wait_for_callback(callback)
+
+        result = callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(sorted(h["Range"] for h in headers), sorted(missing))
+        self.assertFalse(os.path.exists(state_path))
+        self.expect_warn_error = True
+
+    def test_download_from_cache(self):
+        """we don't download again an archive with the same md5sum than a previous one"""
         filename = "simplefile"
-        # We add a suffix to make the server redirect us.
-        request = TestDownloadCenter.build_server_address(self,
-                                                          filename + "-redirect",
-                                                          localhost=True)
-        os.environ['REQUESTS_CA_BUNDLE'] = join(get_data_dir(), 'localhost.pem')
-        try:
-            DownloadCenter([request], self.callback)
-            TestDownloadCenter.wait_for_callback(self, self.callback)
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
+        DownloadCenter([(request, '268a5059001855fef30b4f95f82044ed')], self.callback)
+        self.wait_for_callback(self.callback)
 
-            result = self.callback.call_args[0][0][request]
-            self.assertTrue(self.callback.called)
-            self.assertEqual(self.callback.call_count, 1)
-            with open(os.path.join(self.server_dir, filename), 'rb') as file_on_disk:
-                self.assertEqual(file_on_disk.read(),
-                                 result.fd.read())
-            self.assertIsNone(result.buffer)
-            self.assertIsNone(result.error)
-        finally:
-            del os.environ['REQUESTS_CA_BUNDLE']
+        callback = Mock()
+        report = CopyingMock()
+        # even from another url
+        other_request = self.build_server_address(filename + "-redirect")
+        DownloadCenter([(other_request, '268a5059001855fef30b4f95f82044ed')], callback, report=report)
+        self.wait_for_callback(callback)
 
-    def test_with_invalid_certificate(self):
-        """we error on invalid ssl certificate"""
+        result = callback.call_args[0][0][other_request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(report.call_args_list, [call({other_request: {'size': filesize, 'current': filesize}})])
+        self.assertEqual(DownloadCache().stats()["hits"], 1)
+
+    def test_download_from_cache_keyed_on_strongest_digest(self):
+        """we key the cached archive on the strongest digest of the request"""
         filename = "simplefile"
-        request = TestDownloadCenter.build_server_address(self, filename)
+        request = self.build_server_address(filename)
+        sha256 = 'b1b113c6ed8ab3a14779f7c54179eac2b87d39fcebbf65a50556b8d68caaa2fb'
+        DownloadCenter([(request, ('md5:268a5059001855fef30b4f95f82044ed', 'sha256:' + sha256))], self.callback)
+        self.wait_for_callback(self.callback)
+
+        self.assertEqual([os.path.basename(path) for (path, size, last_use) in DownloadCache().entries()],
+                         ['sha256-' + sha256])
+        callback = Mock()
+        DownloadCenter([(request, 'sha256:' + sha256)], callback)
+        self.wait_for_callback(callback)
+        self.assertIsNone(callback.call_args[0][0][request].error)
+        self.assertEqual(DownloadCache().stats()["hits"], 1)
+
+    def test_download_from_cache_without_md5(self):
+        """we use the cached archive without md5sum if the server content didn't change"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
         DownloadCenter([request], self.callback)
-        TestDownloadCenter.wait_for_callback(self, self.callback)
+        self.wait_for_callback(self.callback)
+
+        callback = Mock()
+        report = CopyingMock()
+        DownloadCenter([request], callback, report=report)
+        self.wait_for_callback(callback)
+
+        result = callback.call_args[0][0][request]
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(report.call_args_list, [call({request: {'size': filesize, 'current': filesize}})])
+
+    def test_corrupted_cache_entry_downloaded_again(self):
+        """we drop a cached archive not matching its md5sum, downloading it again"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        cache_path = DownloadCache().path
+        os.makedirs(cache_path, exist_ok=True)
+        with open(join(cache_path, 'md5-268a5059001855fef30b4f95f82044ed'), 'wb') as f:
+            f.write(b"garbage")
+        DownloadCenter([(request, '268a5059001855fef30b4f95f82044ed')], self.callback)
+        self.wait_for_callback(self.callback)
 
         result = self.callback.call_args[0][0][request]
-        self.assertIn("CERTIFICATE_VERIFY_FAILED", result.error)
-        self.assertIsNone(result.buffer)
-        self.assertIsNone(result.fd)
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        self.assertEqual(result.fd.read(), content)
+        with open(join(cache_path, 'md5-268a5059001855fef30b4f95f82044ed'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.expect_warn_error = True
+
+    def test_corrupted_cache_entry_not_streamed(self):
+        """we don't feed a sink a cached archive not matching its md5sum, downloading it again"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        cache_path = DownloadCache().path
+        os.makedirs(cache_path, exist_ok=True)
+        with open(join(cache_path, 'md5-268a5059001855fef30b4f95f82044ed'), 'wb') as f:
+            f.write(b"garbage")
+        content = []
+        sink = Mock(spec=["write", "finish", "abort"], write=lambda data: content.append(bytes(data)))
+        DownloadCenter([(request, '268a5059001855fef30b4f95f82044ed')], self.callback, download=False,
+                       stream_to={request: sink})
+        self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][request].error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(b"".join(content), file_on_disk.read())
+        sink.finish.assert_called_once_with()
+        self.assertFalse(os.path.exists(join(cache_path, 'md5-268a5059001855fef30b4f95f82044ed')))
+        self.expect_warn_error = True
+
+    def test_wrong_md5_not_cached(self):
+        """we don't cache an archive not matching its md5sum"""
+        request = self.build_server_address("simplefile")
+        DownloadCenter([(request, 'AAAAA')], self.callback)
+        self.wait_for_callback(self.callback)
+
+        self.assertEqual(DownloadCache().stats()["entries"], 0)
         self.expect_warn_error = True
+
+    def test_in_memory_download_not_modified(self):
+        """we use the cached page if the server tells it wasn't modified since"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        DownloadCenter([request], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        # tweak the cached content to ensure we serve it from there
+        with open(PageCache()._paths_for(request)[0], 'wb') as f:
+            f.write(b"cached content")
+
+        callback = Mock()
+        DownloadCenter([request], callback, download=False)
+        self.wait_for_callback(callback)
+
+        result = callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.buffer.read(), b"cached content")
+
+    def test_in_memory_download_modified(self):
+        """we download again the page if it changed on the server"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        DownloadCenter([request], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        content_path, state_path = PageCache()._paths_for(request)
+        with open(content_path, 'wb') as f:
+            f.write(b"cached content")
+        with open(state_path, 'w') as f:
+            yaml.dump({"url": request, "last_modified": "Mon, 01 Jan 2001 00:00:00 GMT"}, f)
+
+        callback = Mock()
+        DownloadCenter([request], callback, download=False)
+        self.wait_for_callback(callback)
+
+        result = callback.call_args[0][0][request]
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.buffer.read())
+        with open(content_path, 'rb') as f:
+            self.assertEqual(f.read(), b"foo\nbar\nbaz\n")
+
+    def test_in_memory_download_fresh_in_cache(self):
+        """we don't contact the server for a page cached recently enough"""
+        request = self.build_server_address("does_not_exist")
+        PageCache().add(request, {}, b"cached content")
+
+        with patchelem(PageCache, 'DEFAULT_MAX_AGE', 3600):
+            DownloadCenter([request], self.callback, download=False)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.buffer.read(), b"cached content")
+
+    def test_page_streamed_not_modified(self):
+        """we cache a page streamed to a sink, and replay it to the next sink if the server tells it wasn't modified"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        content = []
+        DownloadCenter([request], self.callback, download=False,
+                       stream_to={request: Mock(spec=["write", "finish", "abort"],
+                                                write=lambda data: content.append(bytes(data)))})
+        self.wait_for_callback(self.callback)
+        self.assertIsNone(self.callback.call_args[0][0][request].error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), b"".join(content))
+        content_path = PageCache()._paths_for(request)[0]
+        with open(content_path, 'rb') as f:
+            self.assertEqual(f.read(), b"".join(content))
+        # tweak the cached content to ensure we serve it from there
+        with open(content_path, 'wb') as f:
+            f.write(b"cached content")
+
+        callback = Mock()
+        content = []
+        DownloadCenter([request], callback, download=False,
+                       stream_to={request: Mock(spec=["write", "finish", "abort"],
+                                                write=lambda data: content.append(bytes(data)))})
+        self.wait_for_callback(callback)
+
+        self.assertIsNone(callback.call_args[0][0][request].error)
+        self.assertEqual(b"".join(content), b"cached content")
+
+    def test_download_streamed_to_extractor(self):
+        """we extract a tarball while downloading it"""
+        filename = "android-studio-fake.tgz"
+        request = self.build_server_address(filename)
+        dest = join(self.cache_dir, "dest")
+        extractor = StreamExtractor(dest)
+        DownloadCenter([(request, '490786f827f2578f788e25e423b10cec')], self.callback,
+                       stream_to={request: extractor})
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertIsNone(result.fd)
+        self.assertTrue(os.path.isfile(join(extractor.path, "android-studio", "bin", "studio.sh")))
+        self.assertFalse(os.path.exists(DownloadCenter._partial_paths(request, None)[0]))
+        extractor.close()
+
+    def test_download_streamed_to_extractor_with_wrong_md5(self):
+        """we discard the extracted tree if the streamed tarball doesn't match its md5sum"""
+        filename = "android-studio-fake.tgz"
+        request = self.build_server_address(filename)
+        extractor = StreamExtractor(join(self.cache_dir, "dest"))
+        DownloadCenter([(request, 'AAAAA')], self.callback, stream_to={request: extractor})
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Corrupted download", result.error)
+        self.assertFalse(os.path.exists(extractor.path))
+        self.expect_warn_error = True
+
+    def test_download_streamed_to_extractor_is_cached(self):
+        """we add a streamed tarball to the download cache, extracting it from there next time"""
+        filename = "android-studio-fake.tgz"
+        request = self.build_server_address(filename)
+        extractor = StreamExtractor(join(self.cache_dir, "dest"))
+        DownloadCenter([(request, '490786f827f2578f788e25e423b10cec')], self.callback,
+                       stream_to={request: extractor})
+        self.wait_for_callback(self.callback)
+        self.assertIsNone(self.callback.call_args[0][0][request].error)
+        extractor.close()
+
+        self.callback.reset_mock()
+        extractor = StreamExtractor(join(self.cache_dir, "dest"))
+        with patchelem(DownloadCenter, '_get', Mock(side_effect=BaseException("No network"))):
+            DownloadCenter([(request, '490786f827f2578f788e25e423b10cec')], self.callback,
+                           stream_to={request: extractor})
+            self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][request].error)
+        self.assertTrue(os.path.isfile(join(extractor.path, "android-studio", "bin", "studio.sh")))
+        extractor.close()
+
+    def test_download_streamed_resumed_after_interruption(self):
+        """we resume an interrupted streamed download, feeding a new sink the content downloaded so far first"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        sink = Mock()
+        with patchelem(DownloadCenter, '_get', self.flaky_get(1)), patchelem(DownloadCenter, 'MAX_RETRIES', 0):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback, stream_to={request: sink})
+            self.wait_for_callback(self.callback)
+        self.assertIsNotNone(self.callback.call_args[0][0][request].error)
+        sink.abort.assert_called_once_with()
+
+        self.callback.reset_mock()
+        content = []
+        sink = Mock(write=lambda data: content.append(bytes(data)))
+        get = DownloadCenter._get
+        headers = []
+
+        def recording_get(center, url, request_headers=None):
+            headers.append(request_headers)
+            return get(center, url, request_headers)
+
+        with patchelem(DownloadCenter, '_get', recording_get):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback, stream_to={request: sink})
+            self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][request].error)
+        self.assertEqual(headers[0]["Range"], "bytes={}-".format(DownloadCenter.BLOCK_SIZE))
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), b"".join(content))
+        sink.finish.assert_called_once_with()
+        self.expect_warn_error = True
+
+    def build_local_mirror(self, filename):
+        """copy filename from the server to a local mirror directory, and return that directory"""
+        mirror_dir = join(self.cache_dir, "mirror")
+        os.makedirs(mirror_dir, exist_ok=True)
+        shutil.copy(join(self.server_dir, filename), mirror_dir)
+        return mirror_dir
+
+    def test_download_local_file(self):
+        """we deliver a local file hard linked in the staging directory"""
+        mirror_dir = self.build_local_mirror("biggerfile")
+        request = "file://" + pathname2url(join(mirror_dir, "biggerfile"))
+        DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback, staging_dir=self.cache_dir)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertTrue(os.path.samefile(result.fd.name, join(mirror_dir, "biggerfile")))
+        self.assertEqual(os.path.dirname(result.fd.name), self.cache_dir)
+        with open(join(self.server_dir, "biggerfile"), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        result.fd.close()
+        self.assertTrue(os.path.isfile(join(mirror_dir, "biggerfile")))
+
+    def test_download_local_file_copied(self):
+        """we copy a local file we can't link"""
+        def link(source, dest):
+            raise OSError("Invalid cross-device link")
+
+        request = "file://" + pathname2url(join(self.server_dir, "biggerfile"))
+        with patchelem(os, 'link', link):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertFalse(os.path.samefile(result.fd.name, join(self.server_dir, "biggerfile")))
+        with open(join(self.server_dir, "biggerfile"), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_download_local_file_with_wrong_md5(self):
+        """we verify the checksum of local files"""
+        request = "file://" + pathname2url(join(self.server_dir, "biggerfile"))
+        DownloadCenter([(request, 'AAAAA')], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Corrupted download", result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_download_local_page(self):
+        """we read a local file in memory"""
+        request = "file://" + pathname2url(join(self.server_dir, "simplefile"))
+        DownloadCenter([request], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.buffer.read(), b"foo\nbar\nbaz\n")
+
+    def test_download_local_file_streamed_to_extractor(self):
+        """we extract a local tarball while reading it"""
+        filename = "android-studio-fake.tgz"
+        request = "file://" + pathname2url(join(self.server_dir, filename))
+        extractor = StreamExtractor(join(self.cache_dir, "dest"))
+        DownloadCenter([(request, '490786f827f2578f788e25e423b10cec')], self.callback,
+                       stream_to={request: extractor})
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertTrue(os.path.isfile(join(extractor.path, "android-studio", "bin", "studio.sh")))
+        extractor.close()
+
+    def test_download_rewritten_to_local_directory(self):
+        """we download from the local directory an url prefix is rewritten to, keying the result on the url"""
+        mirror_dir = self.build_local_mirror("biggerfile")
+        request = "http://unreachable.invalid/archives/biggerfile"
+        with patchelem(DownloadCenter, 'url_rewrites', classmethod(lambda cls: {
+                "http://unreachable.invalid/": "/does/not/exist",
+                "http://unreachable.invalid/archives/": mirror_dir})):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, "biggerfile"), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_download_rewritten_to_internal_mirror(self):
+        """we download from the internal mirror an url prefix is rewritten to"""
+        request = "http://unreachable.invalid/simplefile"
+        with patchelem(DownloadCenter, 'url_rewrites', classmethod(lambda cls: {
+                "http://unreachable.invalid/": "{}/".format(self.server.get_address())})):
+            DownloadCenter([request], self.callback, download=False)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.buffer.read(), b"foo\nbar\nbaz\n")
+
+    def test_download_missing_local_file_fails_over(self):
+        """we fail over to the next mirror if the local file is missing"""
+        missing = "file://" + pathname2url(join(self.cache_dir, "biggerfile"))
+        working = self.build_server_address("biggerfile")
+        DownloadCenter([((working, missing), '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][working]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, "biggerfile"), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.expect_warn_error = True
+
+    def test_download_from_mirrors_failover(self):
+        """we fail over to the next mirror if the fastest one fails, keying the result on the first url"""
+        filename = "biggerfile"
+        failing = "http://127.0.0.1:{}/does_not_exist".format(self.server.port)
+        working = self.build_server_address(filename)
+        MirrorSelector().record(failing, 1000000)
+        MirrorSelector().record(working, 1)
+        DownloadCenter([((failing, working), '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][failing]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        # the failure and the download are both accounted in the mirrors history
+        self.assertLess(MirrorSelector().throughput(failing), 1000000)
+        self.assertGreater(MirrorSelector().throughput(working), 1)
+        self.expect_warn_error = True
+
+    def test_download_from_mirrors_resumes_other_mirror_partial(self):
+        """we resume the partial download of another mirror as the md5sum pins the content"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        failing = "http://127.0.0.1:{}/does_not_exist".format(self.server.port)
+        working = self.build_server_address(filename)
+        MirrorSelector().record(failing, 1000000)
+        MirrorSelector().record(working, 1)
+        self.create_partial(failing, filename, 5000, md5sum='42d69d1a6d333a7ebdf64792a555e392')
+        report = CopyingMock()
+        DownloadCenter([((failing, working), '42d69d1a6d333a7ebdf64792a555e392')], self.callback, report=report)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][failing]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(report.call_args_list[0], call({failing: {'size': filesize, 'current': 5000}}))
+        self.expect_warn_error = True
+
+    def test_download_with_bandwidth_limit(self):
+        """we don't download faster than the bandwidth limit"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        BandwidthLimiter().set_rate(18000)
+        try:
+            start = time()
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+            elapsed = time() - start
+        finally:
+            BandwidthLimiter().set_rate(None)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        # 9000 bytes at 18000 B/s
+        self.assertGreater(elapsed, 0.4)
+
+    def flaky_get(self, fail_after_blocks, failures=1):
+        """Return a DownloadCenter._get replacement whose first failures responses break after fail_after_blocks"""
+        original_get = DownloadCenter._get
+        state = {"failures": failures}
+
+        def _get(center, url, headers=None):
+            r = original_get(center, url, headers)
+            if not state["failures"]:
+                return r
+            state["failures"] -= 1
+            read = r.raw.read
+            reads = {"count": 0}
+
+            def broken_read(*args, **kwargs):
+                if reads["count"] == fail_after_blocks:
+                    raise urllib3.exceptions.ProtocolError("Connection broken")
+                reads["count"] += 1
+                return read(*args, **kwargs)
+            r.raw.read = broken_read
+            return r
+        return _get
+
+    def test_download_retried_on_transient_error(self):
+        """we retry a download when the connection breaks, resuming it from the last good byte"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
+        report = CopyingMock()
+        with patchelem(DownloadCenter, '_get', self.flaky_get(1)), patchelem(DownloadCenter, 'BACKOFF_BASE', 0.01),\
+                self.report_all_progress():
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertIn(call({request: {'size': filesize, 'current': DownloadCenter.BLOCK_SIZE, 'retries': 1,
+                                      'wasted': 0}}), report.call_args_list)
+        self.assertEqual(report.call_args, call({request: {'size': filesize, 'current': filesize, 'retries': 1,
+                                                           'wasted': 0}}))
+        self.expect_warn_error = True
+
+    def recording_get(self, get, headers):
+        """Return a DownloadCenter._get replacement calling get and appending the headers of each request to headers"""
+        def _get(center, url, request_headers=None):
+            headers.append(request_headers or {})
+            return get(center, url, request_headers)
+        return _get
+
+    def test_segmented_download_retries_failed_segment_only(self):
+        """we retry the missing range of a segment when its connection breaks, without restarting other segments"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        headers = []
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024), patchelem(DownloadCenter, 'BACKOFF_BASE', 0.01),\
+                patchelem(DownloadCenter, '_get', self.recording_get(self.flaky_get(0), headers)):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(sorted(h.get("Range", "") for h in headers),
+                         ["", "bytes=0-2249", "bytes=2250-4499", "bytes=4500-6749", "bytes=6750-8999"])
+        self.expect_warn_error = True
+
+    def test_segmented_download_stalled_segment_retried(self):
+        """we detect a stalled segment and retry its missing range only"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        headers = []
+        update = ThroughputMonitor.update
+        stalls = {"count": 1}
+
+        def stalling_update(monitor, size):
+            if stalls["count"]:
+                stalls["count"] -= 1
+                raise DownloadStalled("Download stalled")
+            update(monitor, size)
+
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024), patchelem(DownloadCenter, 'BACKOFF_BASE', 0.01),\
+                patchelem(DownloadCenter, 'BLOCK_SIZE', 1000), patchelem(DownloadCenter, 'MAX_BLOCK_SIZE', 1000),\
+                patchelem(DownloadCenter, '_get', self.recording_get(DownloadCenter._get, headers)),\
+                patchelem(ThroughputMonitor, 'update', stalling_update):
+            DownloadCenter([(request, '42d69d1a6d333a7ebdf64792a555e392')], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        # the stalled segment is resumed after its first 1000 bytes
+        ranges = [h.get("Range") for h in headers]
+        self.assertEqual(len(ranges), 5)
+        self.assertEqual(len(set(ranges) & {"bytes=1000-2249", "bytes=3250-4499", "bytes=5500-6749",
+                                            "bytes=7750-8999"}), 1)
+        self.expect_warn_error = True
+
+    def test_in_memory_download_retried_counts_wasted_bytes(self):
+        """we restart in memory downloads from scratch, reporting the bytes downloaded again"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
+        report = CopyingMock()
+        with patchelem(DownloadCenter, '_get', self.flaky_get(1)), patchelem(DownloadCenter, 'BACKOFF_BASE', 0.01):
+            DownloadCenter([request], self.callback, download=False, report=report)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.buffer.read())
+        self.assertEqual(report.call_args, call({request: {'size': filesize, 'current': filesize, 'retries': 1,
+                                                           'wasted': DownloadCenter.BLOCK_SIZE}}))
+        self.assertEqual(result.metrics.retries, 1)
+        self.assertEqual(result.metrics.wasted, DownloadCenter.BLOCK_SIZE)
+        self.assertEqual(result.metrics.bytes, filesize + DownloadCenter.BLOCK_SIZE)
+        self.expect_warn_error = True
+
+    def test_download_retries_exhausted(self):
+        """we report the error once all retries failed"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        with patchelem(DownloadCenter, '_get', self.flaky_get(0, failures=3)), \
+                patchelem(DownloadCenter, 'BACKOFF_BASE', 0.01), patchelem(DownloadCenter, 'MAX_RETRIES', 2):
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Connection broken", result.error)
+        self.expect_warn_error = True
+
+    def test_download_not_retried_on_client_error(self):
+        """we don't retry a download which can't succeed"""
+        request = self.build_server_address("does_not_exist")
+        retried = Mock()
+        with patchelem(DownloadCenter, '_retried', retried):
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+
+        self.assertIn("404", self.callback.call_args[0][0][request].error)
+        self.assertFalse(retried.called)
+        self.expect_warn_error = True
+
+    def test_in_memory_download_spills_to_disk(self):
+        """we move in memory downloads bigger than the memory buffer size to a temporary file"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        with patchelem(DownloadCenter, 'DEFAULT_MEMORY_BUFFER_SIZE', 1024):
+            DownloadCenter([request], self.callback, download=False)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertTrue(result.buffer._rolled)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        self.assertEqual(result.buffer.getvalue(), content)
+        self.assertEqual(list(result.buffer), content.splitlines(keepends=True))
+
+    def test_small_in_memory_download_stays_in_memory(self):
+        """we keep in memory downloads smaller than the memory buffer size in memory"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        DownloadCenter([request], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertFalse(result.buffer._rolled)
+        self.assertEqual(result.buffer.getvalue(), b"foo\nbar\nbaz\n")
+
+    def test_download_staged(self):
+        """we write downloads to the staging directory as hidden files, with their partial download"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        staging_dir = join(self.cache_dir, "staging")
+        os.makedirs(staging_dir)
+        report = Mock(side_effect=[None, BaseException("Connection dropped")])
+        with self.report_all_progress():
+            DownloadCenter([request], self.callback, report=report, staging_dir=staging_dir)
+            self.wait_for_callback(self.callback)
+        partial_path = DownloadCenter._partial_paths(request, None, staging_dir)[0]
+        self.assertEqual(os.path.dirname(partial_path), staging_dir)
+        self.assertEqual(getsize(partial_path), DownloadCenter.BLOCK_SIZE)
+
+        callback = Mock()
+        DownloadCenter([request], callback, staging_dir=staging_dir)
+        self.wait_for_callback(callback)
+
+        result = callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(os.path.dirname(result.fd.name), staging_dir)
+        self.assertTrue(os.path.basename(result.fd.name).startswith("."))
+        self.assertEqual(os.listdir(staging_dir), [os.path.basename(result.fd.name)])
+        self.assertFalse(os.path.exists(os.path.dirname(DownloadCenter._partial_paths(request, None)[0])))
+        self.expect_warn_error = True
+
+    def test_segmented_download_staged(self):
+        """we write segmented downloads to the staging directory"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        staging_dir = join(self.cache_dir, "staging")
+        os.makedirs(staging_dir)
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1):
+            DownloadCenter([request], self.callback, staging_dir=staging_dir)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertEqual(os.path.dirname(result.fd.name), staging_dir)
+
+    def test_download_with_missing_staging_dir(self):
+        """we fall back to the default temporary directory if the staging directory doesn't exist"""
+        request = self.build_server_address("simplefile")
+        staging_dir = join(self.cache_dir, "doesnt_exist")
+        DownloadCenter([request], self.callback, staging_dir=staging_dir)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        self.assertNotEqual(os.path.dirname(result.fd.name), staging_dir)
+        self.assertFalse(os.path.exists(staging_dir))
+
+    def counting_get(self, counter):
+        """Return a DownloadCenter._get replacement counting requests per url in counter"""
+        original_get = DownloadCenter._get
+
+        def _get(center, url, headers=None):
+            counter[url] = counter.get(url, 0) + 1
+            return original_get(center, url, headers)
+        return _get
+
+    def test_identical_downloads_share_transfer(self):
+        """we download once an url requested again while it's downloading, each request getting its own file"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = self.build_server_address(filename)
+        requests_count = {}
+        second_started = threading.Event()
+
+        def first_report(progress):
+            second_started.wait(5)
+
+        second_callback = Mock()
+        second_report = CopyingMock()
+        with patchelem(DownloadCenter, '_get', self.counting_get(requests_count)):
+            DownloadCenter([request], self.callback, report=first_report)
+            DownloadCenter([request], second_callback, report=second_report)
+            second_started.set()
+            self.wait_for_callback(self.callback)
+            self.wait_for_callback(second_callback)
+
+        first_result = self.callback.call_args[0][0][request]
+        second_result = second_callback.call_args[0][0][request]
+        self.assertEqual(requests_count, {request: 1})
+        self.assertNotEqual(first_result.fd.name, second_result.fd.name)
+        first_result.fd.close()
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             second_result.fd.read())
+        self.assertEqual(second_report.call_args, call({request: {'size': filesize, 'current': filesize}}))
+
+    def test_identical_in_memory_downloads_share_transfer(self):
+        """we download once a page requested again while it's downloading, each request getting its own buffer"""
+        request = self.build_server_address("simplefile")
+        requests_count = {}
+        second_started = threading.Event()
+        second_callback = Mock()
+        with patchelem(DownloadCenter, '_get', self.counting_get(requests_count)):
+            DownloadCenter([request], self.callback, download=False, report=lambda progress: second_started.wait(5))
+            DownloadCenter([request], second_callback, download=False)
+            second_started.set()
+            self.wait_for_callback(self.callback)
+            self.wait_for_callback(second_callback)
+
+        first_buffer = self.callback.call_args[0][0][request].buffer
+        second_buffer = second_callback.call_args[0][0][request].buffer
+        self.assertEqual(requests_count, {request: 1})
+        self.assertIsNot(first_buffer, second_buffer)
+        self.assertEqual(first_buffer.read(), b"foo\nbar\nbaz\n")
+        self.assertEqual(second_buffer.read(), b"foo\nbar\nbaz\n")
+
+    def test_download_metrics(self):
+        """we attach the download metrics to its result"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        DownloadCenter([request], self.callback)
+        self.wait_for_callback(self.callback)
+
+        metrics = self.callback.call_args[0][0][request].metrics
+        self.assertEqual(metrics.url, request)
+        self.assertEqual(metrics.bytes, getsize(join(self.server_dir, filename)))
+        self.assertFalse(metrics.shared)
+        self.assertLessEqual(metrics.connect_time, metrics.ttfb)
+        self.assertLessEqual(metrics.ttfb, metrics.wall_time)
+        self.assertGreater(metrics.mean_throughput, 0)
+        self.assertEqual(metrics.retries, 0)
+
+    def test_download_metrics_appended_to_file(self):
+        """we append the metrics of all downloads, even failed ones, to the metrics file"""
+        self.expect_warn_error = True
+        requests = [self.build_server_address("simplefile"), self.build_server_address("does_not_exist")]
+        metrics_path = join(self.cache_dir, "downloads.jsonl")
+        with patchelem(telemetry, 'metrics_file', lambda: metrics_path):
+            DownloadCenter(requests, self.callback)
+            self.wait_for_callback(self.callback)
+        with open(metrics_path) as f:
+            records = {record["url"]: record for record in (json.loads(line) for line in f)}
+
+        self.assertEqual(set(records), set(requests))
+        self.assertIsNone(records[requests[0]]["error"])
+        self.assertEqual(records[requests[0]]["bytes"], 12)
+        self.assertIsNotNone(records[requests[1]]["error"])
+
+    def test_connections_reused_between_downloads(self):
+        """we reuse the same connection for sequential downloads to the same server"""
+        reused = SessionManager().stats()["reused"]
+        for filename in ("simplefile", "biggerfile"):
+            callback = Mock()
+            request = self.build_server_address(filename)
+            DownloadCenter([request], callback)
+            self.wait_for_callback(callback)
+            self.assertIsNone(callback.call_args[0][0][request].error)
+
+        self.assertGreater(SessionManager().stats()["reused"], reused)
+
+    def test_download_priority(self):
+        """we schedule in memory downloads as metadata and downloads to file as archives, unless told otherwise"""
+        submit = DownloadScheduler.submit
+        priorities = {}
+
+        def recording_submit(scheduler, fn, *args, url=None, priority=DownloadScheduler.DEFAULT_PRIORITY, ready=None):
+            priorities[url] = priority
+            return submit(scheduler, fn, *args, url=url, priority=priority, ready=ready)
+
+        page = self.build_server_address("simplefile?page")
+        archive = self.build_server_address("simplefile?archive")
+        prefetch = self.build_server_address("simplefile?prefetch")
+        callbacks = [Mock(), Mock(), Mock()]
+        with patchelem(DownloadScheduler, 'submit', recording_submit):
+            DownloadCenter([page], callbacks[0], download=False)
+            DownloadCenter([archive], callbacks[1])
+            DownloadCenter([prefetch], callbacks[2], priority=DownloadScheduler.PRIORITY_PREFETCH)
+            for callback in callbacks:
+                self.wait_for_callback(callback)
+
+        self.assertEqual(priorities, {page: DownloadScheduler.PRIORITY_METADATA,
+                                      archive: DownloadScheduler.PRIORITY_ARCHIVE,
+                                      prefetch: DownloadScheduler.PRIORITY_PREFETCH})
+
+    def start_controlled_download(self, filename, on_first_report):
+        """Start downloading filename, calling on_first_report(center) from the download thread once it started
+
+        Return the DownloadCenter"""
+        ready = threading.Event()
+        state = {"reported": False}
+
+        def report(progress):
+            if not state["reported"]:
+                state["reported"] = True
+                ready.wait(5)
+                on_first_report(center)
+
+        with self.report_all_progress():
+            center = DownloadCenter([self.build_server_address(filename)], self.callback, report=report)
+        ready.set()
+        return center
+
+    def test_download_cancelled(self):
+        """we stop a cancelled download in flight, reporting it as cancelled"""
+        request = self.build_server_address("biggerfile")
+        self.start_controlled_download("biggerfile", lambda center: center.cancel())
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertEqual(result.error, "Download cancelled")
+        self.assertIsNone(result.fd)
+
+    def test_queued_download_cancelled(self):
+        """we don't start queued downloads once cancelled"""
+        request = self.build_server_address("simplefile")
+        queued = []
+
+        def queue(scheduler, fn, *args, url=None, priority=None, ready=None):
+            queued.append((fn, args))
+            return futures.Future()
+
+        get = Mock()
+        with patchelem(DownloadScheduler, 'submit', queue), patchelem(DownloadCenter, '_get', get):
+            center = DownloadCenter([request], self.callback)
+            center.cancel()
+            (fn, args) = queued[0]
+            with self.assertRaises(DownloadCancelled):
+                fn(*args)
+
+        get.assert_not_called()
+
+    def test_queued_streamed_download_cancelled(self):
+        """we abort the sink of a queued download once cancelled"""
+        request = self.build_server_address("simplefile")
+        sink = Mock(spec=["write", "finish", "abort"])
+        queued = []
+
+        def queue(scheduler, fn, *args, url=None, priority=None, ready=None):
+            queued.append((fn, args))
+            return futures.Future()
+
+        with patchelem(DownloadScheduler, 'submit', queue):
+            center = DownloadCenter([request], self.callback, stream_to={request: sink})
+            center.cancel()
+            (fn, args) = queued[0]
+            with self.assertRaises(DownloadCancelled):
+                fn(*args)
+
+        sink.abort.assert_called_once_with()
+        sink.write.assert_not_called()
+        sink.finish.assert_not_called()
+
+    def test_queued_download_paused(self):
+        """we don't let the scheduler start queued downloads while paused"""
+        request = self.build_server_address("simplefile")
+        queued = []
+
+        def queue(scheduler, fn, *args, url=None, priority=None, ready=None):
+            queued.append(ready)
+            return futures.Future()
+
+        with patchelem(DownloadScheduler, 'submit', queue):
+            center = DownloadCenter([request], self.callback)
+            center.pause()
+            self.assertFalse(queued[0]())
+            center.resume()
+            self.assertTrue(queued[0]())
+
+    def test_shared_download_cancelled_by_one_request(self):
+        """we keep downloading a shared transfer for other requests when one of them is cancelled"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        second_started = threading.Event()
+        second_callback = Mock()
+        first = DownloadCenter([request], self.callback, report=lambda progress: second_started.wait(5))
+        DownloadCenter([request], second_callback)
+        first.cancel()
+        self.wait_for_callback(self.callback)
+        second_started.set()
+        self.wait_for_callback(second_callback)
+
+        self.assertEqual(self.callback.call_args[0][0][request].error, "Download cancelled")
+        result = second_callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_shared_download_cancelled_by_all_requests(self):
+        """we stop a shared transfer once all its requests are cancelled"""
+        request = self.build_server_address("biggerfile")
+        started = threading.Event()
+        second_callback = Mock()
+        first = DownloadCenter([request], self.callback, report=lambda progress: started.wait(5))
+        second = DownloadCenter([request], second_callback)
+        second.cancel()
+        first.cancel()
+        started.set()
+        self.wait_for_callback(self.callback)
+        self.wait_for_callback(second_callback)
+
+        # the first request got the error of the transfer itself
+        self.assertEqual(self.callback.call_args[0][0][request].error, "Download cancelled")
+        self.assertEqual(second_callback.call_args[0][0][request].error, "Download cancelled")
+
+    def test_shared_download_paused_by_one_request(self):
+        """we keep downloading a shared transfer for other requests when one of them is paused"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        paused = threading.Event()
+        second_callback = Mock()
+        first = DownloadCenter([request], self.callback, report=lambda progress: paused.wait(5))
+        DownloadCenter([request], second_callback)
+        first.pause()
+        paused.set()
+        self.wait_for_callback(second_callback)
+        first.resume()
+        self.wait_for_callback(self.callback)
+
+        result = second_callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertIsNone(self.callback.call_args[0][0][request].error)
+
+    def test_download_paused_and_resumed(self):
+        """we suspend a paused download until it's resumed, then complete it"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        paused = threading.Event()
+
+        def pause(center):
+            center.pause()
+            paused.set()
+
+        center = self.start_controlled_download(filename, pause)
+        paused.wait(5)
+        threading.Event().wait(0.2)
+        self.assertFalse(self.callback.called)
+        center.resume()
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_paused_download_cancelled(self):
+        """we stop a paused download once cancelled"""
+        request = self.build_server_address("biggerfile")
+        paused = threading.Event()
+
+        def pause(center):
+            center.pause()
+            paused.set()
+
+        center = self.start_controlled_download("biggerfile", pause)
+        paused.wait(5)
+        center.cancel()
+        self.wait_for_callback(self.callback)
+
+        self.assertEqual(self.callback.call_args[0][0][request].error, "Download cancelled")
+
+    def test_cancel_during_backoff(self):
+        """we don't wait for the retry backoff of a cancelled download"""
+        request = self.build_server_address("biggerfile")
+        with patchelem(DownloadCenter, '_get', self.flaky_get(1)), patchelem(DownloadCenter, 'BACKOFF_BASE', 100), \
+                patchelem(random, 'uniform', lambda a, b: b):
+            center = DownloadCenter([request], self.callback)
+            for i in range(500):
+                if center._retry_stats:
+                    break
+                threading.Event().wait(0.01)
+            start = time()
+            center.cancel()
+            self.wait_for_callback(self.callback)
+
+        self.assertLess(time() - start, 5)
+        self.assertEqual(self.callback.call_args[0][0][request].error, "Download cancelled")
+        self.expect_warn_error = True
+
+
+class TestDownloadCenterSecure(LoggedTestCase):
+    """This will test the download center in secure mode by sending one or more download requests"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir, use_ssl="localhost.pem")
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.fd_to_close = []
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        # don't share transfers left in flight by previous tests
+        with suppress(KeyError):
+            Singleton._instances.pop(InFlightDownloads)
+
+    def tearDown(self):
+        super().tearDown()
+        with suppress(KeyError):
+            Singleton._instances.pop(InFlightDownloads)
+        for fd in self.fd_to_close:
+            fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+
+    def test_download(self):
+        """we deliver one successful download under ssl with known cert"""
+        filename = "simplefile"
+        # The host name is important here, since we verify it, so request
+        # the localhost address.
+        request = TestDownloadCenter.build_server_address(self, filename, True)
+        # prepare the cert and set it as the trusted system context
+        os.environ['REQUESTS_CA_BUNDLE'] = join(get_data_dir(), 'localhost.pem')
+        try:
+            DownloadCenter([request], self.callback)
+            TestDownloadCenter.wait_for_callback(self, self.callback)
+
+            result = self.callback.call_args[0][0][request]
+            self.assertTrue(self.callback.called)
+            self.assertEqual(self.callback.call_count, 1)
+            with open(os.path.join(self.server_dir, filename), 'rb') as file_on_disk:
+                self.assertEqual(file_on_disk.read(),
+                                 result.fd.read())
+        finally:
+            del os.environ['REQUESTS_CA_BUNDLE']
+
+    def test_redirect_download(self):
+        """we deliver one successful download after being redirected"""
+        filename = "simplefile"
+        # We add a suffix to make the server redirect us.
+        request = TestDownloadCenter.build_server_address(self,
+                                                          filename + "-redirect",
+                                                          localhost=True)
+        os.environ['REQUESTS_CA_BUNDLE'] = join(get_data_dir(), 'localhost.pem')
+        try:
+            DownloadCenter([request], self.callback)
+            TestDownloadCenter.wait_for_callback(self, self.callback)
+
+            result = self.callback.call_args[0][0][request]
+            self.assertTrue(self.callback.called)
+            self.assertEqual(self.callback.call_count, 1)
+            with open(os.path.join(self.server_dir, filename), 'rb') as file_on_disk:
+                self.assertEqual(file_on_disk.read(),
+                                 result.fd.read())
+            self.assertIsNone(result.buffer)
+            self.assertIsNone(result.error)
+        finally:
+            del os.environ['REQUESTS_CA_BUNDLE']
+
+    def test_with_invalid_certificate(self):
+        """we error on invalid ssl certificate"""
+        filename = "simplefile"
+        request = TestDownloadCenter.build_server_address(self, filename)
+        DownloadCenter([request], self.callback)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("CERTIFICATE_VERIFY_FAILED", result.error)
+        self.assertIsNone(result.buffer)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+
+class TestDownloadCenterAsyncio(LoggedTestCase):
+    """This will test the download center with the asyncio engine by sending one or more download requests"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = LocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.fd_to_close = []
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        os.environ[UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE] = "asyncio"
+        # don't share transfers left in flight by previous tests
+        with suppress(KeyError):
+            Singleton._instances.pop(InFlightDownloads)
+
+    def tearDown(self):
+        del os.environ[UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE]
+        super().tearDown()
+        with suppress(KeyError):
+            Singleton._instances.pop(InFlightDownloads)
+        for fd in self.fd_to_close:
+            fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+
+    def test_engine_selection(self):
+        """we select the engine from the environment, defaulting to threads"""
+        self.assertEqual(DownloadCenter.engine(), "asyncio")
+        os.environ[UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE] = ""
+        self.assertEqual(DownloadCenter.engine(), "threads")
+
+    def test_unknown_engine(self):
+        """we fallback to the threaded engine on unknown ones"""
+        os.environ[UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE] = "foo"
+        self.assertEqual(DownloadCenter.engine(), "threads")
+        self.expect_warn_error = True
+
+    def test_download(self):
+        """we deliver one successful download with a matching md5sum, without using the threaded scheduler"""
+        filename = "simplefile"
+        request = TestDownloadCenter.build_server_address(self, filename)
+        with patchelem(DownloadScheduler, 'submit', Mock()):
+            DownloadCenter([(request, '268a5059001855fef30b4f95f82044ed')], self.callback)
+            TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(os.path.join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertIsNone(result.buffer)
+
+    def test_download_cancelled(self):
+        """we stop a cancelled download in flight on the event loop"""
+        request = TestDownloadCenter.build_server_address(self, "biggerfile")
+        ready = threading.Event()
+
+        def report(progress):
+            ready.wait(5)
+            center.cancel()
+
+        with patchelem(DownloadScheduler, 'submit', Mock()):
+            center = DownloadCenter([request], self.callback, report=report)
+            ready.set()
+            TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertEqual(result.error, "Download cancelled")
+        self.assertIsNone(result.fd)
+
+    def test_redirect_download(self):
+        """we follow redirections"""
+        filename = "simplefile"
+        request = TestDownloadCenter.build_server_address(self, filename + "-redirect")
+        DownloadCenter([request], self.callback)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(os.path.join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_in_memory_download(self):
+        """we deliver download on memory objects"""
+        filename = "simplefile"
+        request = TestDownloadCenter.build_server_address(self, filename)
+        DownloadCenter([request], self.callback, download=False)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertEqual(result.buffer.read(), b"foo\nbar\nbaz\n")
+        self.assertIsNone(result.fd)
+
+    def test_download_with_progress(self):
+        """we deliver progress hooks up to the full size"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        request = TestDownloadCenter.build_server_address(self, filename)
+        report = CopyingMock()
+        DownloadCenter([request], self.callback, report=report)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        self.assertEqual(report.call_args_list[0], call({request: {'size': filesize, 'current': 0}}))
+        self.assertEqual(report.call_args, call({request: {'size': filesize, 'current': filesize}}))
+
+    def test_download_with_wrong_md5(self):
+        """we raise an error if we don't have the correct md5sum"""
+        request = TestDownloadCenter.build_server_address(self, "simplefile")
+        DownloadCenter([(request, 'AAAAA')], self.callback)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Corrupted download", result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_404_url(self):
+        """we return an error for a request including a 404 url"""
+        request = TestDownloadCenter.build_server_address(self, "does_not_exist")
+        DownloadCenter([request], self.callback)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("404", result.error)
+        self.expect_warn_error = True
+
+    def test_many_concurrent_downloads(self):
+        """we deliver many concurrent downloads on the single event loop"""
+        requests = ["{}?{}".format(TestDownloadCenter.build_server_address(self, "simplefile"), i) for i in range(50)]
+        DownloadCenter(requests, self.callback, download=False)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        results = self.callback.call_args[0][0]
+        self.assertEqual(len(results), 50)
+        for request in requests:
+            self.assertIsNone(results[request].error)
+            self.assertEqual(results[request].buffer.read(), b"foo\nbar\nbaz\n")
+
+    def test_download_tries_next_address(self):
+        """we connect to the next address of a host if the first one doesn't answer"""
+        request = TestDownloadCenter.build_server_address(self, "simplefile")
+
+        async def resolve(engine, host, port):
+            # TEST-NET-1 address, never answering
+            return ["192.0.2.1", "127.0.0.1"]
+
+        with patchelem(AsyncDownloadEngine, '_resolve', resolve), \
+                patchelem(AsyncDownloadEngine, 'CONNECT_TIMEOUT', 0.5), patchelem(DownloadScheduler, 'submit', Mock()):
+            DownloadCenter([(request, '268a5059001855fef30b4f95f82044ed')], self.callback)
+            TestDownloadCenter.wait_for_callback(self, self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][request].error)
+
+    def test_download_through_proxy_uses_threads(self):
+        """we download with the threaded engine when a proxy is set, the asyncio one doesn't support them"""
+        request = TestDownloadCenter.build_server_address(self, "simplefile")
+        scheduler_submit = Mock(return_value=futures.Future())
+        engine_submit = Mock()
+        with patch.dict(os.environ, {"http_proxy": "http://proxy.invalid:3128", "no_proxy": ""}), \
+                patchelem(DownloadScheduler, 'submit', scheduler_submit), \
+                patchelem(AsyncDownloadEngine, 'submit', engine_submit):
+            DownloadCenter([request], self.callback)
+
+        self.assertTrue(scheduler_submit.called)
+        engine_submit.assert_not_called()
+
+    def test_read_timeout(self):
+        """we fail a read which doesn't get any data in time"""
+        with self.assertRaisesRegex(BaseException, "Too slow"):
+            asyncio.run(with_timeout(asyncio.sleep(5), 0.01, "Too slow"))
+
+
+class TestChunkSizer(LoggedTestCase):
+    """This will test the adaptation of download read sizes"""
+
+    def elapse(self, sizer, seconds):
+        """Simulate seconds spent on the last chunk and update the sizer"""
+        sizer._last -= seconds
+        sizer.update()
+
+    def test_start_at_min_size(self):
+        """we start reading with the minimum size"""
+        self.assertEqual(ChunkSizer(8, 64).size, 8)
+
+    def test_grow_on_fast_chunks(self):
+        """we double the size while chunks are processed quickly, up to the maximum size"""
+        sizer = ChunkSizer(8, 64)
+        sizes = []
+        for i in range(5):
+            sizer.update()
+            sizes.append(sizer.size)
+        self.assertEqual(sizes, [16, 32, 64, 64, 64])
+
+    def test_shrink_on_slow_chunks(self):
+        """we halve the size when chunks take too long, down to the minimum size"""
+        sizer = ChunkSizer(8, 64)
+        sizer.size = 32
+        sizes = []
+        for i in range(4):
+            self.elapse(sizer, ChunkSizer.TARGET_TIME * 3)
+            sizes.append(sizer.size)
+        self.assertEqual(sizes, [16, 8, 8, 8])
+
+    def test_keep_size_around_target_time(self):
+        """we keep the size when chunks take about the target time"""
+        sizer = ChunkSizer(8, 64)
+        sizer.size = 32
+        self.elapse(sizer, ChunkSizer.TARGET_TIME * 1.5)
+        self.assertEqual(sizer.size, 32)
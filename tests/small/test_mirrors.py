@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the mirrors selection and throughput monitoring"""
+
+from concurrent import futures
+from os.path import join
+import shutil
+import tempfile
+from time import sleep
+from ..tools import change_xdg_path, get_data_dir, LoggedTestCase, patchelem
+from ..tools.local_server import LocalHttp
+from udtc.network.mirrors import DownloadStalled, MirrorSelector, MirrorTooSlow, ThroughputMonitor
+from udtc.network.scheduler import DownloadScheduler
+
+
+class TestMirrorSelector(LoggedTestCase):
+    """This will test the mirrors ordering, with the history in a temporary cache directory"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = LocalHttp(join(get_data_dir(), "server-content"))
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+
+    def tearDown(self):
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def test_order_by_history(self):
+        """We order mirrors by their throughput history once we know all of them"""
+        selector = MirrorSelector()
+        selector.record("http://slow/foo", 10)
+        selector.record("http://fast/foo", 1000)
+        self.assertEqual(selector.order(["http://slow/bar", "http://fast/bar"]), ["http://fast/bar", "http://slow/bar"])
+
+    def test_history_moving_average(self):
+        """We keep a moving average of the throughput of each mirror"""
+        selector = MirrorSelector()
+        selector.record("http://foo/bar", 100)
+        selector.record("http://foo/baz", 200)
+        self.assertEqual(selector.throughput("http://foo/"), 0.7 * 100 + 0.3 * 200)
+        self.assertIsNone(selector.throughput("http://unknown/"))
+
+    def test_race_unknown_mirrors(self):
+        """We race mirrors we don't know, putting those which fail last"""
+        failing = "http://127.0.0.1:{}/does_not_exist".format(self.server.port)
+        working = "{}/biggerfile".format(self.server.get_address())
+        self.assertEqual(MirrorSelector().order([failing, working]), [working, failing])
+
+    def test_race_probes_scheduled(self):
+        """We probe mirrors with metadata jobs of the scheduler, putting those not probed in time last"""
+        submit = DownloadScheduler.submit
+        submitted = []
+        stuck = "http://stuck/foo"
+        working = "{}/biggerfile".format(self.server.get_address())
+
+        def never_start_stuck(scheduler, fn, *args, url=None, priority=DownloadScheduler.DEFAULT_PRIORITY,
+                              ready=None):
+            submitted.append((url, priority))
+            if url == stuck:
+                return futures.Future()
+            return submit(scheduler, fn, *args, url=url, priority=priority, ready=ready)
+
+        with patchelem(DownloadScheduler, 'submit', never_start_stuck), patchelem(MirrorSelector, 'PROBE_TIMEOUT', 1):
+            self.assertEqual(MirrorSelector().race([stuck, working]), [working, stuck])
+        self.assertEqual(submitted, [(stuck, DownloadScheduler.PRIORITY_METADATA),
+                                     (working, DownloadScheduler.PRIORITY_METADATA)])
+
+    def test_single_mirror_not_raced(self):
+        """We don't probe a single url"""
+        with patchelem(MirrorSelector, 'race', None):
+            self.assertEqual(MirrorSelector().order(["http://foo/bar"]), ["http://foo/bar"])
+
+
+class TestThroughputMonitor(LoggedTestCase):
+    """This will test throughput collapse detection with windows as short as possible"""
+
+    def test_collapse_raises_on_failover(self):
+        """We raise MirrorTooSlow when the throughput collapses and we can fail over"""
+        with patchelem(ThroughputMonitor, 'WINDOW', 0):
+            monitor = ThroughputMonitor("http://foo/bar", failover=True)
+            monitor.update(1024*1024*1024)
+            sleep(0.01)
+            self.assertRaises(MirrorTooSlow, monitor.update, 1)
+
+    def test_collapse_ignored_without_failover(self):
+        """We keep downloading from the last mirror, even if slow"""
+        with patchelem(ThroughputMonitor, 'WINDOW', 0):
+            monitor = ThroughputMonitor("http://foo/bar")
+            monitor.update(1024*1024*1024)
+            sleep(0.01)
+            monitor.update(1)
+        self.assertEqual(monitor.size, 1024*1024*1024 + 1)
+
+    def test_stall_raises(self):
+        """We raise DownloadStalled when the throughput falls under the minimum one"""
+        with patchelem(ThroughputMonitor, 'WINDOW', 0.01):
+            monitor = ThroughputMonitor("http://foo/bar", min_throughput=1024*1024)
+            sleep(0.02)
+            self.assertRaises(DownloadStalled, monitor.update, 1)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the overall progress of several downloads"""
+
+from copy import deepcopy
+from ..tools import LoggedTestCase
+from udtc.network.progress import ProgressAggregator, ProgressSnapshot, ProgressTotals
+
+
+class TestProgressAggregator(LoggedTestCase):
+    """This will test the running totals of downloads progress"""
+
+    def test_no_download(self):
+        """We have empty totals and no percentage without any download"""
+        totals = ProgressAggregator().totals()
+        self.assertEqual(totals, ProgressTotals(current=0, known_current=0, size=0, unknown=0))
+        self.assertIsNone(totals.percentage)
+
+    def test_sum_downloads(self):
+        """We sum the progress of all downloads"""
+        aggregator = ProgressAggregator()
+        aggregator.update("http://foo", 10, 100)
+        aggregator.update("http://bar", 20, 300)
+        self.assertEqual(aggregator.totals(), ProgressTotals(current=30, known_current=30, size=400, unknown=0))
+
+    def test_update_download(self):
+        """We replace the previous progress of a download, even when it restarts from a lower offset"""
+        aggregator = ProgressAggregator()
+        aggregator.update("http://foo", 10, 100)
+        aggregator.update("http://bar", 20, 300)
+        aggregator.update("http://foo", 50, 100)
+        self.assertEqual(aggregator.totals(), ProgressTotals(current=70, known_current=70, size=400, unknown=0))
+        aggregator.update("http://foo", 0, 100)
+        self.assertEqual(aggregator.totals(), ProgressTotals(current=20, known_current=20, size=400, unknown=0))
+
+    def test_percentage_weighted_by_size(self):
+        """We compute the percentage over all bytes, not as the average of each download one"""
+        aggregator = ProgressAggregator()
+        aggregator.update("http://foo", 100, 100)
+        aggregator.update("http://bar", 0, 300)
+        self.assertEqual(aggregator.totals().percentage, 25)
+
+    def test_unknown_size(self):
+        """We count downloads of unknown size apart, the percentage being over the known size ones"""
+        aggregator = ProgressAggregator()
+        aggregator.update("http://foo", 50, 100)
+        aggregator.update("http://bar", 1000, -1)
+        totals = aggregator.totals()
+        self.assertEqual(totals, ProgressTotals(current=1050, known_current=50, size=100, unknown=1))
+        self.assertEqual(totals.percentage, 50)
+
+    def test_only_unknown_sizes(self):
+        """We have no percentage if no download size is known"""
+        aggregator = ProgressAggregator()
+        aggregator.update("http://foo", 1000, -1)
+        self.assertIsNone(aggregator.totals().percentage)
+
+    def test_size_becomes_known(self):
+        """We move a download from the unknown size ones once its size is known"""
+        aggregator = ProgressAggregator()
+        aggregator.update("http://foo", 0, -1)
+        aggregator.update("http://foo", 10, 100)
+        self.assertEqual(aggregator.totals(), ProgressTotals(current=10, known_current=10, size=100, unknown=0))
+
+    def test_snapshot(self):
+        """We deliver the progress of each download with their totals, which survive a copy"""
+        aggregator = ProgressAggregator()
+        aggregator.update("http://foo", 10, 100)
+        snapshot = ProgressSnapshot({"http://foo": {"current": 10, "size": 100}}, aggregator.totals())
+        self.assertEqual(snapshot, {"http://foo": {"current": 10, "size": 100}})
+        self.assertEqual(deepcopy(snapshot).totals, aggregator.totals())
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the download scheduler"""
+
+from concurrent import futures
+from contextlib import suppress
+import threading
+from ..tools import LoggedTestCase, patchelem
+from udtc.network.scheduler import DownloadScheduler
+from udtc.tools import Singleton
+
+
+class TestDownloadScheduler(LoggedTestCase):
+    """This will test the scheduler limits and ordering using jobs blocked on events"""
+
+    def setUp(self):
+        super().setUp()
+        # get a fresh scheduler for each test
+        with suppress(KeyError):
+            Singleton._instances.pop(DownloadScheduler)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.order = []
+
+    def tearDown(self):
+        with suppress(KeyError):
+            Singleton._instances.pop(DownloadScheduler)
+        super().tearDown()
+
+    def job(self, name, event):
+        """Record concurrency and order, then wait for event to finish"""
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.running, self.max_running)
+            self.order.append(name)
+        event.wait(5)
+        with self.lock:
+            self.running -= 1
+        return name
+
+    def wait_for_running(self, number):
+        """Wait for number jobs to be running at once"""
+        for i in range(500):
+            with self.lock:
+                if self.running == number:
+                    return
+            threading.Event().wait(0.01)
+        raise BaseException("{} jobs weren't running within 5 seconds".format(number))
+
+    def test_run_jobs(self):
+        """We return the job result in the future"""
+        future = DownloadScheduler().submit(lambda x: x * 2, 21)
+        self.assertEqual(future.result(timeout=5), 42)
+
+    def test_job_exception(self):
+        """We return job exceptions in the future"""
+        def fail():
+            raise BaseException("Failed")
+        future = DownloadScheduler().submit(fail)
+        self.assertEqual(str(future.exception(timeout=5)), "Failed")
+
+    def test_global_limit(self):
+        """We don't run more jobs than workers at once"""
+        event = threading.Event()
+        with patchelem(DownloadScheduler, 'DEFAULT_MAX_WORKERS', 2):
+            scheduler = DownloadScheduler()
+        jobs = [scheduler.submit(self.job, i, event, url="http://host{}/foo".format(i)) for i in range(5)]
+        self.wait_for_running(2)
+        event.set()
+        futures.wait(jobs, timeout=5)
+
+        self.assertEqual([job.result() for job in jobs], list(range(5)))
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(len(scheduler._workers), 2)
+
+    def test_per_host_limit(self):
+        """We don't run more jobs than the host limit at once for the same host"""
+        event = threading.Event()
+        with patchelem(DownloadScheduler, 'DEFAULT_MAX_WORKERS', 4), \
+                patchelem(DownloadScheduler, 'DEFAULT_MAX_PER_HOST', 1):
+            scheduler = DownloadScheduler()
+        jobs = [scheduler.submit(self.job, i, event, url="http://samehost/foo{}".format(i)) for i in range(3)]
+        other_host_job = scheduler.submit(self.job, "other", event, url="http://otherhost/foo")
+        # the other host job isn't blocked by the first ones
+        self.wait_for_running(2)
+        event.set()
+        futures.wait(jobs + [other_host_job], timeout=5)
+
+        self.assertIn("other", self.order[:2])
+        self.assertEqual(self.max_running, 2)
+
+    def test_priority_order(self):
+        """We run queued jobs by priority, then in submission order"""
+        block = threading.Event()
+        event = threading.Event()
+        event.set()
+        with patchelem(DownloadScheduler, 'DEFAULT_MAX_WORKERS', 1):
+            scheduler = DownloadScheduler()
+        first_job = scheduler.submit(self.job, "blocking", block)
+        jobs = [scheduler.submit(self.job, "low1", event, priority=DownloadScheduler.PRIORITY_PREFETCH),
+                scheduler.submit(self.job, "high", event, priority=DownloadScheduler.PRIORITY_ARCHIVE),
+                scheduler.submit(self.job, "low2", event, priority=DownloadScheduler.PRIORITY_PREFETCH)]
+        block.set()
+        futures.wait([first_job] + jobs, timeout=5)
+
+        self.assertEqual(self.order, ["blocking", "high", "low1", "low2"])
+
+    def test_metadata_jobs_on_reserved_worker(self):
+        """We run metadata jobs right away on a reserved worker while bulk jobs take all the others"""
+        block = threading.Event()
+        event = threading.Event()
+        event.set()
+        with patchelem(DownloadScheduler, 'DEFAULT_MAX_WORKERS', 2):
+            scheduler = DownloadScheduler()
+        bulk_jobs = [scheduler.submit(self.job, "archive{}".format(i), block, url="http://host{}/foo".format(i))
+                     for i in range(3)]
+        self.wait_for_running(2)
+        metadata_job = scheduler.submit(self.job, "page", event, priority=DownloadScheduler.PRIORITY_METADATA)
+
+        self.assertEqual(metadata_job.result(timeout=5), "page")
+        self.assertEqual(self.order, ["archive0", "archive1", "page"])
+        block.set()
+        futures.wait(bulk_jobs, timeout=5)
+        self.assertEqual(len(scheduler._workers), 3)
+
+    def test_bulk_jobs_limited_to_max_workers(self):
+        """We don't run more bulk jobs than max_workers at once, even with an idle reserved worker"""
+        event = threading.Event()
+        with patchelem(DownloadScheduler, 'DEFAULT_MAX_WORKERS', 1):
+            scheduler = DownloadScheduler()
+        # start the reserved worker
+        done = threading.Event()
+        pages = [scheduler.submit(self.job, "page", done, priority=DownloadScheduler.PRIORITY_METADATA)
+                 for i in range(2)]
+        self.wait_for_running(2)
+        done.set()
+        futures.wait(pages, timeout=5)
+        self.max_running = 0
+        jobs = [scheduler.submit(self.job, name, event, priority=priority)
+                for (name, priority) in (("archive", DownloadScheduler.PRIORITY_ARCHIVE),
+                                         ("prefetch", DownloadScheduler.PRIORITY_PREFETCH))]
+        self.wait_for_running(1)
+        threading.Event().wait(0.1)
+        self.assertEqual(self.max_running, 1)
+        event.set()
+        futures.wait(jobs, timeout=5)
+
+        self.assertEqual(self.order, ["page", "page", "archive", "prefetch"])
+        self.assertEqual(self.max_running, 1)
+        self.assertEqual(len(scheduler._workers), 2)
+
+    def test_jobs_not_ready_stay_queued(self):
+        """We don't run a job until it's ready, leaving the workers to the next ones"""
+        ready = threading.Event()
+        event = threading.Event()
+        event.set()
+        with patchelem(DownloadScheduler, 'DEFAULT_MAX_WORKERS', 1):
+            scheduler = DownloadScheduler()
+        waiting_job = scheduler.submit(self.job, "paused", event, ready=ready.is_set)
+        job = scheduler.submit(self.job, "next", event)
+
+        self.assertEqual(job.result(timeout=5), "next")
+        self.assertFalse(waiting_job.done())
+        ready.set()
+        scheduler.wake()
+        self.assertEqual(waiting_job.result(timeout=5), "paused")
+        self.assertEqual(self.order, ["next", "paused"])
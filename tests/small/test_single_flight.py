@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the in flight downloads registry"""
+
+from concurrent import futures
+from contextlib import suppress
+from unittest.mock import ANY, Mock, call
+from ..tools import LoggedTestCase
+from udtc.network.single_flight import InFlightDownloads
+from udtc.tools import Singleton
+
+
+class TestInFlightDownloads(LoggedTestCase):
+    """This will test sharing transfers with manually completed futures"""
+
+    def setUp(self):
+        super().setUp()
+        # get a fresh registry for each test
+        with suppress(KeyError):
+            Singleton._instances.pop(InFlightDownloads)
+        self.transfer = futures.Future()
+        self.start = Mock(return_value=self.transfer)
+
+    def tearDown(self):
+        with suppress(KeyError):
+            Singleton._instances.pop(InFlightDownloads)
+        super().tearDown()
+
+    def test_share_transfer(self):
+        """We start a single transfer for identical requests, sharing its result"""
+        share = Mock(return_value="shared handle")
+        first = InFlightDownloads().submit(("http://foo", None, True), self.start, share, Mock())
+        second = InFlightDownloads().submit(("http://foo", None, True), self.start, share, Mock())
+        self.transfer.set_result("handle")
+
+        self.assertEqual(self.start.call_count, 1)
+        self.assertEqual(first.result(), "handle")
+        self.assertEqual(second.result(), "shared handle")
+        share.assert_called_once_with("handle")
+
+    def test_different_requests_not_shared(self):
+        """We start one transfer per different request"""
+        InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        InFlightDownloads().submit(("http://foo", None, False), self.start, Mock(), Mock())
+        self.transfer.set_result(None)
+
+        self.assertEqual(self.start.call_count, 2)
+
+    def test_new_transfer_once_done(self):
+        """We start a new transfer once the previous one is done"""
+        InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        self.transfer.set_result("handle")
+        self.start.return_value = futures.Future()
+        InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+
+        self.assertEqual(self.start.call_count, 2)
+
+    def test_share_error(self):
+        """We deliver the transfer error to all requests"""
+        first = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        second = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        self.transfer.set_exception(BaseException("Failed"))
+
+        self.assertEqual(str(first.exception()), "Failed")
+        self.assertEqual(str(second.exception()), "Failed")
+
+    def test_report_to_all(self):
+        """We report progress to all requests"""
+        reports = [Mock(), Mock()]
+        for report in reports:
+            InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), report)
+        report_all = self.start.call_args[0][0]
+        report_all(10, 100)
+        self.transfer.set_result(None)
+
+        for report in reports:
+            report.assert_called_once_with(10, 100)
+        self.assertEqual(self.start.call_args, call(report_all, ANY, ANY))
+
+    def test_cancel_shared_request(self):
+        """We detach a cancelled request from a transfer still needed by others"""
+        first = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        second = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(return_value="shared"),
+                                            Mock())
+        cancelled = self.start.call_args[0][1]
+        InFlightDownloads().cancel(first, BaseException("Cancelled"))
+
+        self.assertEqual(str(first.exception(timeout=0)), "Cancelled")
+        self.assertFalse(cancelled.is_set())
+        self.transfer.set_result("handle")
+        self.assertEqual(second.result(), "handle")
+
+    def test_cancel_all_requests(self):
+        """We cancel the transfer once all its requests are cancelled"""
+        first = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        second = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        cancelled = self.start.call_args[0][1]
+        InFlightDownloads().cancel(second, BaseException("Cancelled"))
+        InFlightDownloads().cancel(first, BaseException("Cancelled"))
+
+        self.assertTrue(cancelled.is_set())
+        self.assertFalse(first.done())
+        self.transfer.set_exception(BaseException("Transfer cancelled"))
+        self.assertEqual(str(first.exception()), "Transfer cancelled")
+        self.assertEqual(str(second.exception()), "Cancelled")
+
+    def test_pause_shared_request(self):
+        """We only pause a transfer while all its requests are paused"""
+        first = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        second = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        resumed = self.start.call_args[0][2]
+        InFlightDownloads().pause(first)
+        self.assertTrue(resumed.is_set())
+        InFlightDownloads().pause(second)
+        self.assertFalse(resumed.is_set())
+        InFlightDownloads().resume(first)
+        self.assertTrue(resumed.is_set())
+
+    def test_cancel_resumes_paused_transfer(self):
+        """We resume a paused transfer once its other requests are cancelled, or once it's cancelled"""
+        first = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        second = InFlightDownloads().submit(("http://foo", None, True), self.start, Mock(), Mock())
+        resumed = self.start.call_args[0][2]
+        InFlightDownloads().pause(first)
+        InFlightDownloads().cancel(first, BaseException("Cancelled"))
+        self.assertTrue(resumed.is_set())
+        InFlightDownloads().pause(second)
+        self.assertFalse(resumed.is_set())
+        InFlightDownloads().cancel(second, BaseException("Cancelled"))
+        self.assertTrue(resumed.is_set())
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the download metrics"""
+
+import json
+from os.path import join
+import shutil
+import tempfile
+from time import sleep
+from unittest.mock import Mock
+from ..tools import LoggedTestCase, patchelem
+from udtc.network import telemetry
+from udtc.network.telemetry import MetricsRecorder, append_metrics
+
+
+class TestMetricsRecorder(LoggedTestCase):
+    """This will test the metrics recorded from progress reports"""
+
+    def test_record_progress(self):
+        """We measure the bytes transferred from the progress reports, passing them on"""
+        wrapped = Mock()
+        recorder = MetricsRecorder("http://foo")
+        recorder.begin()
+        report = recorder.report(wrapped)
+        report(0, 100)
+        sleep(0.01)
+        report(60, 100)
+        report(100, 100)
+        metrics = recorder.metrics()
+
+        self.assertEqual(wrapped.call_count, 3)
+        self.assertEqual(metrics.bytes, 100)
+        self.assertFalse(metrics.shared)
+        self.assertLessEqual(metrics.connect_time, metrics.ttfb)
+        self.assertLessEqual(metrics.ttfb, metrics.wall_time)
+        self.assertGreater(metrics.mean_throughput, 0)
+        self.assertEqual(metrics.stall_time, 0)
+
+    def test_resumed_bytes_not_counted(self):
+        """We only count the bytes transferred after the offset the download starts from"""
+        recorder = MetricsRecorder("http://foo")
+        report = recorder.report(Mock())
+        report(40, 100)
+        report(100, 100)
+
+        self.assertEqual(recorder.metrics().bytes, 60)
+
+    def test_restarted_attempt(self):
+        """We count the bytes transferred again by a new attempt"""
+        recorder = MetricsRecorder("http://foo")
+        report = recorder.report(Mock())
+        report(0, 100)
+        report(50, 100)
+        report(0, 100)
+        report(100, 100)
+
+        metrics = recorder.metrics(retries=1, wasted=50)
+
+        self.assertEqual(metrics.bytes, 150)
+        self.assertEqual(metrics.retries, 1)
+        self.assertEqual(metrics.wasted, 50)
+
+    def test_cached_download(self):
+        """We don't have any transfer metrics for a download from the cache"""
+        recorder = MetricsRecorder("http://foo")
+        recorder.report(Mock())(100, 100)
+        metrics = recorder.metrics()
+
+        self.assertEqual(metrics.bytes, 0)
+        self.assertIsNone(metrics.ttfb)
+        self.assertIsNone(metrics.mean_throughput)
+        self.assertIsNone(metrics.p95_throughput)
+
+    def test_stall_time(self):
+        """We sum the gaps without any byte received"""
+        with patchelem(MetricsRecorder, 'STALL_GAP', 0.01):
+            recorder = MetricsRecorder("http://foo")
+            report = recorder.report(Mock())
+            report(0, 100)
+            sleep(0.02)
+            report(100, 100)
+
+        self.assertGreaterEqual(recorder.metrics().stall_time, 0.02)
+
+    def test_p95_throughput(self):
+        """We take the 95th percentile of the throughput samples"""
+        with patchelem(MetricsRecorder, 'SAMPLE_SIZE', 1):
+            recorder = MetricsRecorder("http://foo")
+            report = recorder.report(Mock())
+            report(0, -1)
+            for current_size in range(1, 21):
+                sleep(0.001)
+                report(current_size, -1)
+        metrics = recorder.metrics()
+
+        self.assertGreaterEqual(metrics.p95_throughput, metrics.mean_throughput)
+
+
+class TestMetricsFile(LoggedTestCase):
+    """This will test the metrics appended to the metrics file"""
+
+    def setUp(self):
+        super().setUp()
+        self.metrics_dir = tempfile.mkdtemp()
+        self.path = join(self.metrics_dir, "metrics", "downloads.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.metrics_dir)
+        super().tearDown()
+
+    def test_append_json_lines(self):
+        """We append one JSON line per download"""
+        metrics = MetricsRecorder("http://foo").metrics()
+        with patchelem(telemetry, 'metrics_file', lambda: self.path):
+            append_metrics(metrics)
+            append_metrics(metrics, "Can't download")
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+
+        self.assertEqual([record["url"] for record in records], ["http://foo", "http://foo"])
+        self.assertEqual([record["error"] for record in records], [None, "Can't download"])
+        self.assertIn("timestamp", records[0])
+
+    def test_no_metrics_file(self):
+        """We don't write anything without a metrics file"""
+        with patchelem(telemetry, 'metrics_file', lambda: None):
+            append_metrics(MetricsRecorder("http://foo").metrics())
@@ -703,6 +703,47 @@ class TestMiscTools(LoggedTestCase):
         osmock.seteuid.assert_called_once_with(0)
 
 
+class TestTemporaryFile(LoggedTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.local_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.local_dir, "foo")
+        with open(self.path, 'w') as f:
+            f.write("content")
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+        super().tearDown()
+
+    def test_get_temporary_file_from(self):
+        """We move the file to a new temporary name next to it, keeping the suffix"""
+        with tools.get_temporary_file_from(self.path, suffix=".tgz") as f:
+            self.assertFalse(os.path.exists(self.path))
+            self.assertEquals(os.path.dirname(f.name), self.local_dir)
+            self.assertTrue(f.name.endswith(".tgz"))
+            self.assertEquals(f.read(), b"content")
+
+    def test_temporary_file_removed_on_close(self):
+        """We remove the temporary file from disk once closed"""
+        f = tools.get_temporary_file_from(self.path)
+        f.close()
+        self.assertEquals(os.listdir(self.local_dir), [])
+
+    def test_temporary_file_closed_twice(self):
+        """We don't fail when closing a temporary file which was already removed"""
+        f = tools.TemporaryFile(self.path)
+        f.close()
+        f.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_preallocate(self):
+        """We reserve disk space without changing the file size"""
+        with open(self.path, 'wb') as f:
+            tools.preallocate(f.fileno(), 1024*1024)
+            self.assertEquals(os.fstat(f.fileno()).st_size, 0)
+
+
 class TestAppendPATH(LoggedTestCase):
 
     def setUp(self):
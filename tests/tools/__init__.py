@@ -100,6 +100,7 @@ def change_xdg_path(key, value=None, remove=False):
     importlib.reload(xdg.BaseDirectory)
     with suppress(KeyError):
         udtc.tools.Singleton._instances.pop(udtc.tools.ConfigHandler)
+    udtc.tools.xdg_cache_home = xdg.BaseDirectory.xdg_cache_home
     udtc.tools.xdg_config_home = xdg.BaseDirectory.xdg_config_home
     udtc.tools.xdg_data_home = xdg.BaseDirectory.xdg_data_home
 
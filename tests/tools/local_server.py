@@ -24,6 +24,7 @@ from http.server import HTTPServer, SimpleHTTPRequestHandler
 import logging
 import os
 import posixpath
+from socketserver import ThreadingMixIn
 import ssl
 from . import get_data_dir
 import urllib
@@ -51,7 +52,7 @@ class LocalHttp:
         handler = RequestHandler
         handler.root_path = path
         # can be TCPServer, but we don't have a self.httpd.server_name then
-        self.httpd = HTTPServer(("", self.port), RequestHandler)
+        self.httpd = ThreadingHTTPServer(("", self.port), RequestHandler)
         if self.use_ssl:
             self.httpd.socket = ssl.wrap_socket(self.httpd.socket,
                                                 certfile=os.path.join(get_data_dir(), self.use_ssl),
@@ -76,16 +77,28 @@ class LocalHttp:
         self.httpd.socket.close()
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """Serve each connexion in its own thread, as they are kept alive"""
+    daemon_threads = True
+
+
 class RequestHandler(SimpleHTTPRequestHandler):
 
     root_path = os.getcwd()
+    # keep connexions alive
+    protocol_version = "HTTP/1.1"
 
     def end_headers(self):
-        """don't send Content-Length header for a particular file"""
+        """don't send Content-Length header for a particular file, advertise range support for the others"""
         if self.path.endswith("-with-no-content-length"):
             for current_header in self._headers_buffer:
                 if current_header.decode("UTF-8").startswith("Content-Length"):
                     self._headers_buffer.remove(current_header)
+            # the end of the content is then the end of the connexion
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        else:
+            self.send_header("Accept-Ranges", "bytes")
         super().end_headers()
 
     def translate_path(self, path):
@@ -122,12 +135,51 @@ class RequestHandler(SimpleHTTPRequestHandler):
         if self.path.endswith('-redirect'):
             self.send_response(302)
             self.send_header('Location', self.path[:-len('-redirect')])
+            self.send_header('Content-Length', '0')
             self.end_headers()
         else:
             # keep special ?file= to redirect the query
             if '?file=' in self.path:
                 self.path = self.path.split('?file=', 1)[1]
-            super().do_GET()
+            if "Range" in self.headers and not self.path.endswith("-with-no-content-length") and \
+                    self.range_is_valid():
+                self.send_range()
+            else:
+                super().do_GET()
+
+    def range_is_valid(self):
+        """Return if the file didn't change since the If-Range date, if any"""
+        if "If-Range" not in self.headers:
+            return True
+        try:
+            mtime = os.path.getmtime(self.translate_path(self.path))
+        except OSError:
+            return True
+        return self.headers["If-Range"] == self.date_time_string(mtime)
+
+    def send_range(self):
+        """Send the single byte range requested in the Range header"""
+        path = self.translate_path(self.path)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = self.headers["Range"].split("=", 1)[1].split("-", 1)
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+            if start >= size:
+                self.send_error(416, "Requested range not satisfiable")
+                return
+            self.send_response(206)
+            self.send_header("Content-type", self.guess_type(path))
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            f.seek(start)
+            self.wfile.write(f.read(end - start + 1))
 
     def log_message(self, fmt, *args):
         """Log an arbitrary message.
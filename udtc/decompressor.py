@@ -17,13 +17,19 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import bz2
 from collections import namedtuple
 from concurrent import futures
+from contextlib import suppress
 from glob import glob
+import gzip
 import logging
+import lzma
 import os
 import shutil
 import tarfile
+import tempfile
+import threading
 import zipfile
 
 
@@ -78,16 +84,20 @@ class Decompressor:
     def _decompress(self, fd, dir, dest):
         """decompress one entry
 
+        fd can be a StreamExtractor which already extracted the archive while it was downloading.
         dir can be a regexp"""
-        logger.debug("Extracting to {}".format(dest))
-        # We don't use shutil to automatically select the right codec as we need to ensure that zipfile
-        # will keep the original perms.
-        archive = None
-        try:
-            archive = tarfile.open(fileobj=fd)
-        except tarfile.ReadError:
-            archive = self.ZipFileWithPerm(fd.name)
-        archive.extractall(dest)
+        if isinstance(fd, StreamExtractor):
+            fd.move_to(dest)
+        else:
+            logger.debug("Extracting to {}".format(dest))
+            # We don't use shutil to automatically select the right codec as we need to ensure that zipfile
+            # will keep the original perms.
+            archive = None
+            try:
+                archive = tarfile.open(fileobj=fd)
+            except tarfile.ReadError:
+                archive = self.ZipFileWithPerm(fd.name)
+            archive.extractall(dest)
 
         # we want the content of dir to be the root of dest, rename and move content
         if dir is not None:
@@ -123,3 +133,120 @@ class Decompressor:
         """
         logger.info("All pending decompression done to {} done.".format([self._orders[fd].dest for fd in self._orders]))
         self._done_callback(self._decompressed)
+
+
+class StreamExtractor:
+    """Extract a tarball in a separate thread while its content is written chunk by chunk
+
+    The archive is extracted in a staging directory next to dest, then moved to dest once complete and verified
+    (see Decompressor). Writes block while the extraction is lagging behind."""
+
+    TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+    BLOCK_SIZE = 1024*64
+
+    def __init__(self, dest):
+        parent_dir = os.path.dirname(os.path.normpath(dest))
+        os.makedirs(parent_dir, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=".{}-".format(os.path.basename(os.path.normpath(dest))), dir=parent_dir)
+        self._error = None
+        read_fd, write_fd = os.pipe()
+        self._reader = open(read_fd, 'rb')
+        self._writer = open(write_fd, 'wb')
+        self._thread = threading.Thread(target=self._extract, name="extract-{}".format(os.path.basename(dest)))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def can_stream(cls, url):
+        """Return if the archive at url can be extracted while downloading (tarballs only: zip needs seeking)"""
+        return url.lower().endswith(cls.TAR_EXTENSIONS)
+
+    def _open_stream(self):
+        """Return the uncompressed stream of the archive, which raises if the compressed stream is truncated"""
+        magic = self._reader.peek(6)
+        if magic.startswith(b"\x1f\x8b"):
+            return gzip.GzipFile(fileobj=self._reader, mode='rb')
+        if magic.startswith(b"BZh"):
+            return bz2.BZ2File(self._reader)
+        if magic.startswith(b"\xfd7zXZ\x00"):
+            return lzma.LZMAFile(self._reader)
+        return self._reader
+
+    def _extract(self):
+        logger.debug("Extracting stream to {}".format(self.path))
+        try:
+            stream = self._open_stream()
+            with tarfile.open(fileobj=stream, mode="r|") as archive:
+                # the content isn't verified yet: nothing may be written outside the staging directory
+                if hasattr(tarfile, "data_filter"):
+                    archive.extractall(self.path, members=self._safe_members(archive), filter="data")
+                else:
+                    archive.extractall(self.path, members=self._safe_members(archive))
+            # consume end of archive padding so that the writer never blocks
+            while stream.read(self.BLOCK_SIZE):
+                pass
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._reader.close()
+
+    def _safe_members(self, archive):
+        """Yield archive members, raising on any one which would be written outside the staging directory
+
+        Only regular files, directories and links within the staging directory are allowed, and the set-id bits of
+        file modes are dropped."""
+        root = os.path.realpath(self.path)
+
+        def inside(path):
+            path = os.path.realpath(os.path.join(root, path))
+            return path == root or path.startswith(root + os.sep)
+
+        for member in archive:
+            if os.path.isabs(member.name) or not inside(member.name):
+                raise BaseException("{} would be extracted outside of the destination".format(member.name))
+            if member.issym():
+                target = os.path.join(os.path.dirname(member.name), member.linkname)
+                if os.path.isabs(member.linkname) or not inside(target):
+                    raise BaseException("{} links outside of the destination".format(member.name))
+            elif member.islnk():
+                if os.path.isabs(member.linkname) or not inside(member.linkname):
+                    raise BaseException("{} links outside of the destination".format(member.name))
+            elif not (member.isfile() or member.isdir()):
+                raise BaseException("{} isn't a regular file nor a directory".format(member.name))
+            member.mode &= 0o777
+            yield member
+
+    def write(self, data):
+        """Feed next chunk of the archive"""
+        try:
+            self._writer.write(data)
+        except BrokenPipeError:
+            self._thread.join()
+            raise BaseException("Couldn't extract archive: {}".format(self._error))
+
+    def finish(self):
+        """Signal the end of the archive and wait for its extraction to end, raising any extraction error"""
+        with suppress(BrokenPipeError):
+            self._writer.close()
+        self._thread.join()
+        if self._error is not None:
+            raise BaseException("Couldn't extract archive: {}".format(self._error))
+
+    def abort(self):
+        """Stop the extraction and discard the partially extracted tree"""
+        logger.debug("Discarding extracted content in {}".format(self.path))
+        with suppress(OSError):
+            self._writer.close()
+        self._thread.join()
+        self.close()
+
+    def move_to(self, dest):
+        """Move the extracted content to dest"""
+        logger.debug("Moving extracted content to {}".format(dest))
+        os.makedirs(dest, exist_ok=True)
+        for filename in os.listdir(self.path):
+            shutil.move(os.path.join(self.path, filename), os.path.join(dest, filename))
+
+    def close(self):
+        """Remove the staging directory"""
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -27,16 +27,72 @@ from progressbar import ProgressBar
 import os
 import shutil
 import udtc.frameworks
-from udtc.decompressor import Decompressor
+from udtc.decompressor import Decompressor, StreamExtractor
 from udtc.interactions import InputText, YesNo, LicenseAgreement, DisplayMessage, UnknownProgress
+from udtc.network.download_cache import DownloadCache
 from udtc.network.download_center import DownloadCenter
 from udtc.network.requirements_handler import RequirementsHandler
+from udtc.network.scheduler import DownloadScheduler
 from udtc.ui import UI
 from udtc.tools import MainLoop, strip_tags, launcher_exists, get_icon_path, get_launcher_path
 
 logger = logging.getLogger(__name__)
 
 
+class DownloadPageParser:
+    """Sink feeding a download page to the installer parsers line by line, while it's downloading.
+
+    It's complete as soon as the installer tells it found everything it needs in the page."""
+
+    def __init__(self, installer):
+        self._installer = installer
+        self._pending = b""
+        self._in_license = False
+        self._in_download = False
+        self.url = None
+        self.checksum = None
+        self.license_txt = StringIO()
+        self.complete = False
+
+    def write(self, data):
+        self._pending += data
+        # only cut the lines parsed from the pending data once, rather than on each line
+        start = 0
+        while not self.complete:
+            end = self._pending.find(b"\n", start)
+            if end == -1:
+                break
+            self._parse_line(self._pending[start:end + 1])
+            start = end + 1
+        self._pending = self._pending[start:]
+
+    def finish(self):
+        # last line without any line ending
+        if self._pending and not self.complete:
+            self._parse_line(self._pending)
+        self._pending = b""
+
+    def abort(self):
+        self._pending = b""
+
+    def _parse_line(self, line):
+        installer = self._installer
+        line_content = line.decode()
+
+        if installer.expect_license:
+            self._in_license = installer.parse_license(line_content, self.license_txt, self._in_license)
+
+        (download, self._in_download) = installer.parse_download_link(line_content, self._in_download)
+        if download is not None:
+            (newurl, newchecksum) = download
+            self.url = newurl if newurl is not None else self.url
+            self.checksum = newchecksum if newchecksum is not None else self.checksum
+            logger.debug("Found download link for {}, checksum: {}".format(self.url, self.checksum))
+
+        self.complete = installer.is_metadata_complete(self.url, self.checksum, self.license_txt, self._in_license,
+                                                       self._in_download)
+
+
 class BaseInstaller(udtc.frameworks.BaseFramework):
 
     def __new__(cls, *args, **kwargs):
@@ -48,15 +104,17 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
     def __init__(self, *args, **kwargs):
         """The Downloader framework isn't instantiated directly, but is useful to inherit from for all frameworks
 
-        having a set of downloads to proceed, some eventual supported_archs."""
+        having a set of downloads to proceed, some eventual supported_archs.
+        require_checksum (or its former name, require_md5) makes the download page parsing fail if no checksum
+        is found."""
         self.expect_license = kwargs.get("expect_license", False)
         self.download_page = kwargs["download_page"]
-        self.require_md5 = kwargs.get("require_md5", False)
+        self.require_checksum = kwargs.get("require_checksum", kwargs.get("require_md5", False))
         self.dir_to_decompress_in_tarball = kwargs.get("dir_to_decompress_in_tarball", None)
         self.desktop_filename = kwargs.get("desktop_filename", None)
         self.icon_filename = kwargs.get("icon_filename", None)
-        for extra_arg in ["expect_license", "download_page", "require_md5", "dir_to_decompress_in_tarball",
-                          "desktop_filename", "icon_filename"]:
+        for extra_arg in ["expect_license", "download_page", "require_checksum", "require_md5",
+                          "dir_to_decompress_in_tarball", "desktop_filename", "icon_filename"]:
             with suppress(KeyError):
                 kwargs.pop(extra_arg)
         super().__init__(*args, **kwargs)
@@ -64,6 +122,8 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
         self._install_done = False
         self._paths_to_clean = set()
         self._arg_install_path = None
+        self._prefetch_done = None
+        self._download_center = None
         self.download_requests = []
 
     @property
@@ -142,9 +202,51 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
         self._paths_to_clean.add(self.install_path)
         self.download_provider_page()
 
+    def prefetch(self, on_done):
+        """Download the provider page and archives to the caches, without installing anything nor asking anything.
+
+        This runs the metadata phase as an installation would. The license is still to be agreed on at installation
+        time. on_done(framework, error) is called once done, error being None on success."""
+        logger.debug("Prefetch {}".format(self.name))
+        self._prefetch_done = on_done
+        self.download_requests = []
+        self.download_provider_page()
+
+    @property
+    def metadata_priority(self):
+        """Scheduler priority class of the metadata downloads: a prefetch doesn't get ahead of installations"""
+        if self._prefetch_done:
+            return DownloadScheduler.PRIORITY_PREFETCH
+        return DownloadScheduler.PRIORITY_METADATA
+
+    def abort(self, message):
+        """Log message as an error and return to the main screen, or end the prefetch with that error"""
+        logger.error(message)
+        if self._prefetch_done:
+            self._prefetch_done(self, message)
+            return
+        UI.return_main_screen()
+
     def download_provider_page(self):
         logger.debug("Download application provider page")
-        DownloadCenter([(self.download_page, None)], self.get_metadata_and_check_license, download=False)
+        self._page_parser = DownloadPageParser(self)
+        if self._prefetch_done:
+            # download the whole page, to have it in the page cache
+            DownloadCenter([(self.download_page, None)], self._parse_provider_page, download=False,
+                           priority=self.metadata_priority)
+            return
+        # parse the page while it's downloading, stopping once we have what we need
+        DownloadCenter([(self.download_page, None)], self.get_metadata_and_check_license, download=False,
+                       stream_to={self.download_page: self._page_parser}, priority=self.metadata_priority)
+
+    def _parse_provider_page(self, result):
+        """Parse the downloaded provider page, then check its metadata"""
+        page = result[self.download_page].buffer
+        if page is not None:
+            with page:
+                self._page_parser.write(page.read())
+            self._page_parser.finish()
+        self.get_metadata_and_check_license(result)
 
     def parse_license(self, line, license_txt, in_license):
         """Parse license per line, eventually write to license_txt if it's in the license part.
@@ -157,9 +259,19 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
         download part.
 
         return a tuple of (None, in_download=True/False) if no parsable is found or
-                          ((url, md5sum), in_download=True/False)"""
+                          ((url, checksum), in_download=True/False)
+        checksum is a md5sum, a typed digest like "sha256:<hexdigest>" or a tuple of typed digests"""
         pass
 
+    def is_metadata_complete(self, url, checksum, license_txt, in_license, in_download):
+        """Return if the download page parsed so far has everything we need, the rest isn't downloaded then.
+
+        By default, we need the download link, its checksum if required and the whole license if expected. Frameworks
+        whose download link or license can be overridden later in the page should return False."""
+        if url is None or in_download or (self.require_checksum and checksum is None):
+            return False
+        return not self.expect_license or (license_txt.getvalue() != "" and not in_license)
+
     @MainLoop.in_mainloop_thread
     def get_metadata_and_check_license(self, result):
         """Download files to download + license and check it"""
@@ -167,48 +279,37 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
 
         error_msg = result[self.download_page].error
         if error_msg:
-            logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
-            UI.return_main_screen()
+            self.abort("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
+            return
 
-        url, md5sum = (None, None)
-        with StringIO() as license_txt:
-            in_license = False
-            in_download = False
-            for line in result[self.download_page].buffer:
-                line_content = line.decode()
-
-                if self.expect_license:
-                    in_license = self.parse_license(line_content, license_txt, in_license)
-
-                (download, in_download) = self.parse_download_link(line_content, in_download)
-                if download is not None:
-                    (newurl, newmd5sum) = download
-                    url = newurl if newurl is not None else url
-                    md5sum = newmd5sum if newmd5sum is not None else md5sum
-                    logger.debug("Found download link for {}, md5sum: {}".format(url, md5sum))
-
-            if url is None or (self.require_md5 and md5sum is None):
-                logger.error("Download page changed its syntax or is not parsable")
-                UI.return_main_screen()
-            self.download_requests.append((url, md5sum))
-
-            if license_txt.getvalue() != "":
+        parser = self._page_parser
+        url, checksum = (parser.url, parser.checksum)
+        with parser.license_txt as license_txt:
+            if url is None or (self.require_checksum and checksum is None):
+                self.abort("Download page changed its syntax or is not parsable")
+                return
+            self.download_requests.append((url, checksum))
+
+            if license_txt.getvalue() != "" and not self._prefetch_done:
                 logger.debug("Check license agreement.")
                 UI.display(LicenseAgreement(strip_tags(license_txt.getvalue()).strip(),
                                             self.start_download_and_install,
                                             UI.return_main_screen))
-            elif self.expect_license:
-                logger.error("We were expecting to find a license on the download page, we didn't.")
-                UI.return_main_screen()
+            elif self.expect_license and license_txt.getvalue() == "":
+                self.abort("We were expecting to find a license on the download page, we didn't.")
             else:
                 self.start_download_and_install()
         return
 
     def start_download_and_install(self):
+        if self._prefetch_done:
+            self.download_to_cache()
+            return
         self.last_progress_download = None
         self.last_progress_requirement = None
         self.balance_requirement_download = None
         self.pkg_size_download = 0
+        self.total_download_size = 0
         self.result_requirement = None
         self.result_download = None
         self._download_done_callback_called = False
@@ -217,7 +318,46 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
         self.pkg_to_install = RequirementsHandler().install_bucket(self.packages_requirements,
                                                                    self.get_progress_requirement,
                                                                    self.requirement_done)
-        DownloadCenter(urls=self.download_requests, on_done=self.download_done, report=self.get_progress_download)
+        # extract tarballs while they download
+        self._stream_extractors = {}
+        if len(self.download_requests) == 1:
+            (url, checksum) = self.download_requests[0]
+            # results are keyed by the first of mirror urls
+            if not isinstance(url, str):
+                url = url[0]
+            if StreamExtractor.can_stream(url):
+                self._stream_extractors[url] = StreamExtractor(self.install_path)
+        # stage downloads on the installation filesystem, to not copy them between filesystems when installing
+        staging_dir = os.path.dirname(os.path.normpath(self.install_path))
+        with suppress(OSError):
+            os.makedirs(staging_dir, exist_ok=True)
+        self._download_center = DownloadCenter(urls=self.download_requests, on_done=self.download_done,
+                                               report=self.get_progress_download, stream_to=self._stream_extractors,
+                                               staging_dir=staging_dir)
+
+    def download_to_cache(self):
+        """Download the archives to the download cache only"""
+        # stage downloads on the cache filesystem, to not copy them between filesystems when adding them to it
+        staging_dir = DownloadCache().path
+        with suppress(OSError):
+            os.makedirs(staging_dir, exist_ok=True)
+        DownloadCenter(urls=self.download_requests, on_done=self.download_to_cache_done,
+                       priority=DownloadScheduler.PRIORITY_PREFETCH, staging_dir=staging_dir)
+
+    @MainLoop.in_mainloop_thread
+    def download_to_cache_done(self, result):
+        errors = []
+        for url in result:
+            if result[url].error:
+                errors.append(result[url].error)
+            # the download cache has its own copy
+            if result[url].fd:
+                result[url].fd.close()
+        if errors:
+            self.abort("\n".join(errors))
+            return
+        logger.debug("Prefetched {}".format(self.name))
+        self._prefetch_done(self, None)
 
     @MainLoop.in_mainloop_thread
     def get_progress(self, progress_download, progress_requirement):
@@ -243,8 +383,8 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
                     return
                 else:
                     # apply a minimum of 15% (no download or small download + install time)
-                    self.balance_requirement_download = max(self.pkg_size_download /
-                                                            (self.pkg_size_download + self.total_download_size),
+                    total_size = self.pkg_size_download + self.total_download_size
+                    self.balance_requirement_download = max(self.pkg_size_download / total_size if total_size else 0,
                                                             0.15)
 
         progress = self.balance_requirement_download * self.last_progress_requirement +\
@@ -270,18 +410,20 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
     def get_progress_download(self, downloads):
         """Chain up to main get_progress, returning current value between 0 and 100
 
-        First call initialize the balance between requirements and download progress"""
-        total_size = 0
-        total_current_size = 0
-        for download in downloads:
-            total_size += downloads[download]["size"]
-            total_current_size += downloads[download]["current"]
-        self.total_download_size = total_size
-        self.get_progress(total_current_size / total_size * 100, None)
+        First call initialize the balance between requirements and download progress. downloads is a ProgressSnapshot:
+        its totals are used, without going through every download. Until the size of a download is known, we
+        don't report any progress."""
+        totals = downloads.totals
+        self.total_download_size = totals.size
+        if totals.percentage is not None:
+            self.get_progress(totals.percentage, None)
 
     def requirement_done(self, result):
         self.get_progress(None, 100)
         self.result_requirement = result
+        if result.error and self._download_center:
+            # the installation fails anyway, don't download the rest
+            self._download_center.cancel()
         self.download_and_requirements_done()
 
     def download_done(self, result):
@@ -307,8 +449,10 @@ class BaseInstaller(udtc.frameworks.BaseFramework):
             if self.result_download[url].error:
                 logger.error(self.result_download[url].error)
                 error_detected = True
-            fd = self.result_download[url].fd
+            fd = self.result_download[url].fd or self._stream_extractors.get(url)
         if error_detected:
+            for extractor in self._stream_extractors.values():
+                extractor.close()
             UI.return_main_screen()
             return
         self.decompress_and_install(fd)
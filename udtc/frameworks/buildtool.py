@@ -28,7 +28,6 @@ from os.path import join
 import udtc.frameworks.baseinstaller
 from udtc.network.download_center import DownloadCenter
 from udtc.tools import create_launcher, get_application_desktop_file
-from udtc.ui import UI
 
 
 logger = logging.getLogger(__name__)
@@ -42,8 +41,11 @@ class BuildToolCategory(udtc.frameworks.BaseCategory):
 
 class Maven(udtc.frameworks.baseinstaller.BaseInstaller):    
     """The Apache Foundation distribution."""
-    DOWNLOAD_URL_PAT = "http://www.apache.org/dist/maven/maven-3/{release}/binaries" \
+    DOWNLOAD_URL_PAT = "http://www.apache.org/dist/maven/maven-3/{release}/binaries/" \
                        "apache-maven-{release}-bin.tar.gz{suf}"
+    # equivalent mirrors of the archive, the fastest one is used
+    MIRROR_URL_PATS = ("https://archive.apache.org/dist/maven/maven-3/{release}/binaries/"
+                       "apache-maven-{release}-bin.tar.gz{suf}",)
     RELEASE = '3.2.3'
 
     def __init__(self, category):
@@ -61,14 +63,13 @@ class Maven(udtc.frameworks.baseinstaller.BaseInstaller):
         """
         logger.debug("Preparing to download MD5.")
 
-        md5_url = self.DOWNLOAD_URL_PAT.format(release=RELEASE, suf='.md5')
+        md5_url = self.DOWNLOAD_URL_PAT.format(release=self.RELEASE, suf='.md5')
 
         def done(download_result):
             res = download_result[md5_url]
 
             if res.error:
-                logger.error(res.error)
-                UI.return_main_screen()
+                self.abort(res.error)
                 return
 
             # Should be ASCII anyway.
@@ -77,12 +78,13 @@ class Maven(udtc.frameworks.baseinstaller.BaseInstaller):
 
             logger.debug("Preparing to download the main archive.")
 
-            download_url = self.DOWNLOAD_URL_PAT.format(release=RELEASE, suf='')
+            download_urls = [pat.format(release=self.RELEASE, suf='')
+                             for pat in (self.DOWNLOAD_URL_PAT,) + self.MIRROR_URL_PATS]
 
-            self.download_requests.append((download_url, md5))
+            self.download_requests.append((tuple(download_urls), md5))
             self.start_download_and_install()
 
-        DownloadCenter(urls=[md5_url], on_done=done, download=False)
+        DownloadCenter(urls=[md5_url], on_done=done, download=False, priority=self.metadata_priority)
 
     def create_launcher(self):
         """Create the env variables"""
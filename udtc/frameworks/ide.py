@@ -29,7 +29,6 @@ from os.path import join
 import udtc.frameworks.baseinstaller
 from udtc.network.download_center import DownloadCenter
 from udtc.tools import create_launcher, get_application_desktop_file
-from udtc.ui import UI
 
 
 logger = logging.getLogger(__name__)
@@ -47,6 +46,9 @@ class Eclipse(udtc.frameworks.baseinstaller.BaseInstaller):
                        "file=/technology/epp/downloads/release/luna/R/" \
                        "eclipse-standard-luna-R-linux-gtk{arch}.tar.gz{suf}" \
                        "&r=1"
+    # equivalent mirrors of the archive, the fastest one is used
+    MIRROR_URL_PATS = ("https://archive.eclipse.org/technology/epp/downloads/release/luna/R/"
+                       "eclipse-standard-luna-R-linux-gtk{arch}.tar.gz{suf}",)
 
     def __init__(self, category):
         super().__init__(name=_("Eclipse"),
@@ -66,19 +68,19 @@ class Eclipse(udtc.frameworks.baseinstaller.BaseInstaller):
 
         arch = platform.machine()
         if arch == 'i686':
-            md5_url = self.DOWNLOAD_URL_PAT.format(arch='', suf='.md5')
+            arch_suffix = ''
         elif arch == 'x86_64':
-            md5_url = self.DOWNLOAD_URL_PAT.format(arch='-x86_64', suf='.md5')
+            arch_suffix = '-x86_64'
         else:
-            logger.error("Unsupported architecture: {}".format(arch))
-            UI.return_main_screen()
+            self.abort("Unsupported architecture: {}".format(arch))
+            return
+        md5_url = self.DOWNLOAD_URL_PAT.format(arch=arch_suffix, suf='.md5')
 
         def done(download_result):
             res = download_result[md5_url]
 
             if res.error:
-                logger.error(res.error)
-                UI.return_main_screen()
+                self.abort(res.error)
                 return
 
             # Should be ASCII anyway.
@@ -86,15 +88,12 @@ class Eclipse(udtc.frameworks.baseinstaller.BaseInstaller):
             logger.debug("Downloaded MD5 is {}".format(md5))
 
             logger.debug("Preparing to download the main archive.")
-            if arch == 'i686':
-                download_url = self.DOWNLOAD_URL_PAT.format(arch='', suf='')
-            elif arch == 'x86_64':
-                download_url = self.DOWNLOAD_URL_PAT.format(arch='-x86_64',
-                                                            suf='')
-            self.download_requests.append((download_url, md5))
+            download_urls = [pat.format(arch=arch_suffix, suf='')
+                             for pat in (self.DOWNLOAD_URL_PAT,) + self.MIRROR_URL_PATS]
+            self.download_requests.append((tuple(download_urls), md5))
             self.start_download_and_install()
 
-        DownloadCenter(urls=[md5_url], on_done=done, download=False)
+        DownloadCenter(urls=[md5_url], on_done=done, download=False, priority=self.metadata_priority)
 
     def create_launcher(self):
         """Create the Luna launcher"""
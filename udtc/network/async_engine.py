@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering an asyncio download engine, running all downloads on a single event loop thread"""
+
+import asyncio
+import logging
+import os
+import requests.certs
+import requests.utils
+import socket
+import ssl
+import threading
+from urllib.parse import urljoin, urlsplit
+from udtc.network.scheduler import DownloadScheduler
+from udtc.tools import ConfigHandler, Singleton
+
+logger = logging.getLogger(__name__)
+
+
+async def with_timeout(awaitable, timeout, message):
+    """Return the result of awaitable, raising an error with message if it takes more than timeout seconds"""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise BaseException(message) from None
+
+
+class AsyncResponse:
+    """Response of an http request on the event loop, with its body read asynchronously
+
+    Each read fails if no data comes within read_timeout seconds."""
+
+    def __init__(self, url, status_code, reason, headers, reader, writer, on_close, read_timeout=None):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers  # lower case names
+        self._reader = reader
+        self._writer = writer
+        self._on_close = on_close
+        self._read_timeout = read_timeout
+
+    async def _read(self, read):
+        """Return the result of read, a coroutine reading the body, within the read timeout"""
+        return await with_timeout(read, self._read_timeout, "Read timed out on {}".format(self.url))
+
+    async def iter_content(self, chunk_size):
+        """Yield the body in chunks of at most chunk_size bytes"""
+        if "chunked" in self.headers.get("transfer-encoding", "").lower():
+            while True:
+                size = int((await self._read(self._reader.readline())).split(b";")[0], 16)
+                if size == 0:
+                    break
+                while size:
+                    data = await self._read(self._reader.readexactly(min(size, chunk_size)))
+                    size -= len(data)
+                    yield data
+                await self._read(self._reader.readline())
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+            while remaining:
+                data = await self._read(self._reader.read(min(remaining, chunk_size)))
+                if not data:
+                    raise BaseException("Download of {} ended prematurely".format(self.url))
+                remaining -= len(data)
+                yield data
+        else:
+            # delimited by the connection close
+            while True:
+                data = await self._read(self._reader.read(chunk_size))
+                if not data:
+                    break
+                yield data
+
+    def close(self):
+        if self._on_close is not None:
+            self._writer.close()
+            self._on_close()
+            self._on_close = None
+
+
+class AsyncDownloadEngine(object, metaclass=Singleton):
+    """Run download coroutines on one event loop thread shared by the whole process, using non blocking sockets.
+
+    Concurrent downloads don't cost any extra thread. Their number is bounded by max_connections (set as
+    async_max_connections in the "network" section of the configuration) and by the per host limits of the
+    DownloadScheduler. Proxies aren't supported: see proxied()."""
+
+    DEFAULT_MAX_CONNECTIONS = 64
+    MAX_REDIRECTS = 30
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    CONNECT_TIMEOUT = 15  # seconds, per address of the host
+    READ_TIMEOUT = 30  # seconds without receiving any byte
+    ADDRESS_TTL = 300  # seconds before resolving a host again
+
+    def __init__(self):
+        try:
+            self.max_connections = int(ConfigHandler().config["network"]["async_max_connections"])
+        except (TypeError, KeyError, ValueError):
+            self.max_connections = self.DEFAULT_MAX_CONNECTIONS
+        self._loop = asyncio.new_event_loop()
+        self._connections = asyncio.Semaphore(self.max_connections)
+        self._host_connections = {}
+        self._tasks = set()
+        self._ssl_contexts = {}
+        self._addresses = {}
+        self._thread = threading.Thread(target=self._loop.run_forever, name="download-event-loop")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, coroutine):
+        """Schedule coroutine on the event loop, and return a concurrent.futures.Future for its result"""
+        return asyncio.run_coroutine_threadsafe(self._run(coroutine), self._loop)
+
+    async def _run(self, coroutine):
+        """Run coroutine, referencing its task while it runs as the event loop only keeps weak references to them"""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await coroutine
+        finally:
+            self._tasks.discard(task)
+
+    def _ssl_context(self):
+        """Return the ssl context trusting the same certificates than requests (REQUESTS_CA_BUNDLE or certifi)"""
+        cafile = os.environ.get("REQUESTS_CA_BUNDLE") or requests.certs.where()
+        if cafile not in self._ssl_contexts:
+            self._ssl_contexts[cafile] = ssl.create_default_context(cafile=cafile)
+        return self._ssl_contexts[cafile]
+
+    @staticmethod
+    def proxied(url):
+        """Return if url is to be fetched through a proxy, set in the environment as requests does (http_proxy,
+        https_proxy, no_proxy...)"""
+        return requests.utils.select_proxy(url, requests.utils.get_environ_proxies(url)) is not None
+
+    async def _resolve(self, host, port):
+        """Return the addresses to connect to host, resolving each host at most once every ADDRESS_TTL seconds
+
+        Resolution runs in the default executor, this avoids using one of its threads per connection."""
+        resolution = self._addresses.get((host, port))
+        if resolution is None or self._loop.time() - resolution[1] > self.ADDRESS_TTL:
+            resolution = (asyncio.ensure_future(self._loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)),
+                          self._loop.time())
+            self._addresses[(host, port)] = resolution
+        try:
+            infos = await asyncio.shield(resolution[0])
+        except:
+            # retry on next connection
+            self._forget(host, port, resolution)
+            raise
+        addresses = []
+        for info in infos:
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        return addresses
+
+    def _forget(self, host, port, resolution):
+        """Drop the cached resolution of host, unless it was already renewed"""
+        if self._addresses.get((host, port)) is resolution:
+            del self._addresses[(host, port)]
+
+    async def _connect(self, parts, port):
+        """Return the (reader, writer) of a connection to the host of parts, trying each of its addresses in turn"""
+        addresses = await with_timeout(self._resolve(parts.hostname, port), self.CONNECT_TIMEOUT,
+                                       "Resolving {} timed out".format(parts.hostname))
+        options = {}
+        if parts.scheme == "https":
+            options = {"ssl": self._ssl_context(), "server_hostname": parts.hostname}
+        error = None
+        for address in addresses:
+            try:
+                return await asyncio.wait_for(asyncio.open_connection(address, port, **options), self.CONNECT_TIMEOUT)
+            except asyncio.TimeoutError:
+                error = BaseException("Connection to {} ({}) timed out".format(parts.hostname, address))
+            except OSError as e:
+                error = e
+            logger.debug("Can't connect to {} ({}): {}".format(parts.hostname, address, error))
+        # the host may have moved
+        self._addresses.pop((parts.hostname, port), None)
+        raise error
+
+    def _host_semaphore(self, host):
+        """Return the semaphore bounding connections to host. This must be called from the event loop"""
+        if host not in self._host_connections:
+            self._host_connections[host] = asyncio.Semaphore(DownloadScheduler().limit_for(host))
+        return self._host_connections[host]
+
+    async def get(self, url, headers=None):
+        """Send a GET request for url, following redirections, and return an AsyncResponse
+
+        A connection slot to the final host is held until the response is closed."""
+        for i in range(self.MAX_REDIRECTS + 1):
+            response = await self._request(url, headers or {})
+            if response.status_code in self.REDIRECT_CODES and "location" in response.headers:
+                response.close()
+                url = urljoin(url, response.headers["location"])
+                continue
+            return response
+        raise BaseException("Exceeded {} redirects.".format(self.MAX_REDIRECTS))
+
+    async def _request(self, url, headers):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise BaseException("Protocol not supported.")
+        if self.proxied(url):
+            raise BaseException("Can't download {} through a proxy with the asyncio engine".format(url))
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        host_semaphore = self._host_semaphore(parts.hostname)
+        # wait for the host slot first so that we don't hold a global one meanwhile
+        await host_semaphore.acquire()
+        await self._connections.acquire()
+
+        def release():
+            host_semaphore.release()
+            self._connections.release()
+
+        writer = None
+        try:
+            reader, writer = await self._connect(parts, port)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            request_headers = {"Host": parts.netloc, "User-Agent": "udtc", "Accept-Encoding": "identity",
+                               "Connection": "close"}
+            request_headers.update(headers)
+            request = "GET {} HTTP/1.1\r\n".format(path)
+            request += "".join("{}: {}\r\n".format(name, value) for (name, value) in request_headers.items())
+            writer.write((request + "\r\n").encode("latin-1"))
+
+            timeout_message = "Read timed out on {}".format(url)
+            status_line = await with_timeout(reader.readline(), self.READ_TIMEOUT, timeout_message)
+            (version, status_code, reason) = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+            response_headers = {}
+            while True:
+                line = await with_timeout(reader.readline(), self.READ_TIMEOUT, timeout_message)
+                line = line.decode("latin-1").rstrip("\r\n")
+                if not line:
+                    break
+                (name, sep, value) = line.partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+            return AsyncResponse(url, int(status_code), reason, response_headers, reader, writer, release,
+                                 read_timeout=self.READ_TIMEOUT)
+        except:
+            if writer is not None:
+                writer.close()
+            release()
+            raise
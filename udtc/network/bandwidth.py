@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering the process wide bandwidth limiter shared by all downloads"""
+
+import logging
+import threading
+from time import monotonic, sleep
+from urllib.parse import urlparse
+from udtc.tools import ConfigHandler, Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens (bytes) per second, holding at most one second of them.
+
+    Consumers take their tokens right away, even if the bucket goes in debt, and wait for the debt to be paid back.
+    A rate of 0 or None is unlimited."""
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self._rate = None
+        self._tokens = 0
+        self._last = monotonic()
+        self.set_rate(rate)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate):
+        """Change the rate, taking effect for next consumers"""
+        with self._lock:
+            self._refill()
+            self._rate = rate or None
+            if self._rate:
+                self._tokens = min(self._tokens, self._rate)
+
+    def _refill(self):
+        """Add the tokens earned since last refill. This must be called with the lock held"""
+        now = monotonic()
+        if self._rate:
+            self._tokens = min(self._tokens + (now - self._last) * self._rate, self._rate)
+        self._last = now
+
+    def reserve(self, size):
+        """Take size tokens and return the number of seconds to wait before using them"""
+        with self._lock:
+            if not self._rate:
+                return 0
+            self._refill()
+            self._tokens -= size
+            return max(-self._tokens / self._rate, 0)
+
+
+class BandwidthLimiter(object, metaclass=Singleton):
+    """Bound the bandwidth used by all downloads of the process, globally and per host.
+
+    Limits are in bytes per second, and can be set in the "network" section of the configuration: max_bandwidth and
+    host_bandwidth (a dict of host: maximum bandwidth). They can be changed at runtime with set_rate()."""
+
+    def __init__(self):
+        config = ConfigHandler().config
+        try:
+            network_config = config["network"] or {}
+        except (TypeError, KeyError):
+            network_config = {}
+        self._lock = threading.Lock()
+        self._global = TokenBucket(int(network_config.get("max_bandwidth", 0) or 0))
+        self._hosts = {host: TokenBucket(int(rate))
+                       for (host, rate) in (network_config.get("host_bandwidth", None) or {}).items()}
+
+    def rate(self, host=None):
+        """Return the bandwidth limit for host, or the global one if host is None. None is unlimited"""
+        if host is None:
+            return self._global.rate
+        with self._lock:
+            bucket = self._hosts.get(host)
+        return bucket.rate if bucket else None
+
+    def set_rate(self, rate, host=None):
+        """Limit bandwidth to rate bytes per second for host, or globally if host is None. 0 or None is unlimited"""
+        logger.debug("Bandwidth limit {}is now {}".format("for {} ".format(host) if host else "", rate))
+        if host is None:
+            self._global.set_rate(rate)
+            return
+        with self._lock:
+            if host in self._hosts:
+                self._hosts[host].set_rate(rate)
+            else:
+                self._hosts[host] = TokenBucket(rate)
+
+    def reserve(self, url, size):
+        """Account size bytes downloaded from url and return the number of seconds to wait to stay under the limits"""
+        with self._lock:
+            host_bucket = self._hosts.get(urlparse(url).hostname)
+        delay = self._global.reserve(size)
+        if host_bucket:
+            delay = max(delay, host_bucket.reserve(size))
+        return delay
+
+    def throttle(self, url, size):
+        """Account size bytes downloaded from url, blocking as long as needed to stay under the limits"""
+        delay = self.reserve(url, size)
+        if delay:
+            sleep(delay)
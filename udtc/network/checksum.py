@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering checksums of downloaded content"""
+
+import hashlib
+import os
+
+
+class Checksum:
+    """Digests of a download content, computed in one pass while its chunks are written in order.
+
+    The expected checksum is either a bare hexadecimal md5sum, a typed digest like "sha256:<hexdigest>", or a tuple
+    of typed digests which must all match. Content we didn't stream (resumed prefix, cached archive) is hashed back
+    from disk."""
+
+    ALGORITHMS = ("sha512", "sha384", "sha256", "sha1", "md5")  # strongest first
+    BLOCK_SIZE = 2**20
+
+    def __init__(self, checksum):
+        self.expected = self.parse(checksum)
+        self._hashes = {algorithm: hashlib.new(algorithm) for algorithm in self.expected}
+
+    def reset(self):
+        """Forget the content hashed so far"""
+        self._hashes = {algorithm: hashlib.new(algorithm) for algorithm in self.expected}
+
+    @classmethod
+    def parse(cls, checksum):
+        """Return a dict of algorithm: expected hexadecimal digest for checksum"""
+        if not checksum:
+            return {}
+        if isinstance(checksum, str):
+            checksum = (checksum,)
+        digests = {}
+        for digest in checksum:
+            algorithm, sep, value = digest.rpartition(":")
+            algorithm = algorithm.lower() if sep else "md5"
+            if algorithm not in cls.ALGORITHMS:
+                raise(BaseException("Unsupported checksum type: {}".format(algorithm)))
+            digests[algorithm] = value.lower()
+        return digests
+
+    def strongest(self):
+        """Return the (algorithm, expected hexadecimal digest) tuple of the strongest digest, None if there is none"""
+        for algorithm in self.ALGORITHMS:
+            if algorithm in self.expected:
+                return (algorithm, self.expected[algorithm])
+        return None
+
+    def update(self, data):
+        """Hash next chunk of the content"""
+        for hash_object in self._hashes.values():
+            hash_object.update(data)
+
+    def update_from_file(self, f, start=0, end=None):
+        """Hash start-end bytes range (end exclusive, until end of file if None) of the file object f"""
+        if not self._hashes:
+            return
+        offset = start
+        while end is None or offset < end:
+            size = self.BLOCK_SIZE if end is None else min(self.BLOCK_SIZE, end - offset)
+            data = os.pread(f.fileno(), size, offset)
+            if not data:
+                break
+            self.update(data)
+            offset += len(data)
+
+    def hexdigests(self):
+        """Return a dict of algorithm: computed hexadecimal digest"""
+        return {algorithm: hash_object.hexdigest() for (algorithm, hash_object) in self._hashes.items()}
+
+    def mismatches(self):
+        """Return the list of algorithms whose digest doesn't match the expected one"""
+        computed = self.hexdigests()
+        return [algorithm for algorithm in self.ALGORITHMS
+                if algorithm in self.expected and computed[algorithm] != self.expected[algorithm]]
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering local caches of downloaded archives and pages"""
+
+from contextlib import suppress
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from udtc.network.checksum import Checksum
+from udtc.tools import ConfigHandler, Singleton, get_cache_path, get_temporary_file_from
+import yaml
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadCache(object, metaclass=Singleton):
+    """Content addressed cache of downloaded archives, bounded in size by evicting least recently used ones.
+
+    Archives are keyed by their strongest known digest, by their url and server validator otherwise. The maximum size
+    and cache path can be set in the "cache" section of the configuration (max_size, in bytes, and path)."""
+
+    DEFAULT_MAX_SIZE = 1024*1024*1024*4
+    STATS_FILENAME = "stats"
+    KEY_PREFIXES = tuple("{}-".format(algorithm) for algorithm in Checksum.ALGORITHMS) + ("url-",)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        try:
+            return ConfigHandler().config["cache"]["path"]
+        except (TypeError, KeyError):
+            return get_cache_path("archives")
+
+    @property
+    def max_size(self):
+        try:
+            return int(ConfigHandler().config["cache"]["max_size"])
+        except (TypeError, KeyError, ValueError):
+            return self.DEFAULT_MAX_SIZE
+
+    @staticmethod
+    def key_for(url, digest=None, validator=None):
+        """Return the cache key for an archive, None if we can't identify it
+
+        digest is an (algorithm, hexadecimal digest) tuple"""
+        if digest:
+            return "{}-{}".format(digest[0], digest[1].lower())
+        if validator:
+            return "url-{}".format(hashlib.sha1("{}\n{}".format(url, validator).encode()).hexdigest())
+        return None
+
+    def get(self, key, suffix=""):
+        """Return a temporary file with the cached content for key, None if it's not in the cache
+
+        The temporary file is a hard link of the cached archive (deleting it doesn't affect the cache)"""
+        blob_path = os.path.join(self.path, key)
+        try:
+            # mark as recently used
+            os.utime(blob_path)
+            result = get_temporary_file_from(blob_path, suffix=suffix, link=True)
+        except FileNotFoundError:
+            logger.debug("{} isn't in the download cache".format(key))
+            self._record("misses")
+            return None
+        except OSError as e:
+            logger.warning("Can't use {} from the download cache: {}".format(key, e))
+            self._record("misses")
+            return None
+        logger.info("Found {} in the download cache".format(key))
+        self._record("hits")
+        return result
+
+    def add(self, key, path):
+        """Add path content to the cache as key, then evict old entries if we are over the size budget"""
+        blob_path = os.path.join(self.path, key)
+        temp_path = blob_path + ".new"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with suppress(FileNotFoundError):
+                os.remove(temp_path)
+            try:
+                os.link(path, temp_path)
+            except OSError:
+                # different file systems or no hard link support
+                shutil.copyfile(path, temp_path)
+            os.replace(temp_path, blob_path)
+        except OSError as e:
+            logger.warning("Couldn't add {} to the download cache: {}".format(key, e))
+            return
+        logger.debug("Added {} to the download cache".format(key))
+        self.evict()
+
+    def remove(self, key):
+        """Remove key from the cache, if it's there"""
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(self.path, key))
+        logger.debug("Removed {} from the download cache".format(key))
+
+    def entries(self):
+        """Return the list of (path, size, last use) of cached archives, least recently used first"""
+        entries = []
+        with suppress(FileNotFoundError):
+            for filename in os.listdir(self.path):
+                if not filename.startswith(self.KEY_PREFIXES) or filename.endswith(".new"):
+                    continue
+                path = os.path.join(self.path, filename)
+                with suppress(FileNotFoundError):
+                    stat = os.stat(path)
+                    entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, max_size=None):
+        """Remove least recently used archives until the cache fits in max_size (default to the configured one)
+
+        Return the number of bytes reclaimed"""
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        total_size = sum(size for (path, size, last_use) in entries)
+        reclaimed = 0
+        for (path, size, last_use) in entries:
+            if total_size - reclaimed <= max_size:
+                break
+            logger.info("Evicting {} from the download cache".format(path))
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            reclaimed += size
+        return reclaimed
+
+    def stats(self):
+        """Return a dict of cache statistics: number of entries, size, maximum size, hits and misses"""
+        entries = self.entries()
+        stats = {"entries": len(entries), "size": sum(size for (path, size, last_use) in entries),
+                 "max_size": self.max_size, "hits": 0, "misses": 0}
+        stats.update(self._load_counters())
+        return stats
+
+    def _load_counters(self):
+        try:
+            with open(os.path.join(self.path, self.STATS_FILENAME)) as f:
+                counters = yaml.safe_load(f)
+        except (FileNotFoundError, yaml.YAMLError):
+            counters = None
+        return counters if isinstance(counters, dict) else {}
+
+    def _record(self, counter):
+        """Increment counter in the persistent statistics"""
+        with self._lock:
+            counters = self._load_counters()
+            counters[counter] = counters.get(counter, 0) + 1
+            with suppress(OSError):
+                os.makedirs(self.path, exist_ok=True)
+                with open(os.path.join(self.path, self.STATS_FILENAME), 'w') as f:
+                    yaml.dump(counters, f, default_flow_style=False)
+
+
+class PageCache(object, metaclass=Singleton):
+    """Cache of downloaded pages with their server validators, to revalidate them with conditional requests.
+
+    A cached page younger than max_age seconds (set as pages_max_age in the "cache" section of the configuration)
+    is reused without any request to the server."""
+
+    DEFAULT_MAX_AGE = 0
+
+    @property
+    def path(self):
+        return get_cache_path("pages")
+
+    @property
+    def max_age(self):
+        try:
+            return int(ConfigHandler().config["cache"]["pages_max_age"])
+        except (TypeError, KeyError, ValueError):
+            return self.DEFAULT_MAX_AGE
+
+    def _paths_for(self, url):
+        """Return content and state paths for url"""
+        content_path = os.path.join(self.path, hashlib.sha1(url.encode()).hexdigest())
+        return (content_path, content_path + ".state")
+
+    def _load_state(self, url):
+        content_path, state_path = self._paths_for(url)
+        try:
+            with open(state_path) as f:
+                state = yaml.safe_load(f)
+        except (FileNotFoundError, yaml.YAMLError):
+            return None
+        if not isinstance(state, dict) or state.get("url") != url or not os.path.isfile(content_path):
+            return None
+        return state
+
+    def open_fresh(self, url):
+        """Return a file object of the cached content for url if it's younger than max_age, None otherwise"""
+        state = self._load_state(url)
+        if state is None or time.time() - state.get("time", 0) > self.max_age:
+            return None
+        logger.info("Using cached page for {}".format(url))
+        return self.open(url)
+
+    def open(self, url):
+        """Return a file object of the cached content for url, None if there is none"""
+        try:
+            return open(self._paths_for(url)[0], 'rb')
+        except FileNotFoundError:
+            return None
+
+    def conditional_headers(self, url):
+        """Return the headers to revalidate our cached version of url"""
+        state = self._load_state(url)
+        headers = {}
+        if state is None:
+            return headers
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        return headers
+
+    def refresh(self, url):
+        """Mark cached version of url as revalidated now"""
+        state = self._load_state(url)
+        if state is not None:
+            state["time"] = time.time()
+            self._save_state(url, state)
+
+    def add(self, url, headers, content):
+        """Cache content for url, with the response validators in headers
+
+        content is either bytes or a file object, copied from its start."""
+        content_path, state_path = self._paths_for(url)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(content_path, 'wb') as f:
+                if isinstance(content, bytes):
+                    f.write(content)
+                else:
+                    content.seek(0)
+                    shutil.copyfileobj(content, f)
+        except OSError as e:
+            logger.warning("Couldn't cache {}: {}".format(url, e))
+            return
+        self._save_state(url, {"url": url, "etag": headers.get("etag"), "last_modified": headers.get("last-modified"),
+                               "time": time.time()})
+
+    def _save_state(self, url, state):
+        with suppress(OSError):
+            with open(self._paths_for(url)[1], 'w') as f:
+                yaml.dump(state, f, default_flow_style=False)
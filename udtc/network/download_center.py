@@ -19,43 +19,224 @@
 
 """Module delivering a DownloadCenter to download in parallel multiple requests"""
 
+import asyncio
 from collections import namedtuple
-from concurrent import futures
 from contextlib import suppress, closing
+from functools import partial
 import hashlib
-from io import BytesIO
 import logging
 import os
+import random
+import shutil
 import tempfile
+import threading
+from time import monotonic
+from urllib.parse import urlparse
+from urllib.request import pathname2url, url2pathname
 
-import requests
 import requests.exceptions
+import urllib3.exceptions
+from udtc.network.async_engine import AsyncDownloadEngine
+from udtc.network.bandwidth import BandwidthLimiter
+from udtc.network.checksum import Checksum
+from udtc.network.download_cache import DownloadCache, PageCache
+from udtc.network.mirrors import DownloadStalled, MirrorSelector, MirrorTooSlow, ThroughputMonitor
+from udtc.network.progress import ProgressAggregator, ProgressSnapshot
+from udtc.network.scheduler import DownloadScheduler
+from udtc.network.session import SessionManager
+from udtc.network.single_flight import InFlightDownloads
+from udtc.network.telemetry import MetricsRecorder, append_metrics
+from udtc.settings import UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE
+from udtc.tools import ConfigHandler, get_cache_path, get_temporary_file_from, preallocate
+import yaml
 
 
 logger = logging.getLogger(__name__)
 
 
+class SpooledBuffer(tempfile.SpooledTemporaryFile):
+    """Binary buffer kept in memory up to max_size bytes, moving to a temporary file beyond"""
+
+    def getvalue(self):
+        """Return the whole content, as BytesIO does"""
+        position = self.tell()
+        self.seek(0)
+        content = self.read()
+        self.seek(position)
+        return content
+
+
+class TransientDownloadError(BaseException):
+    """Raised on a download error which may not happen again, like a server overload"""
+    pass
+
+
+class DownloadCancelled(BaseException):
+    """Raised in a download stopped by DownloadCenter.cancel()"""
+    pass
+
+
+class SinkFeed:
+    """Feed a download sink the content once and in order, across download attempts and from any copy of it
+
+    written is the number of bytes the sink got so far."""
+
+    BLOCK_SIZE = 1024*1024
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.written = 0
+
+    def feed(self, data, offset):
+        """Feed data, found at offset of the content, skipping the bytes the sink already got"""
+        end = offset + len(data)
+        if end <= self.written:
+            return
+        if offset > self.written:
+            raise(BaseException("Missing content between bytes {} and {} for the sink".format(self.written, offset)))
+        with memoryview(data) as view:
+            self.sink.write(view[self.written - offset:])
+        self.written = end
+
+    def catch_up(self, f, end):
+        """Feed the sink the content of the file object f it didn't get yet, up to end"""
+        while self.written < end:
+            data = os.pread(f.fileno(), min(self.BLOCK_SIZE, end - self.written), self.written)
+            if not data:
+                raise(BaseException("Content ended at byte {} instead of {}".format(self.written, end)))
+            self.feed(data, self.written)
+
+
+class TeeFile:
+    """File object writing the content both to a file and to a SinkFeed, from offset"""
+
+    def __init__(self, f, feed, offset):
+        self._file = f
+        self._feed = feed
+        self._offset = offset
+
+    def write(self, data):
+        self._file.write(data)
+        self._feed.feed(data, self._offset)
+        self._offset += len(data)
+
+    def fileno(self):
+        return self._file.fileno()
+
+
+class Segment:
+    """Inclusive start-end bytes range of a segmented download, next being its first byte still to download"""
+
+    def __init__(self, start, next, end):
+        self.start = start
+        self.next = next
+        self.end = end
+
+    @property
+    def done(self):
+        return self.next > self.end
+
+    def __repr__(self):
+        return "Segment({}, {}, {})".format(self.start, self.next, self.end)
+
+
+class ChunkSizer:
+    """Size of the next read of a download, adapted to its throughput.
+
+    Reads start at min_size bytes. The size doubles while reading a chunk and processing it take less than
+    TARGET_TIME, and halves when they take more than twice that, within [min_size, max_size]: fast downloads are read
+    in few big chunks, sparing per chunk overhead, slow ones in small chunks, keeping their progress smooth."""
+
+    TARGET_TIME = 0.05  # seconds
+
+    def __init__(self, min_size, max_size):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min_size
+        self._last = monotonic()
+
+    def update(self):
+        """Adapt the size to the time spent on the last chunk, since the previous update"""
+        now = monotonic()
+        elapsed = now - self._last
+        self._last = now
+        if elapsed < self.TARGET_TIME:
+            self.size = min(self.size * 2, self.max_size)
+        elif elapsed > self.TARGET_TIME * 2:
+            self.size = max(self.size // 2, self.min_size)
+
+
 class DownloadCenter:
-    """A DownloadCenter enables to read or download requested urls in separate threads."""
+    """A DownloadCenter enables to read or download requested urls in separate threads.
 
-    BLOCK_SIZE = 1024*8  # from urlretrieve code
-    DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd"])
+    Downloads are run by the process wide DownloadScheduler, or on the event loop of the AsyncDownloadEngine
+    (see engine()). Their bandwidth is bounded by the process wide BandwidthLimiter.
+    The DownloadCenter is the handle of its downloads: they can be paused, resumed or cancelled while in flight."""
 
-    def __init__(self, urls, on_done, download=True, report=lambda x: None):
+    BLOCK_SIZE = 1024*8  # from urlretrieve code, first read size of a download
+    MAX_BLOCK_SIZE = 1024*1024*4  # read size of the fastest downloads, see ChunkSizer
+    SEGMENTS = 4  # number of ranges fetched in parallel for a big download
+    SEGMENT_MIN_SIZE = 1024*1024*8  # don't split smaller downloads than this
+    SEGMENT_STATE_INTERVAL = 1  # seconds between saves of the progress of segments, to resume them
+    DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd", "metrics"])
+    DownloadResult.__new__.__defaults__ = (None,)  # metrics are optional
+    ENGINES = ("threads", "asyncio")
+    DEFAULT_ENGINE = "threads"
+    DEFAULT_MEMORY_BUFFER_SIZE = 1024*1024*8  # in memory downloads bigger than this spill to disk
+    DEFAULT_REPORT_INTERVAL = 0.1  # seconds between progress reports of a download
+    DEFAULT_REPORT_STEP = 1  # percentage of a download between its progress reports
+    PAUSE_POLL_INTERVAL = 0.1  # seconds between checks of paused downloads on the event loop
+    CONNECT_TIMEOUT = 15  # seconds
+    READ_TIMEOUT = 30  # seconds without receiving any byte
+    MIN_THROUGHPUT = 1024  # bytes per second, under which a download is stalled
+    MAX_RETRIES = 3  # per mirror, on transient errors
+    BACKOFF_BASE = 1  # seconds, doubled on each retry
+    BACKOFF_MAX = 30  # seconds
+    TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+    TRANSIENT_EXCEPTIONS = (TransientDownloadError, DownloadStalled, requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+    # connection errors which would fail again
+    PERMANENT_EXCEPTIONS = (requests.exceptions.SSLError,)
+
+    def __init__(self, urls, on_done, download=True, report=lambda x: None, stream_to=None, staging_dir=None,
+                 priority=None):
         """Generate a threaded download machine.
-        urls is a list of tuples of (url, md5) to download or read from. The md5sum can be empty, no check will be done.
+        urls is a list of tuples of (url, checksum) to download or read from. The checksum can be empty, no check will
+        be done. It's either a md5sum, a typed digest like "sha256:<hexdigest>" or a tuple of typed digests.
+        url can be a tuple of equivalent mirror urls of the same content: the fastest one is used, failing over to the
+        next ones on error or if its throughput collapses. Results, progress and stream_to are keyed by the first one.
+        file:// urls are supported, and urls are rewritten to local directories or internal mirrors first (see
+        rewrite()). Local files are tried before any remote mirror, and hard linked (or copied in kernel) to the
+        temporary file.
         on_done is the callback that will be called once all those urls are downloaded.
-        md5s is the list like url of md5sum in the same order, if exists
         report, if not None, will be called once any download is in progress, reporting
-        a dict of current download with current/size parameters
+        a dict of current download with current/size parameters. Once a download was retried, it has retries and
+        wasted (number of bytes downloaded again) parameters too. Progress of each download is coalesced (see
+        report_granularity()), and each report gets a new snapshot dict, never modified afterwards. It's a
+        ProgressSnapshot: its totals attribute is the overall progress of all downloads, also available at any time
+        from the progress attribute, a ProgressAggregator.
+        stream_to is an optional dict of url: sink, to write those urls content to the sink while downloading. A sink
+        has write(data), where data is bytes or a memoryview only valid during the call, finish() once the content is
+        complete and verified, and abort() on any error. The result fd for those is None. Downloads to file are still
+        written to file as they are streamed, to be resumed and cached. In memory downloads aren't: their sink can
+        have a complete attribute, set once it doesn't need more content, and the download stops there without
+        checking its checksum.
+        staging_dir is an optional directory where downloads to file are written (as hidden files), instead of the
+        default temporary directory and the user cache. Set it on the filesystem the content will be installed on
+        to avoid copying it between filesystems. It's ignored if it isn't writable.
+        priority is the DownloadScheduler priority class of those downloads (PRIORITY_METADATA, PRIORITY_ARCHIVE or
+        PRIORITY_PREFETCH). It defaults to metadata for in memory downloads, and to archive for downloads to file.
+        The asyncio engine doesn't use it, as it has no worker to share.
 
         The callback will get a dictionary parameter like:
         {
             "url":
-                DownloadResult(buffer=page content as bytes if download is set to False. close() will clean it from
-                                      memory,
+                DownloadResult(buffer=page content if download is set to False, as a file object kept in memory up to
+                                      the memory buffer size (see memory_buffer_size()). close() will clean it,
                                error=string detailing the error which occurred (path and content would be empty),
-                               fd=temporary file descriptor. close() will delete it from disk
+                               fd=temporary file descriptor. close() will delete it from disk,
+                               metrics=DownloadMetrics of the download, see MetricsRecorder. They are appended as a
+                                       JSON line to the metrics file if set (see telemetry.metrics_file())
                 )
         }
         """
@@ -63,94 +244,1173 @@ class DownloadCenter:
         self._done_callback = on_done
         self._wired_report = report
         self._download_to_file = download
+        self._stream_to = stream_to or {}
+        self._staging_dir = staging_dir if staging_dir and os.access(staging_dir, os.W_OK) else None
+        if priority is None:
+            priority = DownloadScheduler.PRIORITY_ARCHIVE if download else DownloadScheduler.PRIORITY_METADATA
+        self._priority = priority
 
         self._urls = list(set(urls))
         self._downloaded_content = {}
 
         self._download_progress = {}
+        self.progress = ProgressAggregator()
+        self._progress_lock = threading.Lock()
+        self._last_reports = {}
+        self._retry_stats = {}
+        self._metrics = {}
+        self._cancelled = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        # cancellation and resume Events of the download run by the current thread, see _cancel_event()
+        self._local = threading.local()
+        self._shared = []
 
-        executor = futures.ThreadPoolExecutor(max_workers=3)
+        # sinks can block, so they are always fed from a thread
+        use_asyncio = self.engine() == "asyncio"
         for url_request in self._urls:
-            url, md5sum = (url_request, None)
-            # grab the md5sum if any
+            url, checksum = (url_request, None)
+            # grab the checksum if any
             with suppress(ValueError):
-                (url, md5sum) = url_request
-            # switch between inline memory and temp file
+                (url, checksum) = url_request
+            mirrors = (url,) if isinstance(url, str) else tuple(url)
+            url = mirrors[0]
+            mirrors = tuple(self.rewrite(mirror) for mirror in mirrors)
             if download:
-                # Named because shutils and tarfile library needs a .name property
-                # http://bugs.python.org/issue21044
-                # also, ensure we keep the same suffix
-                path, ext = os.path.splitext(url)
-                dest = tempfile.NamedTemporaryFile(suffix=ext)
                 logger.info("Start downloading {} as a temporary file".format(url))
             else:
-                dest = BytesIO()
                 logger.info("Start downloading {} in memory".format(url))
-            future = executor.submit(self._fetch, url, md5sum, dest)
+            start = partial(self._start, url, checksum, mirrors, use_asyncio)
+            self._metrics[url] = MetricsRecorder(url)
+            report = self._metrics[url].report(self._reporter(url))
+            if url in self._stream_to:
+                future = start(report)
+            else:
+                # share the transfer with identical requests in flight
+                future = InFlightDownloads().submit((url, checksum, download), start, self._share, report)
+                self._shared.append(future)
             future.tag_url = url
             future.tag_download = download
-            future.tag_dest = dest
             future.add_done_callback(self._one_done)
 
-    def _fetch(self, url, md5sum, dest):
-        """Get an url content and close the connexion.
+    def cancel(self):
+        """Stop the downloads as soon as possible
 
-        This write the content to dest return it, after seeking at start and check for md5sum
-        """
+        Queued ones don't start and running ones stop at their next chunk, failing with a "Download cancelled" error:
+        sinks are aborted, and partial downloads to file are kept in the user cache to be resumed later. on_done is
+        still called once all are done. Downloads sharing their transfer with identical requests of other
+        DownloadCenters fail right away, the transfer going on for those until they are cancelled too."""
+        self._cancelled.set()
+        self._resumed.set()
+        for future in self._shared:
+            InFlightDownloads().cancel(future, DownloadCancelled("Download cancelled"))
+        DownloadScheduler().wake()
+
+    def pause(self):
+        """Suspend the running downloads at their next chunk, until resume() or cancel()
+
+        Their connections are kept open. If a server closes one meanwhile, the download is resumed from the last good
+        byte as on any transient error. Queued downloads don't start, leaving the scheduler workers to others.
+        Downloads sharing their transfer with identical requests of other DownloadCenters go on until those are
+        paused too."""
+        self._resumed.clear()
+        for future in self._shared:
+            InFlightDownloads().pause(future)
+
+    def resume(self):
+        """Resume paused downloads"""
+        self._resumed.set()
+        for future in self._shared:
+            InFlightDownloads().resume(future)
+        DownloadScheduler().wake()
+
+    def _cancel_event(self):
+        """Return the Event set once the download run by the current thread is cancelled
+
+        That's the one of its transfer if it's shared with other requests (see InFlightDownloads), ours otherwise."""
+        return getattr(self._local, "cancelled", None) or self._cancelled
+
+    def _resumed_event(self):
+        """Return the Event cleared while the download run by the current thread is paused, see _cancel_event()"""
+        return getattr(self._local, "resumed", None) or self._resumed
 
-        def _report(block_no, block_size, total_size):
-            current_size = int(block_no * block_size)
+    def _checkpoint(self, monitor=None):
+        """Wait while the downloads are paused, then raise DownloadCancelled if they were cancelled
+
+        monitor, a ThroughputMonitor, doesn't count the pause if set."""
+        resumed = self._resumed_event()
+        if not resumed.is_set():
+            paused = monotonic()
+            resumed.wait()
+            if monitor:
+                monitor.exclude(monotonic() - paused)
+        if self._cancel_event().is_set():
+            raise(DownloadCancelled("Download cancelled"))
+
+    async def _async_checkpoint(self, cancelled=None, resumed=None):
+        """Asyncio engine version of _checkpoint, not blocking the event loop while paused
+
+        cancelled and resumed are the cancellation and resume Events of the download, ours if None."""
+        while not (resumed or self._resumed).is_set():
+            await asyncio.sleep(self.PAUSE_POLL_INTERVAL)
+        if (cancelled or self._cancelled).is_set():
+            raise(DownloadCancelled("Download cancelled"))
+
+    def _start(self, url, checksum, mirrors, use_asyncio, report, cancelled=None, resumed=None):
+        """Start the download of url and return its Future
+
+        cancelled and resumed are the cancellation and resume Events of its shared transfer, if any. The download
+        doesn't start while paused."""
+        # mirrors failover, local files and proxies are only handled by the threaded engine
+        if (use_asyncio and url not in self._stream_to and len(mirrors) == 1 and not self._is_local(mirrors[0]) and
+                not AsyncDownloadEngine.proxied(mirrors[0])):
+            return AsyncDownloadEngine().submit(self._async_fetch(url, checksum, report, cancelled, resumed))
+        return DownloadScheduler().submit(self._fetch, url, checksum, mirrors, report, cancelled, resumed, url=url,
+                                          priority=self._priority, ready=(resumed or self._resumed).is_set)
+
+    @classmethod
+    def _share(cls, content):
+        """Return a new handle on the downloaded content, for another request of the same download"""
+        if content is None:
+            return None
+        if isinstance(content, SpooledBuffer):
+            handle = SpooledBuffer(max_size=cls.memory_buffer_size())
+            content.seek(0)
+            shutil.copyfileobj(content, handle)
+            return handle
+        # a hard link next to the temporary file, which can be closed meanwhile
+        suffix = os.path.splitext(content.name)[1]
+        prefix = ".udtc-" if os.path.basename(content.name).startswith(".") else "tmp"
+        try:
+            return get_temporary_file_from(content.name, suffix=suffix, link=True, prefix=prefix)
+        except OSError:
+            handle = tempfile.NamedTemporaryFile(suffix=suffix)
+            content.seek(0)
+            shutil.copyfileobj(content, handle)
+            return handle
+
+    @classmethod
+    def engine(cls):
+        """Return the download engine to use: "threads" (default) or "asyncio"
+
+        It's set by the UDTC_DOWNLOAD_ENGINE environment variable, or as engine in the "network" section of the
+        configuration. Downloads through a proxy always use the threaded one."""
+        engine = os.environ.get(UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE)
+        if not engine:
+            try:
+                engine = ConfigHandler().config["network"]["engine"]
+            except (TypeError, KeyError):
+                engine = cls.DEFAULT_ENGINE
+        if engine not in cls.ENGINES:
+            logger.warning("Unknown download engine {}, using {}".format(engine, cls.DEFAULT_ENGINE))
+            engine = cls.DEFAULT_ENGINE
+        return engine
+
+    @classmethod
+    def memory_buffer_size(cls):
+        """Return the size above which in memory downloads are moved to a temporary file
+
+        It's set as memory_buffer_size in the "network" section of the configuration, in bytes."""
+        try:
+            return int(ConfigHandler().config["network"]["memory_buffer_size"])
+        except (TypeError, KeyError, ValueError):
+            return cls.DEFAULT_MEMORY_BUFFER_SIZE
+
+    @classmethod
+    def url_rewrites(cls):
+        """Return the dict of url prefix: replacement used to rewrite urls
+
+        It's set as url_rewrites in the "network" section of the configuration. A replacement is either the url of
+        an internal mirror, or a local directory (like a mounted mirror of archives)."""
+        try:
+            return ConfigHandler().config["network"]["url_rewrites"] or {}
+        except (TypeError, KeyError):
+            return {}
+
+    @classmethod
+    def rewrite(cls, url):
+        """Return url with its longest prefix in url_rewrites() replaced, url itself if none matches"""
+        rewrites = cls.url_rewrites()
+        for prefix in sorted(rewrites, key=len, reverse=True):
+            if url.startswith(prefix):
+                target = rewrites[prefix]
+                if "://" not in target:
+                    target = "file://" + pathname2url(os.path.abspath(os.path.expanduser(target)))
+                    if prefix.endswith("/"):
+                        target += "/"
+                rewritten = target + url[len(prefix):]
+                logger.debug("Rewriting {} to {}".format(url, rewritten))
+                return rewritten
+        return url
+
+    @staticmethod
+    def _is_local(url):
+        """Return if url is a local file"""
+        return urlparse(url).scheme == "file"
+
+    @staticmethod
+    def _local_path(url):
+        """Return the path of the local file url"""
+        return url2pathname(urlparse(url).path)
+
+    @classmethod
+    def report_granularity(cls):
+        """Return the (interval, step) tuple of the progress reports of a download
+
+        Progress is only reported once interval seconds elapsed and it moved by step percent since the last report
+        (if the download size is known). The first and last progress of a download are always reported. They are
+        set as report_interval and report_step in the "network" section of the configuration."""
+        granularity = []
+        for (key, default) in (("report_interval", cls.DEFAULT_REPORT_INTERVAL),
+                               ("report_step", cls.DEFAULT_REPORT_STEP)):
+            try:
+                granularity.append(float(ConfigHandler().config["network"][key]))
+            except (TypeError, KeyError, ValueError):
+                granularity.append(default)
+        return tuple(granularity)
+
+    def _temporary_prefix(self):
+        """Return the prefix of our temporary files, hidden in the staging directory"""
+        return ".udtc-" if self._staging_dir else "tmp"
+
+    def _temporary_file(self, suffix):
+        """Return a new named temporary file in the staging directory, or in the default temporary directory"""
+        return tempfile.NamedTemporaryFile(suffix=suffix, prefix=self._temporary_prefix(), dir=self._staging_dir)
+
+    def _memory_buffer(self):
+        """Return a new buffer for an in memory download"""
+        return SpooledBuffer(max_size=self.memory_buffer_size())
+
+    def _copy_from(self, source, dest, checksum, report, until=None, monitor=None):
+        """Copy and hash the source file object to dest, then close it and report it as downloaded
+
+        If until is set, we stop copying as soon as it returns True. monitor, a ThroughputMonitor, counts the copied
+        bytes if set.
+        The source is read into a reused buffer: dest gets views of it, only valid during its write() call."""
+        sizer = ChunkSizer(self.BLOCK_SIZE, self.MAX_BLOCK_SIZE)
+        buffer = memoryview(bytearray(sizer.size))
+        with source:
+            while True:
+                if len(buffer) < sizer.size:
+                    buffer = memoryview(bytearray(sizer.size))
+                read_size = source.readinto(buffer[:sizer.size])
+                if not read_size:
+                    break
+                self._checkpoint(monitor)
+                data = buffer[:read_size]
+                dest.write(data)
+                checksum.update(data)
+                if monitor:
+                    monitor.update(read_size)
+                if until is not None and until():
+                    break
+                sizer.update()
+            size = source.tell()
+        report(size, size)
+
+    def _reporter(self, url):
+        """Return the report function for url download progress, coalescing it to the report granularity"""
+        (interval, step) = self.report_granularity()
+
+        def _report(current_size, total_size):
             if total_size != -1:
                 current_size = min(current_size, total_size)
-            self._download_progress[url] = {"current": current_size, "size": total_size}
-            logger.debug("Deliver download update: {} of {}".format(self._download_progress, total_size))
-            self._wired_report(self._download_progress)
+            progress = {"current": current_size, "size": total_size}
+            stats = self._retry_stats.get(url)
+            if stats:
+                if stats["restarting"]:
+                    # the first report of an attempt is where it restarts from
+                    stats["wasted"] += max(stats["reached"] - current_size, 0)
+                    stats["restarting"] = False
+                progress.update(retries=stats["retries"], wasted=stats["wasted"])
+            now = monotonic()
+            with self._progress_lock:
+                self._download_progress[url] = progress
+                self.progress.update(url, current_size, total_size)
+                last_report = self._last_reports.get(url)
+                if last_report is not None and current_size != total_size:
+                    (last_time, last_size) = last_report
+                    if now - last_time < interval:
+                        return
+                    if total_size > 0 and abs(current_size - last_size) * 100 < step * total_size:
+                        return
+                self._deliver_progress(url, now)
+        return _report
 
-        # Requests support redirection out of the box.
+    def _deliver_progress(self, url, now):
+        """Report a snapshot of all downloads progress, as url is reported at now. This must be called with the
+        progress lock held"""
+        self._last_reports[url] = (now, self._download_progress[url]["current"])
+        snapshot = ProgressSnapshot(self._download_progress, self.progress.totals())
+        logger.debug("Deliver download update: {}".format(snapshot))
+        self._wired_report(snapshot)
+
+    def _flush_progress(self, url):
+        """Report the last progress of url, if it was coalesced"""
+        with self._progress_lock:
+            progress = self._download_progress.get(url)
+            last_report = self._last_reports.get(url)
+            if progress is not None and (last_report is None or last_report[1] != progress["current"]):
+                self._deliver_progress(url, monotonic())
+
+    def _begin(self, url):
+        """Mark the start of the download of url in its metrics"""
+        with suppress(KeyError):
+            self._metrics[url].begin()
+
+    def _fetch(self, url, checksum, mirrors=None, report=None, cancelled=None, resumed=None):
+        """Get an url content and close the connexion.
+
+        Return a file object with that content (temporary file or memory one depending on download) after checking
+        the checksum, computed while downloading. An interrupted download to file is resumed on next attempt.
+        mirrors is the tuple of equivalent urls to download url from, url itself if None.
+        report is the progress report function, the one of url if None.
+        cancelled and resumed are the cancellation and resume Events of the download if it's a shared transfer, ours
+        if None.
+        """
+        self._local.cancelled = cancelled
+        self._local.resumed = resumed
+        sink = self._stream_to.get(url)
         try:
-            with closing(requests.get(url, stream=True)) as r:
-                if r.status_code != 200:
-                    raise(BaseException("Can't download ({}): {}".format(r.status_code, r.reason)))
-                content_size = int(r.headers.get('content-length', -1))
+            self._checkpoint()
+        except:
+            # cancelled while queued
+            if sink is not None:
+                sink.abort()
+            raise
+        self._begin(url)
+        _report = report or self._reporter(url)
+        checksum = Checksum(checksum)
+        # local files are always the fastest
+        mirrors = mirrors or (url,)
+        local_mirrors = [mirror for mirror in mirrors if self._is_local(mirror)]
+        mirrors = local_mirrors + MirrorSelector().order([mirror for mirror in mirrors if not self._is_local(mirror)])
+        if sink is not None and not self._download_to_file:
+            try:
+                self._fetch_to_sink(url, checksum, sink, _report, mirrors)
+                if not self._sink_complete(sink):
+                    self._verify(url, checksum)
+                sink.finish()
+            except:
+                sink.abort()
+                raise
+            return None
+        if sink is not None:
+            # content streamed to a sink is still cached and resumable: the sink is fed as it's written to file
+            feed = SinkFeed(sink)
+            try:
+                dest = self._fetch_file(url, checksum, mirrors, _report, feed)
+                with dest:
+                    feed.catch_up(dest, os.fstat(dest.fileno()).st_size)
+                sink.finish()
+            except:
+                sink.abort()
+                raise
+            return None
+
+        if self._download_to_file:
+            return self._fetch_file(url, checksum, mirrors, _report)
+
+        def fetch_page(mirror, monitor):
+            checksum.reset()
+            return self._fetch_page(mirror, checksum, _report)
+
+        dest = self._from_mirrors(url, mirrors, fetch_page)
+        return self._complete(url, dest, checksum, None)
+
+    def _fetch_file(self, url, checksum, mirrors, report, feed=None):
+        """Download url from the first working of its mirrors to a verified temporary file, added to the download
+        cache, and return it
+
+        feed is an optional SinkFeed, fed the content as it's written to file."""
+        def fetch_to_file(mirror, monitor):
+            # a new attempt hashes the content from the start
+            checksum.reset()
+            return self._fetch_to_file(url, checksum, report, mirror, monitor, feed)
+
+        (dest, cache_key) = self._from_mirrors(url, mirrors, fetch_to_file)
+        return self._complete(url, dest, checksum, cache_key)
 
-                # read in chunk and send report updates
-                block_num = 0
-                _report(block_num, self.BLOCK_SIZE, content_size)
-                for data in r.iter_content(chunk_size=self.BLOCK_SIZE):
-                    dest.write(data)
-                    block_num += 1
-                    _report(block_num, self.BLOCK_SIZE, content_size)
+    def _from_mirrors(self, url, mirrors, fetch):
+        """Return fetch(mirror, monitor) for the first of url mirrors which succeeds.
+
+        Transient errors (timeouts, dropped connections, server overload, stalled downloads) are retried up to
+        MAX_RETRIES times after a jittered exponential backoff. Downloads to file and to a sink resume from the last
+        good byte then.
+        The next mirror is tried if the download fails or if its throughput collapses, as measured by monitor, a
+        ThroughputMonitor. The throughput of each mirror is recorded to order them on next downloads."""
+        min_throughput = self.MIN_THROUGHPUT
+        limiter = BandwidthLimiter()
+        if limiter.rate() or any(limiter.rate(urlparse(mirror).hostname) for mirror in mirrors):
+            # we can't tell a stalled download from a throttled one
+            min_throughput = None
+        for (i, mirror) in enumerate(mirrors):
+            last = i == len(mirrors) - 1
+            measured = len(mirrors) > 1 and not self._is_local(mirror)
+            retries = 0
+            while True:
+                monitor = ThroughputMonitor(mirror, failover=not last, min_throughput=min_throughput)
+                error = None
+                try:
+                    result = fetch(mirror, monitor)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except BaseException as e:
+                    error = e
+                if isinstance(error, DownloadCancelled):
+                    raise error
+                if error is None or retries >= self.MAX_RETRIES or not self._is_transient(error):
+                    break
+                retries += 1
+                delay = random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** retries))
+                logger.warning("Download from {} failed ({}), retrying in {:.1f}s".format(mirror, error, delay))
+                self._retried(url)
+                # cancel() ends the backoff
+                self._cancel_event().wait(delay)
+                self._checkpoint()
+            if error is None:
+                # nothing to measure if the content was in cache
+                if measured and monitor.size:
+                    MirrorSelector().record(mirror, monitor.throughput())
+                return result
+            if measured:
+                MirrorSelector().record(mirror, monitor.throughput() if isinstance(error, MirrorTooSlow) else 0)
+            if last:
+                raise error
+            logger.warning("Download from {} failed ({}), trying {}".format(mirror, error, mirrors[i + 1]))
+
+    def _is_transient(self, error):
+        """Return if error is worth retrying the download"""
+        return isinstance(error, self.TRANSIENT_EXCEPTIONS) and not isinstance(error, self.PERMANENT_EXCEPTIONS)
+
+    def _retried(self, url):
+        """Count a new attempt to download url, and how far the previous one went"""
+        stats = self._retry_stats.setdefault(url, {"retries": 0, "wasted": 0})
+        stats["retries"] += 1
+        stats["reached"] = self._download_progress.get(url, {}).get("current", 0)
+        stats["restarting"] = True
+
+    async def _async_fetch(self, url, checksum, report=None, cancelled=None, resumed=None):
+        """Asyncio engine version of _fetch, running on the event loop thread.
+
+        The content is fetched with a single request: downloads to file aren't resumed nor segmented, but the
+        download and page caches are used. Their disk work (lookups, hashing of cached content, additions) runs in
+        the default executor, not to block the event loop."""
+        await self._async_checkpoint(cancelled, resumed)
+        self._begin(url)
+        report = report or self._reporter(url)
+        checksum = Checksum(checksum)
+        engine = AsyncDownloadEngine()
+        run = partial(self._in_executor, cancelled, resumed)
+        cache_key = None
+        if self._download_to_file:
+            path, ext = os.path.splitext(url)
+            cache_key = DownloadCache.key_for(url, digest=checksum.strongest())
+            dest = await run(self._get_from_cache, cache_key, ext, checksum, report) if cache_key else None
+            if dest:
+                cache_key = None
+            else:
+                r = await engine.get(url)
+                try:
+                    if r.status_code != 200:
+                        raise(self._download_error(r))
+                    if not cache_key:
+                        cache_key = DownloadCache.key_for(url, validator=self._validator(r))
+                        dest = await run(self._get_from_cache, cache_key, ext, checksum, report) if cache_key else None
+                    if dest:
+                        cache_key = None
+                    else:
+                        dest = await run(self._temporary_file, ext)
+                        try:
+                            content_size = int(r.headers.get('content-length', -1))
+                            if content_size > 0:
+                                await run(preallocate, dest.fileno(), content_size)
+                            await self._async_write_stream(r, dest, checksum, report, cancelled, resumed)
+                        except:
+                            dest.close()
+                            raise
+                finally:
+                    r.close()
+        else:
+            cache = PageCache()
+            cached = await run(cache.open_fresh, url)
+            if cached is None:
+                r = await engine.get(url, await run(cache.conditional_headers, url))
+                try:
+                    if r.status_code == 304:
+                        logger.debug("{} not modified since cached".format(url))
+                        cached = await run(cache.open, url)
+                        if cached is None:
+                            raise(BaseException("Cached version of {} vanished".format(url)))
+                        await run(cache.refresh, url)
+                    elif r.status_code == 200:
+                        dest = self._memory_buffer()
+                        await self._async_write_stream(r, dest, checksum, report, cancelled, resumed)
+                        await run(cache.add, url, r.headers, dest)
+                    else:
+                        raise(self._download_error(r))
+                finally:
+                    r.close()
+            if cached is not None:
+                dest = self._memory_buffer()
+                await run(self._copy_from, cached, dest, checksum, report)
+        return await run(self._complete, url, dest, checksum, cache_key)
+
+    async def _in_executor(self, cancelled, resumed, fn, *args):
+        """Return fn(*args), run in the default executor of the event loop as it's blocking
+
+        cancelled and resumed are the cancellation and resume Events of the download fn is part of, ours if None."""
+        def run():
+            self._local.cancelled = cancelled
+            self._local.resumed = resumed
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, run)
+
+    def _complete(self, url, dest, checksum, cache_key):
+        """Verify the downloaded content of url in dest and add it to the download cache as cache_key if any"""
+        try:
+            self._verify(url, checksum)
+        except:
+            # cleaned unusable temp file as something bad happened
+            dest.close()
+            raise
+        if cache_key:
+            DownloadCache().add(cache_key, dest.name)
+        return dest
+
+    def _verify(self, url, checksum):
+        """Raise if the downloaded content of url doesn't match its expected checksum"""
+        if checksum.expected:
+            logger.debug("Checking {}".format(", ".join(checksum.expected)))
+            mismatches = checksum.mismatches()
+            if mismatches:
+                raise(BaseException("The {} of {} doesn't match. Corrupted download? Aborting.".format(
+                    ", ".join(mismatches), url)))
+
+    def _download_error(self, response, message=None):
+        """Return the exception to raise for an unexpected response status, TransientDownloadError if it's worth
+        retrying"""
+        if message is None:
+            message = "Can't download ({}): {}".format(response.status_code, response.reason)
+        if response.status_code in self.TRANSIENT_STATUS_CODES:
+            return TransientDownloadError(message)
+        return BaseException(message)
+
+    def _get(self, url, headers=None):
+        """Open a streamed request on url, using the process wide connection pool"""
+        # Requests support redirection out of the box.
+        try:
+            return SessionManager().get(url, headers=headers, stream=True,
+                                        timeout=(self.CONNECT_TIMEOUT, self.READ_TIMEOUT))
         except requests.exceptions.InvalidSchema as exc:
             # Wrap this for a nicer error message.
             raise BaseException("Protocol not supported.") from exc
 
-        if md5sum:
-            logger.debug("Checking md5sum")
-            dest.seek(0)
-            if md5sum != self._md5_for_fd(dest):
-                raise(BaseException("The md5 of {} doesn't match. Corrupted download? Aborting.".format(url)))
+    def _fetch_page(self, url, checksum, report):
+        """Download url in memory and return it.
+
+        Pages are cached on disk with their server validators. The cached version is used if it's recent enough,
+        or if the server tells it's not modified (conditional request). Local files aren't cached."""
+        if self._is_local(url):
+            dest = self._memory_buffer()
+            self._copy_from(open(self._local_path(url), 'rb'), dest, checksum, report)
+            return dest
+        cache = PageCache()
+        cached = cache.open_fresh(url)
+        if cached is None:
+            with closing(self._get(url, cache.conditional_headers(url))) as r:
+                if r.status_code == 304:
+                    logger.debug("{} not modified since cached".format(url))
+                    cached = cache.open(url)
+                    cache.refresh(url)
+                elif r.status_code == 200:
+                    dest = self._memory_buffer()
+                    try:
+                        self._write_stream(r, dest, 0, int(r.headers.get('content-length', -1)), checksum, report)
+                    except:
+                        dest.close()
+                        raise
+                    cache.add(url, r.headers, dest)
+                    return dest
+                else:
+                    raise(self._download_error(r))
+                if cached is None:
+                    raise(BaseException("Cached version of {} vanished".format(url)))
+        dest = self._memory_buffer()
+        self._copy_from(cached, dest, checksum, report)
+        return dest
+
+    def _fetch_to_file(self, url, checksum, report, mirror=None, monitor=None, feed=None):
+        """Download url to a temporary file and return it with the key to add it to the download cache once verified.
+
+        The download cache is looked up first (by strongest digest, or url and server validator if we don't have any).
+        The content is written to a partial file in the user cache, kept if the download is interrupted. The next
+        attempt resumes it with a range request if the server content didn't change since (If-Range). A partial
+        download from another mirror is resumed too if we have a checksum to verify the whole content. Segmented
+        downloads (see _fetch_segments()) save the progress of each segment, and resume the missing ranges only.
+        checksum is fed with the content as it's written.
+        The content is fetched from mirror (url if None), monitor is an optional ThroughputMonitor of the download.
+        feed is an optional SinkFeed, fed the content as it's written. As it can't be fed the same bytes twice, a
+        download restarting from scratch needs a checksum to ensure they didn't change.
+        A local mirror file is neither cached nor resumed, see _fetch_local_file()."""
+        mirror = mirror or url
+        path, ext = os.path.splitext(url)
+        if self._is_local(mirror):
+            return (self._fetch_local_file(self._local_path(mirror), ext, checksum, report), None)
+        # Named because shutils and tarfile library needs a .name property
+        # http://bugs.python.org/issue21044
+        # also, ensure we keep the same suffix
+        cache = DownloadCache()
+        cache_key = cache.key_for(url, digest=checksum.strongest())
+        if cache_key:
+            dest = self._get_from_cache(cache_key, ext, checksum, report)
+            if dest:
+                return (dest, None)
+        partial_path, state_path = self._partial_paths(url, checksum.expected, self._staging_dir)
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+
+        offset = 0
+        segments = None
+        headers = {}
+        state = self._load_partial_state(state_path)
+        if state and os.path.isfile(partial_path) and os.path.getsize(partial_path):
+            # the validator of another mirror is meaningless, but the checksum pins the content
+            validator = state.get("validator") if state.get("url") == mirror else None
+            if validator or checksum.expected:
+                segments = self._load_segments(state, os.path.getsize(partial_path))
+                if segments is None:
+                    offset = os.path.getsize(partial_path)
+                    headers = {"Range": "bytes={}-".format(offset)}
+                else:
+                    missing = [segment for segment in segments if not segment.done]
+                    if not missing:
+                        # interrupted once complete
+                        with open(partial_path, 'rb') as f:
+                            self._fetch_segments(url, None, segments, f, checksum, report, feed=feed)
+                        return (self._finish_partial(partial_path, state_path, ext),
+                                cache_key or cache.key_for(url, validator=validator))
+                    headers = {"Range": "bytes={}-{}".format(missing[0].next, missing[0].end)}
+                if validator:
+                    headers["If-Range"] = validator
+
+        with closing(self._get(mirror, headers)) as r:
+            content_size = int(r.headers.get('content-length', -1))
+            if r.status_code == 206 and segments:
+                logger.info("Resuming segmented download of {}".format(mirror))
+                validator = self._validator(r) or state.get("validator")
+                with open(partial_path, 'r+b') as f:
+                    self._fetch_segments(url, r, segments, f, checksum, report, monitor, feed,
+                                         partial(self._save_segments, state_path, mirror, validator))
+                return (self._finish_partial(partial_path, state_path, ext),
+                        cache_key or cache.key_for(url, validator=validator))
+            if r.status_code == 206 and offset:
+                logger.info("Resuming download of {} from byte {}".format(mirror, offset))
+                mode = 'ab'
+                if content_size != -1:
+                    content_size += offset
+                with open(partial_path, 'rb') as f:
+                    checksum.update_from_file(f)
+                    if feed:
+                        feed.catch_up(f, offset)
+            elif r.status_code == 416 and (offset or segments):
+                logger.info("Can't resume download of {}, restarting it".format(url))
+                self._remove_partial(url, checksum.expected, self._staging_dir)
+                r.close()
+                return self._fetch_to_file(url, checksum, report, mirror, monitor, feed)
+            elif r.status_code == 200:
+                if feed and feed.written and not checksum.expected:
+                    raise(BaseException("Can't restart the download of {}, part of it was already used".format(url)))
+                offset = 0
+                mode = 'wb'
+                validator = self._save_partial_state(state_path, mirror, r)
+                if not cache_key:
+                    cache_key = cache.key_for(url, validator=validator)
+                    if cache_key:
+                        dest = self._get_from_cache(cache_key, ext, checksum, report)
+                        if dest:
+                            self._remove_partial(url, checksum.expected, self._staging_dir)
+                            return (dest, None)
+                if self._can_segment(r, content_size):
+                    segments = self._split(content_size)
+                    save_segments = partial(self._save_segments, state_path, mirror, validator)
+                    with open(partial_path, 'w+b') as f:
+                        preallocate(f.fileno(), content_size)
+                        f.truncate(content_size)
+                        save_segments(segments)
+                        self._fetch_segments(url, r, segments, f, checksum, report, monitor, feed, save_segments)
+                    return (self._finish_partial(partial_path, state_path, ext), cache_key)
+            else:
+                raise(self._download_error(r))
+
+            with open(partial_path, mode) as f:
+                if content_size > 0:
+                    preallocate(f.fileno(), content_size)
+                self._write_stream(r, TeeFile(f, feed, offset) if feed else f, offset, content_size, checksum, report,
+                                   monitor)
+
+        return (self._finish_partial(partial_path, state_path, ext), cache_key)
+
+    def _finish_partial(self, partial_path, state_path, suffix):
+        """Return the partial file of a complete download as our temporary file, dropping its state"""
+        with suppress(FileNotFoundError):
+            os.remove(state_path)
+        return get_temporary_file_from(partial_path, suffix=suffix, prefix=self._temporary_prefix())
+
+    def _fetch_local_file(self, path, suffix, checksum, report):
+        """Return a temporary file with the content of the local file path, without reading it in user space
+
+        The temporary file is a hard link to path if they are on the same filesystem, otherwise the content is
+        copied in kernel (sendfile). It's only read back if we have a checksum to compute."""
+        size = os.path.getsize(path)
+        report(0, size)
+        try:
+            dest = get_temporary_file_from(path, suffix=suffix, link=True, prefix=self._temporary_prefix(),
+                                           dir=self._staging_dir or tempfile.gettempdir())
+            logger.debug("Linked {} to {}".format(path, dest.name))
+        except OSError:
+            dest = self._temporary_file(suffix)
+            try:
+                with open(path, 'rb') as source:
+                    preallocate(dest.fileno(), size)
+                    offset = 0
+                    while offset < size:
+                        self._checkpoint()
+                        sent = os.sendfile(dest.fileno(), source.fileno(), offset, size - offset)
+                        if not sent:
+                            raise(BaseException("{} was truncated while copying it".format(path)))
+                        offset += sent
+                        report(offset, size)
+            except:
+                dest.close()
+                raise
+            logger.debug("Copied {} to {}".format(path, dest.name))
+        checksum.update_from_file(dest)
+        report(size, size)
+        return dest
+
+    def _fetch_to_sink(self, url, checksum, sink, report, mirrors=None):
+        """Download url to sink without any temporary file, feeding it from the download or page cache if it's there
+
+        As in _fetch_page(), a page cached but not fresh is revalidated with a conditional request, and replayed to
+        the sink if the server tells it's not modified. A page fully downloaded is added to the page cache.
+        On mirror failover, the next one is asked for the remaining bytes only, as the sink already got the
+        first ones (a local mirror file is read from there). The download stops as soon as the sink is complete."""
+        cache_key = DownloadCache.key_for(url, digest=checksum.strongest())
+        # a cached archive is verified before feeding it to the sink, which can't take it back
+        cached = self._get_from_cache(cache_key, "", checksum, report) if cache_key else None
+        if cached:
+            self._copy_from(cached, sink, Checksum(None), report, until=lambda: self._sink_complete(sink))
+            return
+        page_cache = None if self._download_to_file else PageCache()
+        cached = page_cache.open_fresh(url) if page_cache else None
+        if cached:
+            self._copy_from(cached, sink, checksum, report, until=lambda: self._sink_complete(sink))
+            return
+        progress = {"written": 0}
+
+        def fetch(mirror, monitor):
+            offset = progress["written"]
+            if self._is_local(mirror):
+                source = open(self._local_path(mirror), 'rb')
+                source.seek(offset)
+                try:
+                    self._copy_from(source, sink, checksum, report, until=lambda: self._sink_complete(sink),
+                                    monitor=monitor)
+                finally:
+                    progress["written"] = offset + monitor.size
+                return
+            # the cached page validators are the ones of url
+            revalidate = page_cache and not offset and mirror == url
+            if offset:
+                headers = {"Range": "bytes={}-".format(offset)}
+            else:
+                headers = page_cache.conditional_headers(url) if revalidate else None
+            with closing(self._get(mirror, headers)) as r:
+                content_size = int(r.headers.get('content-length', -1))
+                if revalidate and r.status_code == 304:
+                    logger.debug("{} not modified since cached".format(url))
+                    cached = page_cache.open(url)
+                    if cached is None:
+                        raise(BaseException("Cached version of {} vanished".format(url)))
+                    page_cache.refresh(url)
+                    self._copy_from(cached, sink, checksum, report, until=lambda: self._sink_complete(sink))
+                    return
+                if offset and r.status_code == 206:
+                    logger.info("Resuming download of {} from byte {}".format(mirror, offset))
+                    if content_size != -1:
+                        content_size += offset
+                elif offset or r.status_code != 200:
+                    raise(self._download_error(r))
+                # keep a copy of a page downloaded from its start to cache it
+                page = self._memory_buffer() if page_cache and not offset else None
+                try:
+                    dest = TeeFile(page, SinkFeed(sink), 0) if page is not None else sink
+                    whole = self._write_stream(r, dest, offset, content_size, checksum, report, monitor,
+                                               until=lambda: self._sink_complete(sink))
+                    if page is not None and whole:
+                        page_cache.add(url, r.headers, page)
+                finally:
+                    progress["written"] = offset + monitor.size
+                    if page is not None:
+                        page.close()
+
+        self._from_mirrors(url, mirrors or [url], fetch)
+
+    @staticmethod
+    def _sink_complete(sink):
+        """Return if sink doesn't need more content"""
+        return getattr(sink, "complete", False)
+
+    def _get_from_cache(self, cache_key, suffix, checksum, report):
+        """Return a temporary file from the download cache for cache_key if present, reporting it as fully downloaded
+
+        A cached archive which doesn't match the expected checksum is removed from the cache, and None is returned
+        to download it again, with checksum reset."""
+        cache = DownloadCache()
+        dest = cache.get(cache_key, suffix=suffix)
+        if dest:
+            checksum.update_from_file(dest)
+            mismatches = checksum.mismatches()
+            if mismatches:
+                logger.warning("The {} of {} in the download cache doesn't match, downloading it again".format(
+                    ", ".join(mismatches), cache_key))
+                dest.close()
+                cache.remove(cache_key)
+                checksum.reset()
+                return None
+            size = os.fstat(dest.fileno()).st_size
+            report(size, size)
         return dest
 
+    def _write_stream(self, response, dest, offset, content_size, checksum, report, monitor=None, until=None):
+        """Read response in chunk, write it to dest, hash it and send report updates
+
+        monitor, a ThroughputMonitor, counts the written bytes if set. If until is set, we stop reading as soon as
+        it returns True. Return if the whole response was read."""
+        limiter = BandwidthLimiter()
+        current_size = offset
+        report(current_size, content_size)
+        for data in self._iter_content(response):
+            self._checkpoint(monitor)
+            limiter.throttle(response.url, len(data))
+            dest.write(data)
+            checksum.update(data)
+            if monitor:
+                monitor.update(len(data))
+            current_size += len(data)
+            report(current_size, content_size)
+            if until is not None and until():
+                logger.debug("Stop downloading {}, we have what we need".format(response.url))
+                return False
+        return True
+
+    def _iter_content(self, response):
+        """Yield the decoded content of a streamed response in chunks sized by a ChunkSizer
+
+        The chunk size of requests' iter_content() is fixed, so we read the underlying urllib3 response ourselves,
+        translating its errors to requests' ones as iter_content() does."""
+        sizer = ChunkSizer(self.BLOCK_SIZE, self.MAX_BLOCK_SIZE)
+        while True:
+            try:
+                data = response.raw.read(sizer.size, decode_content=True)
+            except urllib3.exceptions.ProtocolError as e:
+                raise(requests.exceptions.ChunkedEncodingError(e))
+            except urllib3.exceptions.DecodeError as e:
+                raise(requests.exceptions.ContentDecodingError(e))
+            except urllib3.exceptions.ReadTimeoutError as e:
+                raise(requests.exceptions.ConnectionError(e))
+            except urllib3.exceptions.SSLError as e:
+                raise(requests.exceptions.SSLError(e))
+            if not data:
+                return
+            yield data
+            sizer.update()
+
+    async def _async_write_stream(self, response, dest, checksum, report, cancelled=None, resumed=None):
+        """Read an AsyncResponse in chunk, write it to dest, hash it and send report updates
+
+        cancelled and resumed are the cancellation and resume Events of the download, ours if None."""
+        content_size = int(response.headers.get('content-length', -1))
+        limiter = BandwidthLimiter()
+        current_size = 0
+        report(current_size, content_size)
+        async for data in response.iter_content(self.BLOCK_SIZE):
+            await self._async_checkpoint(cancelled, resumed)
+            delay = limiter.reserve(response.url, len(data))
+            if delay:
+                await asyncio.sleep(delay)
+            dest.write(data)
+            checksum.update(data)
+            current_size += len(data)
+            report(current_size, content_size)
+
+    @staticmethod
+    def _partial_paths(url, digests, staging_dir=None):
+        """Return the partial file path and its state file path for url and its expected digests dict
+
+        They are in the user cache, or hidden in staging_dir if set."""
+        digests = " ".join("{}:{}".format(algorithm, value) for (algorithm, value) in sorted((digests or {}).items()))
+        key = hashlib.sha1("{}\n{}".format(url, digests).encode()).hexdigest()
+        if staging_dir:
+            partial_path = os.path.join(staging_dir, ".udtc-partial-{}".format(key))
+        else:
+            partial_path = os.path.join(get_cache_path("partial"), key)
+        return (partial_path, partial_path + ".state")
+
+    def _remove_partial(self, url, digests, staging_dir=None):
+        """Remove partial file and state for url and its expected digests"""
+        for path in self._partial_paths(url, digests, staging_dir):
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+    def _load_partial_state(self, state_path):
+        """Return the state dict (url and validator) saved in state_path, None if there is none"""
+        try:
+            with open(state_path) as f:
+                state = yaml.safe_load(f)
+        except (FileNotFoundError, yaml.YAMLError):
+            return None
+        return state if isinstance(state, dict) else None
+
+    @staticmethod
+    def _validator(response):
+        """Return the strong validator (ETag or Last-Modified) of response, None if there is none"""
+        # weak ETags can't be used in If-Range
+        validator = response.headers.get('etag')
+        if not validator or validator.startswith('W/'):
+            validator = response.headers.get('last-modified')
+        return validator
+
+    def _save_partial_state(self, state_path, url, response):
+        """Save the url and validator of response in state_path so that the download can be resumed.
+
+        Return the validator, None if the server didn't send any."""
+        validator = self._validator(response)
+        with open(state_path, 'w') as f:
+            yaml.dump({"url": url, "validator": validator}, f, default_flow_style=False)
+        return validator
+
+    @staticmethod
+    def _load_segments(state, size):
+        """Return the Segment list saved in state for a size bytes partial file, None if it isn't a valid one"""
+        try:
+            if state["size"] != size:
+                return None
+            segments = [Segment(start, next, end) for (start, next, end) in state["segments"]]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if not segments or segments[0].start != 0 or segments[-1].end != size - 1:
+            return None
+        for (previous, segment) in zip(segments, segments[1:]):
+            if segment.start != previous.end + 1:
+                return None
+        if any(not segment.start <= segment.next <= segment.end + 1 for segment in segments):
+            return None
+        return segments
+
+    @staticmethod
+    def _save_segments(state_path, url, validator, segments):
+        """Save the progress of segments, downloaded from url, in state_path so that the missing ranges only are
+        downloaded on next attempt"""
+        state = {"url": url, "validator": validator, "size": segments[-1].end + 1,
+                 "segments": [[segment.start, segment.next, segment.end] for segment in segments]}
+        with open(state_path, 'w') as f:
+            yaml.dump(state, f, default_flow_style=False)
+
+    def _split(self, content_size):
+        """Return the Segment list splitting content_size bytes in SEGMENTS ranges"""
+        segment_size = -(-content_size // self.SEGMENTS)  # ceil division
+        return [Segment(start, start, min(start + segment_size, content_size) - 1)
+                for start in range(0, content_size, segment_size)]
+
+    def _can_segment(self, response, content_size):
+        """Return if the server enables us to split that download in multiple ranges fetched in parallel"""
+        return (self.SEGMENTS > 1 and content_size >= self.SEGMENT_MIN_SIZE and
+                response.headers.get('accept-ranges', '').lower() == 'bytes')
+
+    def _fetch_segments(self, url, response, segments, f, checksum, report, monitor=None, feed=None,
+                        save_segments=None):
+        """Download the missing segments of url content in the preallocated file object f, fetching them concurrently.
+
+        The first missing one is read from the already opened response, others are requested to the final
+        (redirected) url by jobs of the DownloadScheduler, so that they count against its host limits: the ones it
+        didn't start yet once we need them are run in this thread. Each segment writes directly at its offset in f.
+        Their progress is saved regularly and when they stop with save_segments(segments), if set, to resume them on
+        next attempt.
+        Each segment has its own ThroughputMonitor, with the settings of monitor, which counts all of them. On
+        transient errors, only the missing range of the failed segment is retried (up to MAX_RETRIES times), other
+        errors stop all segments.
+        The content is hashed in order: the first segment as it's streamed if it starts from scratch, next ones back
+        from f as soon as they are complete, while later ones are still downloading. feed, an optional SinkFeed, is
+        fed each segment once it's complete. response is None if there is no missing segment."""
+        content_size = segments[-1].end + 1
+        missing = [segment for segment in segments if not segment.done]
+        if missing:
+            logger.debug("Downloading {} in {} segments".format(response.url, len(missing)))
+            range_url = response.url
+        lock = threading.Lock()
+        stop = threading.Event()
+        cancelled = self._cancel_event()
+        resumed = self._resumed_event()
+        errors = []
+        progress = {"current": content_size - sum(segment.end + 1 - segment.next for segment in missing),
+                    "saved": monotonic()}
+
+        def on_data(segment, size):
+            with lock:
+                segment.next += size
+                progress["current"] += size
+                if monitor:
+                    monitor.count(size)
+                report(progress["current"], content_size)
+                if save_segments and monotonic() - progress["saved"] >= self.SEGMENT_STATE_INTERVAL:
+                    save_segments(segments)
+                    progress["saved"] = monotonic()
+
+        def run(segment, response=None, checksum=None):
+            self._local.cancelled = cancelled
+            self._local.resumed = resumed
+            retries = 0
+            while not segment.done and not stop.is_set():
+                segment_monitor = None
+                if monitor:
+                    segment_monitor = ThroughputMonitor(monitor.url, failover=monitor.failover,
+                                                        min_throughput=monitor.min_throughput)
+                try:
+                    if response is None:
+                        self._fetch_range(range_url, segment.next, segment.end, f, partial(on_data, segment),
+                                          checksum, segment_monitor, stop)
+                    else:
+                        with closing(response):
+                            self._write_range(response, segment.next, segment.end, f, partial(on_data, segment),
+                                              checksum, segment_monitor, stop)
+                    continue
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except BaseException as e:
+                    error = e
+                finally:
+                    response = None
+                if stop.is_set():
+                    return
+                if retries >= self.MAX_RETRIES or not self._is_transient(error):
+                    errors.append(error)
+                    stop.set()
+                    return
+                retries += 1
+                delay = random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** retries))
+                logger.warning("Download of range {}-{} of {} failed ({}), retrying in {:.1f}s".format(
+                    segment.next, segment.end, range_url, error, delay))
+                self._retried(url)
+                # cancel() or the failure of another segment end the backoff
+                deadline = monotonic() + delay
+                while not stop.is_set() and not cancelled.is_set() and monotonic() < deadline:
+                    stop.wait(min(self.PAUSE_POLL_INTERVAL, deadline - monotonic()))
+                self._checkpoint()
+
+        report(progress["current"], content_size)
+        hashed = 0
+        scheduler = DownloadScheduler()
+        segment_futures = {segment: scheduler.submit(run, segment, url=range_url, priority=self._priority,
+                                                     ready=resumed.is_set)
+                           for segment in missing[1:]}
+        try:
+            if missing:
+                # reuse the current connexion for the first missing segment
+                segment = missing[0]
+                streamed = segment.next == 0
+                run(segment, response, checksum if streamed else None)
+                if streamed and segment.done:
+                    hashed = segment.end + 1
+            for segment in segments:
+                if segment in segment_futures:
+                    # run ourself the segments still queued, as the scheduler may not have any worker left for them
+                    if segment_futures[segment].cancel():
+                        run(segment)
+                    else:
+                        segment_futures[segment].result()
+                if errors:
+                    break
+                if hashed <= segment.end:
+                    checksum.update_from_file(f, hashed, segment.end + 1)
+                    hashed = segment.end + 1
+                if feed:
+                    feed.catch_up(f, segment.end + 1)
+        finally:
+            stop.set()
+            for segment_future in segment_futures.values():
+                # wait for segments which started writing to f
+                if not segment_future.cancel():
+                    segment_future.exception()
+            if save_segments:
+                with lock:
+                    save_segments(segments)
+        if errors:
+            raise errors[0]
+
+    def _fetch_range(self, url, start, end, dest, on_data, checksum=None, monitor=None, stop=None):
+        """Fetch start-end bytes range (inclusive) of url and write them at the same offset in dest, see
+        _write_range()"""
+        with closing(self._get(url, {"Range": "bytes={}-{}".format(start, end)})) as r:
+            if r.status_code != 206:
+                message = "Can't download range {}-{} ({}): {}".format(start, end, r.status_code, r.reason)
+                raise(self._download_error(r, message))
+            self._write_range(r, start, end, dest, on_data, checksum, monitor, stop)
+
+    def _write_range(self, response, start, end, dest, on_data, checksum=None, monitor=None, stop=None):
+        """Write response content at its offset in dest, up to end (inclusive), hashing it if checksum is set
+
+        monitor, a ThroughputMonitor, checks the throughput if set. Writing ends early once stop, an Event, is set."""
+        limiter = BandwidthLimiter()
+        offset = start
+        for data in self._iter_content(response):
+            self._checkpoint(monitor)
+            if stop is not None and stop.is_set():
+                break
+            data = data[:end + 1 - offset]
+            limiter.throttle(response.url, len(data))
+            os.pwrite(dest.fileno(), data, offset)
+            if checksum:
+                checksum.update(data)
+            offset += len(data)
+            on_data(len(data))
+            if monitor:
+                monitor.update(len(data))
+            if offset > end:
+                break
+        if offset != end + 1:
+            message = "Download of range {}-{} of {} ended prematurely".format(start, end, response.url)
+            raise(TransientDownloadError(message))
+
     def _one_done(self, future):
         """Callback that will be called once the download finishes.
 
         (will be wired on the constructor)
         """
 
+        self._flush_progress(future.tag_url)
         result = self.DownloadResult(buffer=None, error=None, fd=None)
-        if future.exception():
+        if isinstance(future.exception(), DownloadCancelled):
+            logger.info("{} download cancelled".format(future.tag_url))
+            result = result._replace(error=str(future.exception()))
+        elif future.exception():
             logger.error("{} couldn't finish download: {}".format(future.tag_url, future.exception()))
             result = result._replace(error=str(future.exception()))
-            # cleaned unusable temp file as something bad happened
-            future.tag_dest.close()
         else:
             logger.info("{} download finished".format(future.tag_url))
             fd = future.result()
-            fd.seek(0)
-            if future.tag_download:
-                result = result._replace(fd=fd)
-            else:
-                result = result._replace(buffer=fd)
+            # content streamed to a sink has no fd
+            if fd is not None:
+                fd.seek(0)
+                if future.tag_download:
+                    result = result._replace(fd=fd)
+                else:
+                    result = result._replace(buffer=fd)
+        stats = self._retry_stats.get(future.tag_url, {})
+        metrics = self._metrics[future.tag_url].metrics(retries=stats.get("retries", 0), wasted=stats.get("wasted", 0))
+        logger.debug("Download metrics: {}".format(metrics))
+        append_metrics(metrics, result.error)
+        result = result._replace(metrics=metrics)
         self._downloaded_content[future.tag_url] = result
         if len(self._urls) == len(self._downloaded_content):
             self._done()
@@ -161,13 +1421,5 @@ class DownloadCenter:
         uris of the temporary files will be passed on the wired callback
         """
         logger.info("All pending downloads for {} done".format(self._urls))
+        logger.debug("Connection pool statistics: {}".format(SessionManager().stats()))
         self._done_callback(self._downloaded_content)
-
-    def _md5_for_fd(self, f, block_size=2**20):
-        md5 = hashlib.md5()
-        while True:
-            data = f.read(block_size)
-            if not data:
-                break
-            md5.update(data)
-        return md5.hexdigest()
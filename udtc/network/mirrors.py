@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering mirrors selection, based on their throughput history or a race between them"""
+
+from concurrent import futures
+from contextlib import closing, suppress
+import logging
+import os
+import threading
+from time import time
+from urllib.parse import urlparse
+from udtc.network.scheduler import DownloadScheduler
+from udtc.network.session import SessionManager
+from udtc.tools import Singleton, get_cache_path
+import yaml
+
+logger = logging.getLogger(__name__)
+
+
+class MirrorTooSlow(BaseException):
+    """Raised when the throughput of a mirror collapses during a download"""
+    pass
+
+
+class DownloadStalled(BaseException):
+    """Raised when a download throughput falls under the minimum one"""
+    pass
+
+
+class MirrorSelector(object, metaclass=Singleton):
+    """Order equivalent mirror urls, fastest first.
+
+    Mirrors are identified by their host. We keep an history of their throughput (moving average, in bytes per second)
+    in the user cache. Mirrors are ordered by that history once we know all of them, otherwise they are raced with a
+    small range request and ordered by response time."""
+
+    HISTORY_FILENAME = "mirrors"
+    PROBE_SIZE = 1024*64
+    PROBE_TIMEOUT = 10
+    HISTORY_WEIGHT = 0.3  # weight of a new throughput measure in the moving average
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return get_cache_path(self.HISTORY_FILENAME)
+
+    def _load_history(self):
+        try:
+            with open(self.path) as f:
+                history = yaml.safe_load(f)
+        except (FileNotFoundError, yaml.YAMLError):
+            history = None
+        return history if isinstance(history, dict) else {}
+
+    def throughput(self, url):
+        """Return the average throughput of url mirror, None if we don't know it"""
+        return self._load_history().get(urlparse(url).netloc)
+
+    def record(self, url, throughput):
+        """Record a download throughput measure (in bytes per second) for url mirror"""
+        host = urlparse(url).netloc
+        with self._lock:
+            history = self._load_history()
+            if host in history:
+                throughput = (1 - self.HISTORY_WEIGHT) * history[host] + self.HISTORY_WEIGHT * throughput
+            history[host] = throughput
+            with suppress(OSError):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'w') as f:
+                    yaml.dump(history, f, default_flow_style=False)
+        logger.debug("Throughput of {} is now {:.0f} B/s".format(host, throughput))
+
+    def order(self, urls):
+        """Return the list of urls, fastest mirror first"""
+        if len(urls) < 2:
+            return list(urls)
+        history = self._load_history()
+        hosts = [urlparse(url).netloc for url in urls]
+        if all(host in history for host in hosts):
+            logger.debug("Ordering mirrors by throughput history")
+            return sorted(urls, key=lambda url: history[urlparse(url).netloc], reverse=True)
+        return self.race(urls)
+
+    def race(self, urls):
+        """Probe all urls concurrently with a small range request, and return them by response time
+
+        Probes are metadata jobs of the DownloadScheduler, counting against its host limits. Mirrors which failed to
+        answer within PROBE_TIMEOUT are put last."""
+        logger.debug("Racing mirrors {}".format(urls))
+        ordered = []
+        scheduler = DownloadScheduler()
+        probes = {scheduler.submit(self._probe, url, url=url, priority=scheduler.PRIORITY_METADATA): url
+                  for url in urls}
+        try:
+            for probe in futures.as_completed(probes, timeout=self.PROBE_TIMEOUT):
+                if probe.exception() is None:
+                    ordered.append(probes[probe])
+                else:
+                    logger.info("Mirror {} didn't answer: {}".format(probes[probe], probe.exception()))
+        except futures.TimeoutError:
+            for probe in probes:
+                if not probe.done():
+                    probe.cancel()
+                    logger.info("Mirror {} didn't answer in time".format(probes[probe]))
+        ordered.extend(url for url in urls if url not in ordered)
+        logger.debug("Mirrors by response time: {}".format(ordered))
+        return ordered
+
+    def _probe(self, url):
+        """Fetch the first bytes of url"""
+        headers = {"Range": "bytes=0-{}".format(self.PROBE_SIZE - 1)}
+        with closing(SessionManager().get(url, headers=headers, stream=True, timeout=self.PROBE_TIMEOUT)) as r:
+            if r.status_code not in (200, 206):
+                raise BaseException("Can't download ({}): {}".format(r.status_code, r.reason))
+            size = 0
+            for data in r.iter_content(chunk_size=1024*8):
+                size += len(data)
+                if size >= self.PROBE_SIZE:
+                    break
+
+
+class ThroughputMonitor:
+    """Measure a download throughput, and detect when it collapses or stalls
+
+    The throughput is measured on windows of WINDOW seconds. If failover is set, MirrorTooSlow is raised as soon as
+    a window is under COLLAPSE_RATIO of the best window of this download. DownloadStalled is raised if a window is
+    under min_throughput (in bytes per second), if set."""
+
+    WINDOW = 2
+    COLLAPSE_RATIO = 0.1
+
+    def __init__(self, url, failover=False, min_throughput=None):
+        self.url = url
+        self.failover = failover
+        self.min_throughput = min_throughput
+        self.size = 0
+        self._start = time()
+        self._window_start = self._start
+        self._window_size = 0
+        self._best = 0
+
+    def update(self, size):
+        """Count size more bytes downloaded, checking the throughput at the end of each window"""
+        self.count(size)
+        now = time()
+        elapsed = now - self._window_start
+        if elapsed < self.WINDOW:
+            return
+        current = self._window_size / elapsed
+        self._window_start = now
+        self._window_size = 0
+        if self.min_throughput and current < self.min_throughput:
+            raise DownloadStalled("Download from {} stalled at {:.0f} B/s".format(self.url, current))
+        if self.failover and current < self._best * self.COLLAPSE_RATIO:
+            raise MirrorTooSlow("Throughput of {} collapsed to {:.0f} B/s".format(self.url, current))
+        self._best = max(self._best, current)
+
+    def count(self, size):
+        """Count size more bytes downloaded, without checking the throughput, like for a download whose parts are
+        monitored separately"""
+        self.size += size
+        self._window_size += size
+
+    def exclude(self, duration):
+        """Don't count duration seconds the download was paused, starting a new window"""
+        self._start += duration
+        self._window_start = time()
+        self._window_size = 0
+
+    def throughput(self):
+        """Return the average throughput of the download so far, in bytes per second"""
+        return self.size / max(time() - self._start, 0.001)
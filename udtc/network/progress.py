@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering the overall progress of several downloads"""
+
+from collections import namedtuple
+import threading
+
+
+class ProgressTotals(namedtuple("ProgressTotals", ["current", "known_current", "size", "unknown"])):
+    """Overall progress of several downloads, in bytes.
+
+    current is downloaded by all of them, known_current by the ones whose size is known, size is the sum of those
+    sizes and unknown the number of downloads of unknown size."""
+
+    __slots__ = ()
+
+    @property
+    def percentage(self):
+        """Return the percentage done of the downloads of known size, weighted by their size, None if there is none"""
+        if self.size <= 0:
+            return None
+        return self.known_current / self.size * 100
+
+
+class ProgressAggregator:
+    """Running totals of the progress of several downloads.
+
+    Each update() adjusts the totals by the difference with the previous progress of that download, so that both
+    updates and totals() take a constant time, whatever the number of downloads. A size of -1 is an unknown one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._progress = {}
+        self._current = 0
+        self._known_current = 0
+        self._size = 0
+        self._unknown = 0
+
+    def update(self, url, current, size):
+        """Set the progress of url download to current bytes out of size"""
+        with self._lock:
+            previous = self._progress.get(url)
+            if previous is not None:
+                self._add(*previous, sign=-1)
+            self._add(current, size)
+            self._progress[url] = (current, size)
+
+    def _add(self, current, size, sign=1):
+        self._current += sign * current
+        if size == -1:
+            self._unknown += sign
+        else:
+            self._known_current += sign * current
+            self._size += sign * size
+
+    def totals(self):
+        """Return the ProgressTotals of all downloads"""
+        with self._lock:
+            return ProgressTotals(current=self._current, known_current=self._known_current, size=self._size,
+                                  unknown=self._unknown)
+
+
+class ProgressSnapshot(dict):
+    """Progress of downloads by url, as reported by a DownloadCenter, with totals, their ProgressTotals"""
+
+    def __init__(self, progress, totals):
+        super().__init__(progress)
+        self.totals = totals
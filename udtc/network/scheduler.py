@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering the process wide scheduler running all downloads"""
+
+from collections import Counter
+from concurrent import futures
+import itertools
+import logging
+import threading
+from urllib.parse import urlparse
+from udtc.tools import ConfigHandler, Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadScheduler(object, metaclass=Singleton):
+    """Run submitted download jobs on a fixed number of worker threads shared by the whole process.
+
+    Jobs are run by priority (lower first), then in submission order, without running more than max_per_host jobs
+    for the same host at once. Priorities are classes of downloads: small metadata ones (pages, checksums) the user
+    waits on, bulk archive ones, then background prefetch ones. Bulk jobs (archive and prefetch ones) don't run on
+    more than max_workers workers at once, while METADATA_WORKERS extra workers are reserved to metadata jobs: those
+    start right away even while bulk downloads take all other workers.
+    Those limits can be set in the "network" section of the configuration: max_workers, max_per_host and host_limits
+    (a dict of host: maximum number of concurrent downloads)."""
+
+    DEFAULT_MAX_WORKERS = 3
+    DEFAULT_MAX_PER_HOST = 2
+    METADATA_WORKERS = 1
+    PRIORITY_METADATA = 0
+    PRIORITY_ARCHIVE = 1
+    PRIORITY_PREFETCH = 2
+    DEFAULT_PRIORITY = PRIORITY_ARCHIVE
+
+    def __init__(self):
+        config = ConfigHandler().config
+        try:
+            network_config = config["network"] or {}
+        except (TypeError, KeyError):
+            network_config = {}
+        self.max_workers = int(network_config.get("max_workers", self.DEFAULT_MAX_WORKERS))
+        self.max_per_host = int(network_config.get("max_per_host", self.DEFAULT_MAX_PER_HOST))
+        self.host_limits = network_config.get("host_limits", None) or {}
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._running_per_host = Counter()
+        self._running_bulk = 0
+        self._sequence = itertools.count()
+        self._workers = []
+
+    def submit(self, fn, *args, url=None, priority=DEFAULT_PRIORITY, ready=None):
+        """Queue fn(*args) for url, and return a Future for its result
+
+        ready, if set, returns if the job can start now (like once its downloads aren't paused): the job stays queued
+        without taking any worker until then. Call wake() once it may have changed."""
+        future = futures.Future()
+        host = urlparse(url).hostname if url else None
+        with self._condition:
+            self._pending.append((priority, next(self._sequence), host, future, fn, args, ready))
+            max_workers = self.max_workers
+            if priority <= self.PRIORITY_METADATA:
+                max_workers += self.METADATA_WORKERS
+            if len(self._workers) < max_workers:
+                worker = threading.Thread(target=self._work, name="download-worker-{}".format(len(self._workers)))
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+            self._condition.notify()
+        return future
+
+    def wake(self):
+        """Look for runnable jobs again, as the readiness of some may have changed"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def limit_for(self, host):
+        """Return the maximum number of concurrent jobs for host"""
+        return int(self.host_limits.get(host, self.max_per_host))
+
+    def _pop_runnable(self):
+        """Pop the first job by priority and submission order whose host isn't at its limit, None if there is none
+
+        Bulk jobs aren't runnable while max_workers of them are running, nor jobs which aren't ready. This must be
+        called with the condition held"""
+        bulk_runnable = self._running_bulk < self.max_workers
+        runnable = [job for job in self._pending
+                    if (bulk_runnable or not self._is_bulk(job[0])) and
+                    (job[2] is None or self._running_per_host[job[2]] < self.limit_for(job[2])) and
+                    (job[6] is None or job[6]())]
+        if not runnable:
+            return None
+        job = min(runnable, key=lambda job: job[:2])
+        self._pending.remove(job)
+        return job
+
+    def _is_bulk(self, priority):
+        return priority > self.PRIORITY_METADATA
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._pop_runnable()
+                while job is None:
+                    self._condition.wait()
+                    job = self._pop_runnable()
+                (priority, sequence, host, future, fn, args, ready) = job
+                self._running_per_host[host] += 1
+                if self._is_bulk(priority):
+                    self._running_bulk += 1
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = fn(*args)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self._condition:
+                    self._running_per_host[host] -= 1
+                    if self._is_bulk(priority):
+                        self._running_bulk -= 1
+                    # a job for that host, or a bulk one, may be runnable now
+                    self._condition.notify_all()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering a shared pool of http connections"""
+
+import logging
+import requests
+import requests.adapters
+from udtc.tools import ConfigHandler, Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager(object, metaclass=Singleton):
+    """Own the requests session shared by all downloads of the process, keeping connections alive between them.
+
+    The number of connections kept per host can be set as pool_size in the "network" section of the configuration."""
+
+    POOL_HOSTS = 10  # number of hosts we keep a connection pool for
+    DEFAULT_POOL_SIZE = 8  # connections kept alive per host (parallel downloads and segments)
+
+    def __init__(self):
+        try:
+            pool_size = int(ConfigHandler().config["network"]["pool_size"])
+        except (TypeError, KeyError, ValueError):
+            pool_size = self.DEFAULT_POOL_SIZE
+        logger.debug("Create a shared http session with {} connections per host".format(pool_size))
+        self.session = requests.Session()
+        for prefix in ("http://", "https://"):
+            self.session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=self.POOL_HOSTS,
+                                                                     pool_maxsize=pool_size))
+
+    def get(self, url, **kwargs):
+        """Send a GET request through the shared session"""
+        return self.session.get(url, **kwargs)
+
+    def stats(self):
+        """Return a dict of connections opened and reused by requests of hosts currently in the pool"""
+        connections = 0
+        requests_count = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                requests_count += pool.num_requests
+        return {"opened": connections, "requests": requests_count, "reused": max(requests_count - connections, 0)}
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering the process wide registry of in flight downloads"""
+
+from concurrent import futures
+import logging
+import threading
+from udtc.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class Transfer:
+    """A download shared by requests, a list of their (future, report), cancelled once all of them are
+
+    resumed is set unless all its requests are paused."""
+
+    def __init__(self, future, report):
+        self.requests = [(future, report)]
+        self.paused = set()
+        self.cancelled = threading.Event()
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def update_resumed(self):
+        """Set resumed if any request isn't paused, or once cancelled, clear it otherwise"""
+        if self.cancelled.is_set() or any(future not in self.paused for (future, report) in self.requests):
+            self.resumed.set()
+        else:
+            self.resumed.clear()
+
+
+class InFlightDownloads(object, metaclass=Singleton):
+    """Registry of the downloads in progress in the process, so that identical requests share a single transfer.
+
+    Each request gets its own Future. The first one gets the transfer result, next ones a new handle on it. Progress
+    is reported to all of them. A cancelled request is detached from the transfer, which is only cancelled once all
+    its requests are. Likewise, the transfer is only paused while all its requests are."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transfers = {}
+
+    def submit(self, key, start, share, report):
+        """Return a Future for the result of the download identified by key
+
+        If that download isn't in flight, start(report, cancelled, resumed) starts it and returns its Future, where
+        report sends the progress to all requests, cancelled is an Event set once all requests are cancelled and
+        resumed an Event cleared while all requests are paused.
+        share(result) returns a new handle on the result for each extra request."""
+        future = futures.Future()
+        with self._lock:
+            transfer = self._transfers.get(key)
+            if transfer is not None:
+                logger.info("{} is already downloading, waiting for it".format(key[0]))
+                transfer.requests.append((future, report))
+                transfer.update_resumed()
+                return future
+            transfer = Transfer(future, report)
+            self._transfers[key] = transfer
+
+        def report_all(current_size, total_size):
+            with self._lock:
+                reports = [report for (future, report) in transfer.requests]
+            for report in reports:
+                report(current_size, total_size)
+
+        started = start(report_all, transfer.cancelled, transfer.resumed)
+        started.add_done_callback(lambda done: self._done(key, transfer, done, share))
+        return future
+
+    def cancel(self, future, error):
+        """Cancel the request of future
+
+        If other requests share its transfer, the request is detached from it and fails with error right away.
+        Otherwise, the transfer is cancelled, failing the request with its own error."""
+        with self._lock:
+            (transfer, request) = self._find(future)
+            if transfer is None:
+                return
+            if len(transfer.requests) == 1:
+                transfer.cancelled.set()
+                transfer.update_resumed()
+                return
+            transfer.requests.remove(request)
+            transfer.paused.discard(future)
+            transfer.update_resumed()
+        future.set_exception(error)
+
+    def pause(self, future):
+        """Pause the request of future, its transfer being paused once all its requests are"""
+        with self._lock:
+            (transfer, request) = self._find(future)
+            if transfer is not None:
+                transfer.paused.add(future)
+                transfer.update_resumed()
+
+    def resume(self, future):
+        """Resume the request of future, and so its transfer"""
+        with self._lock:
+            (transfer, request) = self._find(future)
+            if transfer is not None:
+                transfer.paused.discard(future)
+                transfer.update_resumed()
+
+    def _find(self, future):
+        """Return the (transfer, request) of future, (None, None) if it's not in flight. This must be called with the
+        lock held"""
+        for transfer in self._transfers.values():
+            request = next((request for request in transfer.requests if request[0] is future), None)
+            if request is not None:
+                return (transfer, request)
+        return (None, None)
+
+    def _done(self, key, transfer, done, share):
+        """Deliver the result of the done transfer to all its requests"""
+        with self._lock:
+            del self._transfers[key]
+            requests = [future for (future, report) in transfer.requests]
+        error = done.exception()
+        if error is not None:
+            for future in requests:
+                future.set_exception(error)
+            return
+        result = done.result()
+        # extra requests get their handle first, as the first one may close the result as soon as it gets it
+        for future in requests[1:]:
+            try:
+                handle = share(result)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(handle)
+        requests[0].set_result(result)
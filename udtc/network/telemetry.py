@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering download performance metrics"""
+
+from collections import namedtuple
+import json
+import logging
+import math
+import os
+import threading
+from time import monotonic, time
+from udtc.tools import ConfigHandler
+
+logger = logging.getLogger(__name__)
+
+# Times are in seconds, throughputs in bytes per second. Times and throughputs we couldn't measure are None.
+DownloadMetrics = namedtuple("DownloadMetrics", ["url", "shared", "bytes", "queue_time", "connect_time", "ttfb",
+                                                 "wall_time", "mean_throughput", "p95_throughput", "stall_time",
+                                                 "retries", "wasted"])
+
+
+class MetricsRecorder:
+    """Record the performance of a download from its progress reports.
+
+    Wrap the download report function with report(). Each attempt of a download reports where it starts from once
+    it got the server answer (or the cached content), then its progress as it gets data. We measure:
+     - queue_time: from the request to the start of the download (begin()), waiting for a scheduler slot.
+     - connect_time: from the start of the download to the first answer. It includes the mirrors selection, the DNS
+       resolution, connection and TLS handshake if no pooled connection could be reused, and the server latency.
+     - ttfb: from the start of the download to the first byte of content.
+     - bytes: number of bytes transferred (not counting the cached or resumed ones).
+     - mean_throughput: bytes over the time spent transferring them, and p95_throughput, the 95th percentile of
+       throughput samples taken every SAMPLE_SIZE bytes.
+     - stall_time: the sum of the gaps of more than STALL_GAP seconds without receiving any byte.
+    A shared download joined a transfer in flight for another request: it's measured from its own request."""
+
+    SAMPLE_SIZE = 1024*64
+    STALL_GAP = 1
+
+    def __init__(self, url):
+        self.url = url
+        self.shared = True
+        self._created = self._start = monotonic()
+        self._answer = None
+        self._first_byte = None
+        self._last = None
+        self._current = None
+        self.bytes = 0
+        self._transfer_time = 0
+        self._stall_time = 0
+        self._sample_size = 0
+        self._sample_time = 0
+        self._samples = []
+
+    def begin(self):
+        """Mark the start of the download itself"""
+        self.shared = False
+        self._start = monotonic()
+
+    def report(self, report):
+        """Return report, wrapped to record the download progress"""
+        def _report(current_size, total_size):
+            self._update(current_size)
+            report(current_size, total_size)
+        return _report
+
+    def _update(self, current_size):
+        now = monotonic()
+        if self._current is None or current_size < self._current:
+            # a new attempt starts there
+            if self._answer is None:
+                self._answer = now
+            self._current = current_size
+            self._last = now
+            return
+        size = current_size - self._current
+        if not size:
+            return
+        if self._first_byte is None:
+            self._first_byte = now
+        elapsed = now - self._last
+        if elapsed > self.STALL_GAP:
+            self._stall_time += elapsed
+        self.bytes += size
+        self._transfer_time += elapsed
+        self._sample_size += size
+        self._sample_time += elapsed
+        if self._sample_size >= self.SAMPLE_SIZE:
+            self._add_sample()
+        self._current = current_size
+        self._last = now
+
+    def _add_sample(self):
+        if self._sample_time > 0:
+            self._samples.append(self._sample_size / self._sample_time)
+        self._sample_size = 0
+        self._sample_time = 0
+
+    def metrics(self, retries=0, wasted=0):
+        """Return the DownloadMetrics recorded so far, with the retries and wasted bytes counted by the caller"""
+        if self._sample_size:
+            self._add_sample()
+        p95_throughput = None
+        if self._samples:
+            # nearest rank: the smallest sample at least 95% of them are below or equal to
+            samples = sorted(self._samples)
+            p95_throughput = samples[math.ceil(len(samples) * 0.95) - 1]
+
+        def since_start(timestamp):
+            return timestamp - self._start if timestamp is not None else None
+
+        return DownloadMetrics(url=self.url, shared=self.shared, bytes=self.bytes,
+                               queue_time=self._start - self._created,
+                               connect_time=since_start(self._answer), ttfb=since_start(self._first_byte),
+                               wall_time=monotonic() - self._start,
+                               mean_throughput=self.bytes / self._transfer_time if self._transfer_time else None,
+                               p95_throughput=p95_throughput, stall_time=self._stall_time,
+                               retries=retries, wasted=wasted)
+
+
+_metrics_file_lock = threading.Lock()
+
+
+def metrics_file():
+    """Return the path of the file download metrics are appended to, None if there is none
+
+    It's set as metrics_file in the "network" section of the configuration."""
+    try:
+        path = ConfigHandler().config["network"]["metrics_file"]
+    except (TypeError, KeyError):
+        return None
+    return os.path.expanduser(path) if path else None
+
+
+def append_metrics(metrics, error=None):
+    """Append metrics of a download as a JSON line to the metrics file, if any, with the error which occurred"""
+    path = metrics_file()
+    if not path:
+        return
+    record = metrics._asdict()
+    record.update(timestamp=time(), error=error)
+    try:
+        with _metrics_file_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+    except OSError as e:
+        logger.warning("Can't write download metrics to {}: {}".format(path, e))
@@ -23,6 +23,7 @@ DEFAULT_INSTALL_TOOLS_PATH = os.path.expanduser(os.path.join("~", "tools"))
 CONFIG_FILENAME = "udtc"
 LSB_RELEASE_FILE = "/etc/lsb-release"
 UDTC_FRAMEWORKS_ENVIRON_VARIABLE = "UDTC_FRAMEWORKS"
+UDTC_DOWNLOAD_ENGINE_ENVIRON_VARIABLE = "UDTC_DOWNLOAD_ENGINE"
 
 # Those are for the tests
 DOCKER_USER = "user"
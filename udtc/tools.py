@@ -18,6 +18,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 from contextlib import suppress
+import ctypes
+import errno
 from gettext import gettext as _
 from gi.repository import GLib, Gio
 from glob import glob
@@ -28,9 +30,10 @@ import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 from textwrap import dedent
 from udtc import settings
-from xdg.BaseDirectory import load_first_config, xdg_config_home, xdg_data_home
+from xdg.BaseDirectory import load_first_config, xdg_cache_home, xdg_config_home, xdg_data_home
 import yaml
 import yaml.scanner
 import yaml.parser
@@ -141,6 +144,33 @@ class MainLoop(object, metaclass=Singleton):
         """Exception raised only to return to MainLoop without finishing the function"""
 
 
+class TemporaryFile:
+    """File object on an existing path, which is removed from disk once closed (like NamedTemporaryFile)"""
+
+    def __init__(self, path, mode='rb+'):
+        self.file = open(path, mode)
+        self.name = path
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['file'], name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(self.name)
+
+
 class InputError(BaseException):
     """Exception raised for errors in the input.
 
@@ -208,6 +238,46 @@ def get_user_frameworks_path():
     return os.path.expanduser(os.path.join('~', '.udtc', 'frameworks'))
 
 
+def get_cache_path(name):
+    """Return udtc cache path for name"""
+    return os.path.join(xdg_cache_home, "udtc", name)
+
+
+def get_temporary_file_from(path, suffix="", link=False, prefix="tmp", dir=None):
+    """Move path to a new temporary file name in dir (the same directory if None) and return it as an opened
+    TemporaryFile
+
+    If link is True, path is kept and the temporary file is a read only hard link to it."""
+    fd, temp_path = tempfile.mkstemp(suffix=suffix, prefix=prefix, dir=dir or os.path.dirname(path))
+    os.close(fd)
+    if link:
+        os.remove(temp_path)
+        os.link(path, temp_path)
+        return TemporaryFile(temp_path, mode='rb')
+    os.replace(path, temp_path)
+    return TemporaryFile(temp_path)
+
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+
+
+def preallocate(fd, size):
+    """Reserve size bytes of disk space for the file descriptor fd, without changing the file size.
+
+    This avoids fragmenting big downloads written chunk by chunk. It's best effort: nothing is done if the
+    platform or the filesystem doesn't support it, but we raise if there isn't enough disk space."""
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate64
+    except (OSError, AttributeError):
+        return
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if fallocate(fd, _FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        error = ctypes.get_errno()
+        if error == errno.ENOSPC:
+            raise BaseException("Not enough disk space to download {} bytes".format(size))
+        logger.debug("Can't preallocate {} bytes: {}".format(size, os.strerror(error)))
+
+
 def get_icon_path(icon_filename):
     """Return local icon path"""
     return os.path.join(xdg_data_home, "icons", icon_filename)
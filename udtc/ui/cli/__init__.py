@@ -21,14 +21,17 @@
 
 import argcomplete
 from contextlib import suppress
+from gettext import gettext as _
 import logging
 import os
 from progressbar import ProgressBar, BouncingBar
 import readline
 import sys
 from udtc.interactions import InputText, TextWithChoices, LicenseAgreement, DisplayMessage, UnknownProgress
+from udtc.network.download_cache import DownloadCache
 from udtc.ui import UI
 from udtc.frameworks import BaseCategory
+from udtc.frameworks.baseinstaller import BaseInstaller
 from udtc.tools import InputError, MainLoop
 
 logger = logging.getLogger(__name__)
@@ -86,6 +89,12 @@ class CliUI(UI):
 @MainLoop.in_mainloop_thread
 def run_command_for_args(args):
     """Run correct command for args"""
+    if args.category == "cache":
+        run_cache_command(args)
+        return
+    if args.category == "prefetch":
+        run_prefetch_command(args)
+        return
     # args.category can be a category or a framework in main
     target = None
     try:
@@ -95,6 +104,90 @@ def run_command_for_args(args):
     target.run_for(args)
 
 
+def run_cache_command(args):
+    """Display download cache statistics or prune it"""
+    cache = DownloadCache()
+    if args.action == "prune":
+        reclaimed = cache.evict(max_size=args.max_size)
+        UI.display(DisplayMessage(_("Reclaimed {} bytes from the download cache").format(reclaimed)))
+    else:
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] * 100 / lookups if lookups else 0
+        UI.display(DisplayMessage(_("Download cache: {entries} archives, {size} bytes used of {max_size}\n"
+                                    "Hits: {hits}, misses: {misses} ({hit_rate:.0f}% hit rate)")
+                                  .format(hit_rate=hit_rate, **stats)))
+    UI.return_main_screen()
+
+
+def install_cache_parser(parser):
+    """Install the download cache command parser"""
+    cache_parser = parser.add_parser("cache", help=_("Manage the cache of downloaded archives"))
+    cache_parser.add_argument("action", choices=["stats", "prune"],
+                              help=_("Show cache statistics or remove cached archives"))
+    cache_parser.add_argument("--max-size", type=int, default=0,
+                              help=_("Only prune least recently used archives until the cache fits in that size "
+                                     "(in bytes)"))
+
+
+def frameworks_to_prefetch(category_name=None, framework_name=None):
+    """Return the list of frameworks to prefetch: all of them, those of a category or one framework
+
+    Return None if there is no such category or framework."""
+    if category_name is None:
+        frameworks = [framework for category in BaseCategory.categories.values()
+                      for framework in category.frameworks.values()]
+    elif category_name in BaseCategory.categories:
+        frameworks = list(BaseCategory.categories[category_name].frameworks.values())
+        if framework_name is not None:
+            frameworks = [framework for framework in frameworks if framework.prog_name == framework_name]
+    elif framework_name is None and category_name in BaseCategory.main_category.frameworks:
+        frameworks = [BaseCategory.main_category.frameworks[category_name]]
+    else:
+        frameworks = []
+    frameworks = [framework for framework in frameworks if isinstance(framework, BaseInstaller)]
+    return frameworks or None
+
+
+def run_prefetch_command(args):
+    """Download the archives and provider pages of frameworks to the caches, all frameworks concurrently"""
+    frameworks = frameworks_to_prefetch(args.prefetch_category, args.prefetch_framework)
+    if not frameworks:
+        logger.error("No framework to prefetch for {}".format(" ".join(
+            name for name in (args.prefetch_category, args.prefetch_framework) if name)))
+        UI.return_main_screen(status_code=1)
+        return
+    pending = set(frameworks)
+    errors = []
+
+    @MainLoop.in_mainloop_thread
+    def done(framework, error):
+        pending.discard(framework)
+        if error:
+            errors.append(framework.name)
+        else:
+            UI.display(DisplayMessage(_("{} is prefetched").format(framework.name)))
+        if not pending:
+            if errors:
+                UI.display(DisplayMessage(_("Couldn't prefetch {}").format(", ".join(sorted(errors)))))
+            UI.return_main_screen(status_code=1 if errors else 0)
+
+    names = sorted(framework.name for framework in frameworks)
+    UI.display(DisplayMessage(_("Prefetching {}").format(", ".join(names))))
+    for framework in frameworks:
+        framework.prefetch(done)
+
+
+def install_prefetch_parser(parser):
+    """Install the prefetch command parser"""
+    prefetch_parser = parser.add_parser("prefetch", help=_("Download frameworks to the cache, without installing them"))
+    prefetch_parser.add_argument("prefetch_category", metavar="category", nargs="?",
+                                 help=_("Only prefetch frameworks of that category (or that framework of the main "
+                                        "category)"))
+    prefetch_parser.add_argument("prefetch_framework", metavar="framework", nargs="?",
+                                 help=_("Only prefetch that framework of the category"))
+
+
 def mangle_args_for_default_framework(args):
     """return the potentially changed args_to_parse for the parser for handling default frameworks
 
@@ -153,6 +246,8 @@ def main(parser):
     categories_parser = parser.add_subparsers(help='Developer environment', dest="category")
     for category in BaseCategory.categories.values():
         category.install_category_parser(categories_parser)
+    install_cache_parser(categories_parser)
+    install_prefetch_parser(categories_parser)
 
     argcomplete.autocomplete(parser)
     # autocomplete will stop there. Can start more expensive operations now.